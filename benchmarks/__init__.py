@@ -0,0 +1,10 @@
+#
+# Benchmarks of the MeshNet stack, run on CPython with the emulator's hardware shims.
+#
+#    python -m benchmarks --output results.json
+#    python -m benchmarks --compare baseline.json
+#
+# micro.py times the hot paths one at a time; macro.py runs the whole stack on
+# simulated topologies.  results.py keeps results as JSON and flags regressions
+# against a baseline.
+#
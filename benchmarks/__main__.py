@@ -0,0 +1,50 @@
+#
+# python -m benchmarks [--micro | --macro] [--match TEXT] [--output FILE] [--compare BASELINE]
+#
+import argparse
+import contextlib
+import os
+import sys
+
+from emulator import shims
+shims.install()
+
+from benchmarks import results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark the MeshNet stack")
+    parser.add_argument('--micro', action='store_true', help="only the micro-benchmarks")
+    parser.add_argument('--macro', action='store_true', help="only the macro-benchmarks")
+    parser.add_argument('--match', default='', help="only benchmarks whose names contain this")
+    parser.add_argument('--quick', action='store_true', help="shorter micro-benchmark rounds")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--results', help="use results from this file instead of running")
+    parser.add_argument('--compare', help="baseline results to flag regressions against")
+    parser.add_argument('--threshold', type=float, default=10.0, help="percent worse that is a regression (default 10)")
+    args = parser.parse_args(argv)
+
+    if args.results:
+        current = results.load(args.results)
+    else:
+        # Micro-benchmarks first: the macro ones leave the stack's threads on a virtual clock
+        from benchmarks import micro, macro
+        current = {}
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+            if not args.macro:
+                current.update(micro.run(args.match, rounds=2 if args.quick else 5, round_time=0.05 if args.quick else 0.2))
+            if not args.micro:
+                current.update(macro.run(args.match))
+
+    if args.output:
+        results.save(current, args.output)
+
+    if args.compare:
+        rows = results.compare(results.load(args.compare), current, args.threshold / 100.0)
+        results.print_comparison(rows)
+        if any(row[4] == 'regression' for row in rows):
+            sys.exit(1)
+    else:
+        results.print_results(current)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#
+# Macro-benchmarks: the whole stack on standard simulated topologies.
+#
+# On each topology the first node sends to the node farthest from it:
+#    - one packet needing route discovery, then one over the route found
+#    - a burst of packets queued at once, for forwarding throughput
+#
+# Simulated figures depend only on the stack and the seed, so a change in them is a
+# change in behavior.  The wall figure is what running the stack costs the host.
+#
+import math
+import os
+import time
+
+from emulator import topology
+from emulator.simulate import Simulation, default_spacing
+from emulator.medium import Medium
+from meshdomains import US902_MESHNET
+
+_SEED       = 1
+_CHANNEL    = (64, 8)
+_STAGGER    = 10.0       # Seconds for the nodes to come up
+_TIMEOUT    = 60.0       # Seconds to wait for deliveries
+_SIZE       = 16         # Payload bytes; fits one frame at this datarate
+_BURST      = 20         # Packets in the throughput burst
+
+_ROUTE_TXT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'route.txt')
+
+TOPOLOGIES = (
+    ('line4',   lambda spacing: topology.line(4, spacing)),
+    ('line8',   lambda spacing: topology.line(8, spacing)),
+    ('grid4x4', lambda spacing: topology.grid(4, 4, spacing)),
+    ('route',   lambda spacing: topology.load(_ROUTE_TXT, spacing)),
+)
+
+def _farthest(nodes, origin):
+    return max(nodes, key=lambda node: math.hypot(node[1] - origin[1], node[2] - origin[2]))
+
+# Results of one topology, named <name>.<figure>
+def measure(name, nodes):
+    source = nodes[0][0]
+    target = _farthest(nodes, nodes[0])[0]
+
+    simulation = Simulation(nodes, domain=US902_MESHNET, channel=_CHANNEL, seed=_SEED)
+    simulation.start(_STAGGER)
+
+    discovery = simulation.send(source, target, _SIZE)
+    simulation.wait([ discovery ], _TIMEOUT)
+    routed = simulation.send(source, target, _SIZE)
+    simulation.wait([ routed ], _TIMEOUT)
+
+    started = time.perf_counter()
+    burst = [ simulation.send(source, target, _SIZE) for packet in range(_BURST) ]
+    simulation.wait(burst, _TIMEOUT)
+    wall = time.perf_counter() - started
+    arrived = [ simulation.latency(serial) for serial in burst if simulation.latency(serial) != None ]
+
+    report = simulation.report()
+    simulation.stop()
+
+    return {
+        name + '.discovery_latency':    { 'value': simulation.latency(discovery), 'unit': 's', 'better': 'lower' },
+        name + '.route_latency':        { 'value': simulation.latency(routed), 'unit': 's', 'better': 'lower' },
+        name + '.throughput':           { 'value': len(arrived) / max(arrived) if arrived else 0.0, 'unit': 'packets/s', 'better': 'higher' },
+        name + '.delivery':             { 'value': len(arrived) / _BURST, 'unit': 'fraction', 'better': 'higher' },
+        name + '.control_frames':       { 'value': report['control_frames'], 'unit': 'frames', 'better': 'lower' },
+        name + '.wall_per_packet':      { 'value': wall / len(arrived) * 1E3 if arrived else None, 'unit': 'ms', 'better': 'lower' },
+    }
+
+# Results by name for the topologies whose names contain <match>.  Each runs on a
+# VirtualClock of its own, which the stack's threads then stay on.
+def run(match=''):
+    spacing = default_spacing(US902_MESHNET, _CHANNEL, Medium())
+    results = {}
+    for name, layout in TOPOLOGIES:
+        if match in "macro." + name:
+            results.update(measure("macro." + name, layout(spacing)))
+    return results
@@ -0,0 +1,139 @@
+#
+# Micro-benchmarks of single stack operations.
+#
+# Each benchmark sets up and returns a body to time.  The body runs in rounds of a
+# calibrated number of iterations; the best round gives the microseconds per iteration.
+#
+import json
+import time
+
+from meshdomains import US902_MESHNET
+from meshnet import MeshNet, Packet, DataPacket, RouteAnnounce
+from uqueue import queue
+from ulock import rlock
+from configdata import ConfigData
+from webserver import HttpRequest
+
+_ROUNDS = 5
+_ROUND_TIME = 0.2        # Seconds each round should take
+
+# Shaped like a unit's configuration (see config-unit-1)
+_CONFIG = {
+    "mesh": { "channel": "64", "datarate": "13", "address": "1", "target": "2" },
+    "device": { "name": "meshnet_test" },
+    "host": { "ap": { "password": "", "essid": "" } },
+    "apmode": { "password": "zippydooda", "essid": "mesh-test-0-1" },
+    "%version": "1",
+}
+
+# A configuration form posted to the unit's web server
+_HTTP_HEADERS = [
+    b'POST /config HTTP/1.1',
+    b'Host: 192.168.4.1',
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:91.0) Gecko/20100101 Firefox/91.0',
+    b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    b'Content-Type: application/x-www-form-urlencoded',
+    b'Content-Length: 64',
+    b'Connection: keep-alive',
+]
+_HTTP_BODY = b'mesh.address=2&mesh.channel=64&mesh.datarate=13&apmode.essid=x%2Fy\r\n'
+
+def packet_encode():
+    payload = bytearray(32)
+    def body():
+        packet = DataPacket(target=2, source=1, previous=1, nexthop=3, protocol=99, payload=payload)
+        packet.ttl(packet.ttl() - 1)
+    return body
+
+def packet_decode():
+    data = DataPacket(target=2, source=1, previous=1, nexthop=3, protocol=99, payload=bytearray(32)).data()
+    def body():
+        packet = Packet(load=data)
+        packet.nexthop()
+        packet.previous()
+        packet.target()
+        packet.source()
+        packet.ttl()
+        packet.protocol()
+    return body
+
+def wrap_packet():
+    mesh = MeshNet(US902_MESHNET, 1)
+    frames = [ RouteAnnounce(target=1, source=3, previous=2, sequence=5, metric=2).data(),
+               DataPacket(target=1, source=3, previous=2, protocol=99, payload=bytearray(32)).data() ]
+    def body():
+        for frame in frames:
+            mesh.wrap_packet(frame)
+    return body
+
+def queue_put_get():
+    fifo = queue()
+    def body():
+        fifo.put(1)
+        fifo.get()
+    return body
+
+def rlock_acquire_release():
+    lock = rlock()
+    def body():
+        with lock:
+            with lock:
+                pass
+    return body
+
+def configdata_get():
+    config = ConfigData(read=lambda: json.dumps(_CONFIG))
+    def body():
+        config.get("mesh.address")
+        config.get("mesh.channel")
+        config.get("apmode.essid")
+    return body
+
+# What WebServer.run does with a request once read
+def http_parse():
+    def body():
+        request = HttpRequest()
+        for header in _HTTP_HEADERS:
+            request.add_header(header)
+        index = request.find_header_matching(b"^Content-Length:.*")
+        int(request.get_header_tag_value(b"Content-Length:", index))
+        request.set_body(_HTTP_BODY)
+        request.url
+        request.method
+        request.post_response()
+    return body
+
+BENCHMARKS = (
+    ('packet_encode',           packet_encode),
+    ('packet_decode',           packet_decode),
+    ('wrap_packet',             wrap_packet),
+    ('queue_put_get',           queue_put_get),
+    ('rlock_acquire_release',   rlock_acquire_release),
+    ('configdata_get',          configdata_get),
+    ('http_parse',              http_parse),
+)
+
+def _time(body, number):
+    started = time.perf_counter()
+    for iteration in range(number):
+        body()
+    return time.perf_counter() - started
+
+# Microseconds per call of <body>
+def measure(body, rounds=_ROUNDS, round_time=_ROUND_TIME):
+    number = 1
+    elapsed = _time(body, number)
+    while elapsed < round_time / 10:
+        number *= 10
+        elapsed = _time(body, number)
+    number = max(int(number * round_time / elapsed), 1)
+
+    return min(_time(body, number) for round in range(rounds)) / number * 1E6
+
+# Results by name for the benchmarks whose names contain <match>
+def run(match='', rounds=_ROUNDS, round_time=_ROUND_TIME):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if match in "micro." + name:
+            results["micro." + name] = { 'value': measure(setup(), rounds, round_time), 'unit': 'us', 'better': 'lower' }
+    return results
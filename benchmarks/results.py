@@ -0,0 +1,75 @@
+#
+# Benchmark results as JSON, and their comparison with a baseline.
+#
+#    {
+#        "environment": { "python": ..., "platform": ..., "time": ... },
+#        "results": {
+#            "micro.packet_encode": { "value": 3.2, "unit": "us", "better": "lower" },
+#            ...
+#        }
+#    }
+#
+# A value of null is a benchmark that produced nothing (a packet never arrived).
+#
+import json
+import math
+import platform
+import time
+
+_THRESHOLD = 0.10          # Fraction worse than the baseline that counts as a regression
+
+def environment():
+    return {
+        'python':       platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform':     platform.platform(),
+        'machine':      platform.machine(),
+        'time':         time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def save(results, filename):
+    with open(filename, 'w') as f:
+        json.dump({ 'environment': environment(), 'results': results }, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+# Compare <results> with <baseline>.  Returns (name, old, new, change, status) for every
+# benchmark in either; <change> is the fraction by which it got worse and <status> one of
+# 'regression', 'improvement', 'same', 'new' or 'missing'.
+def compare(baseline, results, threshold=_THRESHOLD):
+    rows = []
+    for name in sorted(set(baseline) | set(results)):
+        if name not in results:
+            rows.append((name, baseline[name]['value'], None, None, 'missing'))
+            continue
+        if name not in baseline:
+            rows.append((name, None, results[name]['value'], None, 'new'))
+            continue
+
+        old, new = baseline[name]['value'], results[name]['value']
+        if old == None or new == None:
+            status = 'same' if old == new else 'regression' if new == None else 'improvement'
+            rows.append((name, old, new, None, status))
+            continue
+
+        worse = new - old if results[name]['better'] == 'lower' else old - new
+        change = worse / abs(old) if old != 0 else (0.0 if worse == 0 else math.copysign(math.inf, worse))
+        status = 'regression' if change > threshold else 'improvement' if change < -threshold else 'same'
+        rows.append((name, old, new, change, status))
+
+    return rows
+
+def _value(value):
+    return "-" if value == None else "%.4g" % value
+
+def print_results(results):
+    for name in sorted(results):
+        print("%-40s %12s %s" % (name, _value(results[name]['value']), results[name]['unit']))
+
+def print_comparison(rows):
+    for name, old, new, change, status in rows:
+        print("%-40s %12s %12s %8s  %s" % (name, _value(old), _value(new),
+              "" if change == None else "%+.1f%%" % (change * 100), status))
@@ -0,0 +1,20 @@
+#
+# Host side emulation of the radio hardware.
+#
+# Lets the unmodified MeshNet stack run under CPython:
+#
+#    from emulator import shims
+#    shims.install()
+#    from emulator.sx127x_emulator import SX127xEmulator
+#    from emulator.ether import Ether
+#
+#    ether = Ether()
+#    SX127xEmulator(medium=ether)      # Wired to the default MeshNet pins
+#
+#    from meshnet import MeshNet
+#    ...
+#
+# Many nodes on simulated time, with path loss and collisions (see simulate.py):
+#
+#    python -m emulator.simulate --topology grid:10x20 --duration 600
+#
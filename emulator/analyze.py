@@ -0,0 +1,357 @@
+#
+# Offline analysis of frame captures (see meshcapture.py) with NumPy.
+#
+#    python -m emulator.analyze node1.bin node2.bin ... [--compress-header] [--json]
+#
+# All records of all captures are loaded into one set of NumPy arrays, one element per
+# frame, and the mesh header and the route control fields are decoded for all of them
+# at once.  The report gives:
+#    - per link: frames received, CRC errors and, when the sender was captured too, the
+#      delivery ratio: frames heard over frames it sent that were for the receiver or
+#      broadcast.  Captures are assumed to cover the same period.
+#    - inter-arrival time histogram of frames on each link, and their median
+#    - flood fan-out: nodes seen sending each RouteRequest (source, sequence)
+#    - hop counts of routed frames by kind, from the TTL they arrive with
+#    - airtime sent by each node, at the captured datarate: its own capture where there
+#      is one, else the capture that heard the most of it
+#
+# Only the walk over record lengths is a Python loop; millions of frames take seconds.
+#
+import argparse
+import json
+import sys
+
+import numpy
+
+from emulator import shims
+shims.install()
+
+import meshdomains
+import meshnet
+from meshcapture import *
+from sx127x import compile_domain
+from emulator.replay import read, decode_header, CaptureError
+from emulator.simulate import _FRAME_KINDS
+
+_WINDOW             = 24        # Frame bytes decoded: header, control fields and some spare
+_TICKS_PERIOD       = 1 << 30
+_CODING_RATE        = 5         # 4/5
+_PREAMBLE           = 8
+_INTERVAL_BOUNDS    = (10, 50, 100, 500, 1000, 5000, 10000, 30000, 60000, 300000)   # ms
+
+_BEACON             = meshnet.Beacon.PROTOCOL_ID
+_REQUEST            = meshnet.RouteRequest.PROTOCOL_ID
+
+# Record start offsets in capture <data> (bytes: indexing them is quicker than an array)
+def _offsets(data):
+    offsets = []
+    append = offsets.append
+    offset = CAPTURE_HEADER_LEN
+    end = len(data) - CAPTURE_RECORD_LEN
+    while offset <= end:
+        append(offset)
+        offset += CAPTURE_RECORD_LEN + data[offset + CAPTURE_RECORD_LEN - 1]
+    # A record cut short by the end of the file
+    if offsets and offset > len(data):
+        offsets.pop()
+    return numpy.array(offsets, dtype=numpy.int64)
+
+# <width> bytes from each of <offsets>, zero past the end of <data>, as a 2D array
+def _gather(data, offsets, width):
+    index = offsets[:, None] + numpy.arange(width)
+    padded = numpy.concatenate((data, numpy.zeros(width, dtype=numpy.uint8)))
+    return padded[numpy.minimum(index, len(data))].astype(numpy.int64)
+
+# Big endian 16 bit value at column <index> (one per row) of <window>
+def _word(window, index):
+    rows = numpy.arange(len(window))
+    index = numpy.minimum(index, window.shape[1] - 2)
+    return (window[rows, index] << 8) | window[rows, index + 1]
+
+def _byte(window, index):
+    return window[numpy.arange(len(window)), numpy.minimum(index, window.shape[1] - 1)]
+
+# Header fields of full header frames
+def _decode_full(window):
+    header = {
+        'nexthop':  (window[:, meshnet._HEADER_NEXTHOP[0]] << 8) | window[:, meshnet._HEADER_NEXTHOP[0] + 1],
+        'target':   (window[:, meshnet._HEADER_TARGET[0]] << 8) | window[:, meshnet._HEADER_TARGET[0] + 1],
+        'previous': (window[:, meshnet._HEADER_PREVIOUS[0]] << 8) | window[:, meshnet._HEADER_PREVIOUS[0] + 1],
+        'source':   (window[:, meshnet._HEADER_SOURCE[0]] << 8) | window[:, meshnet._HEADER_SOURCE[0] + 1],
+        'protocol': window[:, meshnet._HEADER_PROTOCOL[0]],
+        'ttl':      window[:, meshnet._HEADER_TTL[0]],
+        'payload':  numpy.full(len(window), meshnet._HEADER_PAYLOAD),
+    }
+    return header
+
+# Header fields of compressed header frames, as expand_header() finds them
+def _decode_compressed(window):
+    flags = window[:, 0]
+    index = numpy.full(len(window), meshnet._COMPRESS_FLAGS_LEN)
+
+    broadcast = (flags & meshnet._COMPRESS_NEXTHOP_BROADCAST) != 0
+    nexthop = numpy.where(broadcast, meshnet.BROADCAST_ADDRESS, _word(window, index))
+    index += numpy.where(broadcast, 0, meshnet._ADDRESS_LEN)
+
+    same = (flags & meshnet._COMPRESS_TARGET_IS_NEXTHOP) != 0
+    target = numpy.where(same, nexthop, _word(window, index))
+    index += numpy.where(same, 0, meshnet._ADDRESS_LEN)
+
+    previous = _word(window, index)
+    index += meshnet._ADDRESS_LEN
+
+    same = (flags & meshnet._COMPRESS_SOURCE_IS_PREVIOUS) != 0
+    source = numpy.where(same, previous, _word(window, index))
+    index += numpy.where(same, 0, meshnet._ADDRESS_LEN)
+
+    short = (flags & meshnet._COMPRESS_SHORT_TTL) != 0
+    first = _byte(window, index)
+    protocol = numpy.where(short, first & 0x0F, first)
+    ttl = numpy.where(short, first >> 4, _byte(window, index + meshnet._PROTOCOL_LEN))
+    index += numpy.where(short, meshnet._TTL_LEN, meshnet._PROTOCOL_LEN + meshnet._TTL_LEN)
+
+    protocol |= numpy.where(flags & meshnet._COMPRESS_ACK_REQUEST, meshnet._PROTOCOL_ACK_REQUEST, 0)
+
+    return {
+        'nexthop':  nexthop,
+        'target':   target,
+        'previous': previous,
+        'source':   source,
+        'protocol': protocol,
+        'ttl':      ttl,
+        'payload':  index,
+        'valid':    (flags & meshnet._COMPRESS_RESERVED) == 0,
+    }
+
+# Every frame of <captures> (their contents, as read()) as a dict of equal length arrays.
+# Frames sent without a LoRa header always carry the full mesh header; the rest have
+# compressed ones when <compressed>.
+def frames(captures, compressed=False):
+    columns = {}
+    for capture in captures:
+        header = decode_header(capture)
+        offsets = _offsets(capture)
+        data = numpy.frombuffer(capture, dtype=numpy.uint8)
+        fixed = _gather(data, offsets, CAPTURE_RECORD_LEN)
+        window = _gather(data, offsets + CAPTURE_RECORD_LEN, _WINDOW)
+
+        part = {
+            'node':      numpy.full(len(offsets), header['address']),
+            'datarate':  numpy.full(len(offsets), header['channel'][1]),
+            'ticks':     fixed[:, 0] | (fixed[:, 1] << 8) | (fixed[:, 2] << 16) | (fixed[:, 3] << 24),
+            'flags':     fixed[:, 4],
+            'interface': fixed[:, 5],
+            'rssi':      (fixed[:, 6] | (fixed[:, 7] << 8)).astype(numpy.uint16).astype(numpy.int16),
+            'snr':       (fixed[:, 8] | (fixed[:, 9] << 8)).astype(numpy.uint16).astype(numpy.int16),
+            'length':    fixed[:, 10],
+        }
+
+        full = _decode_full(window)
+        full['valid'] = part['length'] >= meshnet._HEADER_LENGTH
+        if compressed:
+            packed = _decode_compressed(window)
+            implicit = (part['flags'] & CAPTURE_IMPLICIT) != 0
+            for field in full:
+                full[field] = numpy.where(implicit, full[field], packed[field])
+        part.update(full)
+        part['valid'] &= part['payload'] <= part['length']
+
+        # Route control fields follow the header alike in announces and requests
+        payload = part['payload']
+        part['sequence'] = _word(window, payload + meshnet._RREQ_SEQUENCE[0] - meshnet._HEADER_PAYLOAD)
+        part['metric'] = _byte(window, payload + meshnet._RREQ_METRIC[0] - meshnet._HEADER_PAYLOAD)
+
+        for field, values in part.items():
+            columns.setdefault(field, []).append(values)
+
+    result = { field: numpy.concatenate(values) for field, values in columns.items() }
+    result['sent'] = (result['flags'] & CAPTURE_TX) != 0
+    result['crc_ok'] = (result['flags'] & CAPTURE_CRC_ERROR) == 0
+    result['kind'] = result['protocol'] & ~meshnet._PROTOCOL_ACK_REQUEST
+    return result
+
+# Count of observations at or below each of <bounds> plus one above the last
+def _histogram(values, bounds):
+    return numpy.bincount(numpy.searchsorted(numpy.array(bounds), values), minlength=len(bounds) + 1).tolist()
+
+# One int64 per (sender, receiver) link; sorting and unique are much quicker on these
+# than on rows of a 2D array
+def _link(sender, receiver):
+    return (sender << 16) | receiver
+
+def _link_name(link):
+    return "%d>%d" % (link >> 16, link & 0xFFFF)
+
+def _kind_name(kind):
+    return _FRAME_KINDS[kind] if kind in _FRAME_KINDS else 'data'
+
+def _links(data):
+    good = ~data['sent'] & data['valid'] & data['crc_ok']
+    heard = good & ((data['nexthop'] == data['node']) | (data['nexthop'] == meshnet.BROADCAST_ADDRESS))
+    pairs, received = numpy.unique(_link(data['previous'][heard], data['node'][heard]), return_counts=True)
+    captured = set(numpy.unique(data['node']).tolist())
+
+    # Frames each captured node sent, by next hop
+    sent = data['sent'] & data['valid']
+    offered, counts = numpy.unique(_link(data['node'][sent], data['nexthop'][sent]), return_counts=True)
+    offered = dict(zip(offered.tolist(), counts.tolist()))
+
+    links = {}
+    for link, count in zip(pairs.tolist(), received.tolist()):
+        entry = { 'received': count }
+        sender, receiver = link >> 16, link & 0xFFFF
+        if sender in captured:
+            entry['sent'] = offered.get(link, 0) + offered.get(_link(sender, meshnet.BROADCAST_ADDRESS), 0)
+            entry['pdr'] = count / entry['sent'] if entry['sent'] else None
+        links[_link_name(link)] = entry
+
+    # CRC errors can only be put down to the receiver
+    errors = ~data['sent'] & ~data['crc_ok']
+    nodes, counts = numpy.unique(data['node'][errors], return_counts=True)
+    return links, { str(node): int(count) for node, count in zip(nodes.tolist(), counts.tolist()) }
+
+def _intervals(data):
+    heard = ~data['sent'] & data['valid'] & data['crc_ok']
+    links = _link(data['previous'][heard], data['node'][heard])
+    # Stable sort keeps the frames of each link in capture order
+    order = numpy.argsort(links, kind='stable')
+    links, ticks = links[order], data['ticks'][heard][order]
+
+    same = links[1:] == links[:-1]
+    gaps = ((ticks[1:] - ticks[:-1]) % _TICKS_PERIOD)[same]
+    links = links[1:][same]
+
+    # Gaps are grouped by link already
+    medians = {}
+    pairs, starts = numpy.unique(links, return_index=True)
+    for link, gap in zip(pairs.tolist(), numpy.split(gaps, starts[1:])):
+        medians[_link_name(link)] = float(numpy.median(gap))
+
+    return {
+        'bounds':   list(_INTERVAL_BOUNDS),
+        'counts':   _histogram(gaps, _INTERVAL_BOUNDS),
+        'median_ms': medians,
+    }
+
+def _fanout(data):
+    request = data['valid'] & data['crc_ok'] & (data['kind'] == _REQUEST)
+    keys = (data['source'][request] << 32) | (data['sequence'][request] << 16) | data['previous'][request]
+    floods, senders = numpy.unique(numpy.unique(keys) >> 16, return_counts=True)
+    return {
+        'floods':   len(floods),
+        'mean':     float(senders.mean()) if len(senders) else None,
+        'max':      int(senders.max()) if len(senders) else None,
+        'counts':   { str(fanout): int(count) for fanout, count in enumerate(numpy.bincount(senders).tolist()) if count },
+    }
+
+def _hops(data):
+    routed = data['valid'] & data['crc_ok'] & (data['kind'] != _BEACON) & (data['ttl'] > 0) & (data['ttl'] <= meshnet._TTL_DEFAULT)
+    hops = meshnet._TTL_DEFAULT - data['ttl'][routed] + 1
+    kinds = data['kind'][routed]
+    result = {}
+    for kind in numpy.unique(kinds).tolist():
+        counts = numpy.bincount(hops[kinds == kind])
+        result[_kind_name(kind)] = { str(hop): int(count) for hop, count in enumerate(counts.tolist()) if count }
+    return result
+
+# Seconds on air of frames of <length> at <datarate>s of <table>
+def _airtime(table, datarate, length, implicit):
+    rates = numpy.unique(datarate)
+    sf = numpy.zeros(len(length))
+    bw = numpy.ones(len(length))
+    for rate in rates.tolist():
+        if table.has_datarate(rate):
+            sf[datarate == rate] = table.spreading_factor(rate)
+            bw[datarate == rate] = table.bandwidth(rate)
+
+    symbol = 2 ** sf / bw
+    low_rate = symbol > 0.016
+    bits = 8 * length - 4 * sf + 28 + 16 - numpy.where(implicit, 20, 0)
+    step = 4 * (sf - numpy.where(low_rate, 2, 0))
+    symbols = 8 + numpy.maximum(numpy.ceil(bits / step) * _CODING_RATE, 0)
+    return numpy.where(sf > 0, (_PREAMBLE + 4.25 + symbols) * symbol, 0.0)
+
+def _airtimes(data, domain):
+    table = compile_domain(domain)
+    seen = data['valid'] & data['crc_ok']
+    seconds = _airtime(table, data['datarate'][seen], data['length'][seen], (data['flags'][seen] & CAPTURE_IMPLICIT) != 0)
+    sender = numpy.where(data['sent'][seen], data['node'][seen], data['previous'][seen])
+    capturer = data['node'][seen]
+
+    pairs, inverse = numpy.unique(_link(sender, capturer), return_inverse=True)
+    totals = numpy.bincount(inverse.reshape(-1), weights=seconds, minlength=len(pairs))
+
+    airtime = {}
+    for link, total in zip(pairs.tolist(), totals.tolist()):
+        node, capture = link >> 16, link & 0xFFFF
+        best = airtime.get(str(node))
+        if node == capture or best == None or (not best['own'] and total > best['seconds']):
+            airtime[str(node)] = { 'seconds': total, 'own': node == capture }
+    return airtime
+
+def analyze(captures, domain=meshdomains.US902_MESHNET, compressed=False):
+    data = frames(captures, compressed)
+    links, crc_errors = _links(data)
+    return {
+        'frames':       len(data['node']),
+        'sent':         int(numpy.count_nonzero(data['sent'])),
+        'malformed':    int(numpy.count_nonzero(~data['valid'])),
+        'links':        links,
+        'crc_errors':   crc_errors,
+        'intervals':    _intervals(data),
+        'fanout':       _fanout(data),
+        'hops':         _hops(data),
+        'airtime':      _airtimes(data, domain),
+    }
+
+def print_report(report):
+    print("%d frames, %d sent, %d malformed" % (report['frames'], report['sent'], report['malformed']))
+
+    print("Links:            received      sent    PDR")
+    for link in sorted(report['links']):
+        entry = report['links'][link]
+        print("    %-12s %9d %9s %6s" % (link, entry['received'], entry.get('sent', '-'),
+              "-" if entry.get('pdr') == None else "%.1f%%" % (entry['pdr'] * 100)))
+    if report['crc_errors']:
+        print("CRC errors: %s" % ", ".join("node %s %d" % (node, count) for node, count in sorted(report['crc_errors'].items())))
+
+    intervals = report['intervals']
+    print("Inter-arrival ms: %s" % " ".join("<=%d:%d" % (bound, count) for bound, count in zip(intervals['bounds'], intervals['counts'])),
+          ">%d:%d" % (intervals['bounds'][-1], intervals['counts'][-1]))
+
+    fanout = report['fanout']
+    print("Route request floods: %d, senders per flood mean %s max %s" % (fanout['floods'],
+          "-" if fanout['mean'] == None else "%.1f" % fanout['mean'], "-" if fanout['max'] == None else fanout['max']))
+
+    print("Hops:")
+    for kind in sorted(report['hops']):
+        print("    %-10s %s" % (kind, " ".join("%s:%d" % (hops, count) for hops, count in report['hops'][kind].items())))
+
+    print("Airtime:")
+    for node in sorted(report['airtime'], key=int):
+        entry = report['airtime'][node]
+        print("    %-6s %9.1f s%s" % (node, entry['seconds'], "" if entry['own'] else " (heard)"))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze MeshNet frame captures")
+    parser.add_argument('captures', nargs='+', help="capture files, binary or console '@' lines")
+    parser.add_argument('--domain', default='US902_MESHNET')
+    parser.add_argument('--compress-header', action='store_true', help="the mesh ran with compressed headers")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        captures = [ read(filename) for filename in args.captures ]
+        for data in captures:
+            decode_header(data)
+    except CaptureError as error:
+        sys.exit(str(error))
+
+    report = analyze(captures, getattr(meshdomains, args.domain), args.compress_header)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
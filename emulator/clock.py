@@ -0,0 +1,235 @@
+#
+# Time sources for the emulator.
+#
+# The emulated chip never sleeps itself; it asks a clock to call it back when
+# something on the air or in the modem finishes.  RealClock follows the wall
+# clock; VirtualClock runs the whole stack on simulated time.
+#
+import collections
+import heapq
+import threading
+import time as _time
+import traceback
+
+# Wall clock time.  Callbacks run on their own threads like hardware interrupts would.
+class RealClock:
+    def __init__(self):
+        self._start = _time.monotonic()
+
+    # Seconds since the clock was created
+    def now(self):
+        return _time.monotonic() - self._start
+
+    def sleep(self, seconds):
+        _time.sleep(max(seconds, 0))
+
+    # Call <func>(*<args>) after <delay> seconds.  Returns a handle with cancel().
+    def call_later(self, delay, func, *args):
+        handle = threading.Timer(max(delay, 0), func, args)
+        handle.daemon = True
+        handle.start()
+        return handle
+
+class SimulationError(Exception):
+    pass
+
+# A task is a thread of the stack run under a VirtualClock.  Its OS thread only runs while
+# holding the baton: <_wake> is released to hand the baton over and acquired to wait for it.
+class _Task:
+    def __init__(self):
+        self.ident = None
+        self.job = None
+        self.token = None       # Identifies the timed wakeup still valid for this task
+        self.granted = False    # A lock waited for was handed over
+        self.error = None
+        self._wake = threading.Lock()
+        self._wake.acquire()
+
+# A lock of the VirtualClock.  Waiting yields to other tasks; release hands the lock straight
+# to the longest waiter.  Like _thread locks any task may release it.
+class _VirtualLock:
+    def __init__(self, clock):
+        self._clock = clock
+        self._locked = False
+        self._waiters = collections.deque()
+
+    def acquire(self, waitflag=1, timeout=-1):
+        if not self._locked:
+            self._locked = True
+            return True
+        if not waitflag or timeout == 0:
+            return False
+        return self._clock._wait_lock(self, timeout)
+
+    def release(self):
+        if not self._locked:
+            raise RuntimeError("release unlocked lock")
+        if self._waiters:
+            task = self._waiters.popleft()
+            task.granted = True
+            task.token = None
+            self._clock._ready.append(task)
+        else:
+            self._locked = False
+
+    def locked(self):
+        return self._locked
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+# Simulated time.  Threads of the stack become tasks that run one at a time and only give way
+# when they sleep, wait for a lock or finish, so nothing is preempted.  When every task is waiting
+# the clock jumps to the next timed event.  call_later() callbacks run on tasks of their own, as
+# interrupts would, so they may block too.
+#
+# The thread that creates the clock is its first task; its sleep() lets the rest run:
+#
+#    clock = VirtualClock()
+#    ... create and start nodes ...
+#    clock.sleep(600)          # Ten simulated minutes
+#
+class VirtualClock:
+    def __init__(self):
+        self._now = 0.0
+        self._events = []                     # Heap of (when, sequence, handle)
+        self._sequence = 0
+        self._ready = collections.deque()
+        self._idle = []                       # Tasks with no job, waiting for one
+        self._idents = 0
+        self.tasks = 0
+        self.switches = 0
+
+        self._root = _Task()
+        self._root.ident = self._ident()
+        self._current = self._root
+
+    def now(self):
+        return self._now
+
+    def _ident(self):
+        self._idents += 1
+        return self._idents
+
+    def _schedule(self, when, handle):
+        self._sequence += 1
+        heapq.heappush(self._events, (when, self._sequence, handle))
+        return handle
+
+    def call_later(self, delay, func, *args):
+        return self._schedule(self._now + max(delay, 0), _Handle(func, args))
+
+    def sleep(self, seconds):
+        task = self._current
+        if seconds <= 0:
+            # Let everything else that is ready run first
+            self._ready.append(task)
+        else:
+            task.token = self._schedule(self._now + seconds, _Wakeup(task))
+        self._block()
+
+    # Called by a lock with the current task wanting it
+    def _wait_lock(self, lock, timeout):
+        task = self._current
+        task.granted = False
+        lock._waiters.append(task)
+        task.token = self._schedule(self._now + timeout, _Wakeup(task)) if timeout > 0 else None
+        self._block()
+        if not task.granted:
+            lock._waiters.remove(task)
+        return task.granted
+
+    # Give the baton to the next task and wait for it to come back
+    def _block(self):
+        task = self._current
+        following = self._next()
+        self._current = following
+        if following is not task:
+            self.switches += 1
+            following._wake.release()
+            task._wake.acquire()
+
+        if task.error != None:
+            error, task.error = task.error, None
+            raise error
+
+    def _next(self):
+        while True:
+            if self._ready:
+                return self._ready.popleft()
+
+            if not self._events:
+                # Nothing will ever run again; fail the creator of the clock
+                self._root.error = SimulationError("every task is waiting at %.3f" % self._now)
+                return self._root
+
+            when, sequence, handle = heapq.heappop(self._events)
+            if handle.cancelled:
+                continue
+            self._now = max(self._now, when)
+
+            if type(handle) == _Wakeup:
+                if handle.task.token is handle:
+                    handle.task.token = None
+                    return handle.task
+            else:
+                return self._worker(handle.func, handle.args, {})
+
+    # A task to run <func>, reusing one that is idle if possible
+    def _worker(self, func, args, kwargs):
+        if self._idle:
+            task = self._idle.pop()
+        else:
+            task = _Task()
+            worker = threading.Thread(target=self._serve, args=(task,), daemon=True)
+            worker.start()
+            self.tasks += 1
+        task.ident = self._ident()
+        task.job = (func, args, kwargs)
+        return task
+
+    def _serve(self, task):
+        task._wake.acquire()
+        while True:
+            func, args, kwargs = task.job
+            task.job = None
+            try:
+                func(*args, **kwargs)
+            except SystemExit:
+                pass
+            except BaseException:
+                traceback.print_exc()
+            task.ident = None
+            self._idle.append(task)
+            self._block()
+
+    #
+    # The _thread module on this clock (see thread_shim.py)
+    #
+    def start_new_thread(self, func, args, kwargs={}):
+        task = self._worker(func, args, kwargs)
+        self._ready.append(task)
+        return task.ident
+
+    def allocate_lock(self):
+        return _VirtualLock(self)
+
+    def get_ident(self):
+        return self._current.ident
+
+class _Handle:
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class _Wakeup:
+    def __init__(self, task):
+        self.task = task
+        self.cancelled = False
@@ -0,0 +1,72 @@
+#
+# The simplest medium: every radio hears every other at the same level.
+#
+# Frames overlapping in time on the same tuning destroy each other; there is no
+# capture and no path loss.  Enough to run a few nodes against each other.
+#
+import threading
+
+from emulator.clock import RealClock
+
+class Ether:
+    def __init__(self, clock=None, rssi=-60.0, snr=9.0, noise=-120.0):
+        self.clock = clock if clock != None else RealClock()
+        self._rssi = rssi
+        self._snr = snr
+        self._noise = noise
+        self._radios = []
+        self._air = []
+        self._collided = set()
+        self._lock = threading.Lock()
+        self.transmissions = 0
+        self.collisions = 0
+
+    def attach(self, radio):
+        with self._lock:
+            self._radios.append(radio)
+
+    # Frames on the air that <radio> tuned to <tuning> could hear
+    def active(self, radio, tuning):
+        with self._lock:
+            return [ transmission for transmission in self._air if transmission.tuning == tuning and transmission.radio is not radio ]
+
+    # Power a radio measures on <tuning> right now
+    def rssi(self, radio, tuning):
+        with self._lock:
+            for transmission in self._air:
+                if transmission.tuning[0] == tuning[0] and transmission.radio is not radio:
+                    return self._rssi
+        return self._noise
+
+    # <transmission> has started
+    def transmit(self, transmission):
+        with self._lock:
+            for other in self._air:
+                if other.tuning[0] == transmission.tuning[0]:
+                    self._collided.add(other)
+                    self._collided.add(transmission)
+                    self.collisions += 1
+            self._air.append(transmission)
+            self.transmissions += 1
+            radios = [ radio for radio in self._radios if radio is not transmission.radio ]
+
+        for radio in radios:
+            radio.receiving(transmission)
+
+        self.clock.call_later(transmission.end - self.clock.now(), self._finish, transmission)
+
+    # The sender left transmit mode before <transmission> was done
+    def abort(self, transmission):
+        self._finish(transmission)
+
+    def _finish(self, transmission):
+        with self._lock:
+            if transmission not in self._air:
+                return
+            self._air.remove(transmission)
+            ok = transmission not in self._collided and not transmission.aborted
+            self._collided.discard(transmission)
+            radios = [ radio for radio in self._radios if radio is not transmission.radio ]
+
+        for radio in radios:
+            radio.received(transmission, ok, self._rssi, self._snr)
@@ -0,0 +1,28 @@
+#
+# Stand-in for the MicroPython gc module on CPython.
+#
+# The stack collects often to keep a small heap from fragmenting.  A full CPython
+# collection of a large simulation is far slower than that, so collect() only does
+# the youngest generation.  Anything else is CPython's own gc.
+#
+import gc as _cpython_gc
+import tracemalloc as _tracemalloc
+
+for _name in dir(_cpython_gc):
+    if not _name.startswith('__'):
+        globals()[_name] = getattr(_cpython_gc, _name)
+
+def collect():
+    return _cpython_gc.collect(0)
+
+# Heap figures MicroPython has and CPython does not.  While tracemalloc is tracing,
+# mem_alloc() is what it has traced, so allocation profiles mean something here.
+def mem_alloc():
+    return _tracemalloc.get_traced_memory()[0] if _tracemalloc.is_tracing() else 0
+
+def mem_free():
+    return -1
+
+# CPython decides for itself when to collect
+def threshold(amount=None):
+    return -1
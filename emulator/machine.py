@@ -0,0 +1,127 @@
+#
+# Stand-in for the MicroPython machine module (Pin and SPI only).
+#
+# Pins are global by number.  Emulated devices wire themselves to pins to hear
+# output changes (chip select, reset) and drive inputs (DIO lines) through drive().
+# SPI transfers go to the device whose select pin the calling thread pulled low,
+# so each thread behaves as if it had the bus to itself.
+#
+import threading
+
+_pins = {}
+_pins_lock = threading.Lock()
+_bus = threading.local()
+
+class _PinState:
+    def __init__(self, id):
+        self.id = id
+        self.level = 0
+        self.handler = None
+        self.trigger = 0
+        self.device = None
+
+def _state(id):
+    with _pins_lock:
+        if id not in _pins:
+            _pins[id] = _PinState(id)
+        return _pins[id]
+
+class Pin:
+    IN          = 1
+    OUT         = 3
+    OPEN_DRAIN  = 7
+    PULL_UP     = 1
+    PULL_DOWN   = 2
+    IRQ_FALLING = 1
+    IRQ_RISING  = 2
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self._state = _state(id)
+        if value != None:
+            self.value(value)
+
+    def __repr__(self):
+        return "Pin(%s)" % self._state.id
+
+    def id(self):
+        return self._state.id
+
+    def value(self, level=None):
+        state = self._state
+        if level == None:
+            return state.level
+
+        level = 1 if level else 0
+        if level != state.level:
+            state.level = level
+            if state.device:
+                state.device.pin_changed(state.id, level)
+
+    def __call__(self, level=None):
+        return self.value(level)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    # Hard and soft handlers are the same here
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._state.handler = handler
+        self._state.trigger = trigger if handler else 0
+
+# Have <device>.pin_changed(id, level) called when pin <id> is written
+def wire(id, device):
+    _state(id).device = device
+
+# Drive input pin <id> to <level> from an emulated device, calling its irq handler on a matching edge
+def drive(id, level):
+    state = _state(id)
+    level = 1 if level else 0
+    old = state.level
+    state.level = level
+    handler = state.handler
+    if handler and level != old and state.trigger & (Pin.IRQ_RISING if level else Pin.IRQ_FALLING):
+        handler(Pin(id))
+
+# Device selected by the calling thread (called by devices as their select pin changes)
+def select(device):
+    _bus.device = device
+
+def deselect(device):
+    if getattr(_bus, 'device', None) is device:
+        _bus.device = None
+
+class SPI:
+    MSB = 0
+    LSB = 1
+
+    def __init__(self, id=1, **kwargs):
+        pass
+
+    def init(self, **kwargs):
+        pass
+
+    def deinit(self):
+        pass
+
+    # One byte each way; a floating bus reads as 0xFF
+    def _transfer(self, value):
+        device = getattr(_bus, 'device', None)
+        return device.transfer(value) if device else 0xFF
+
+    def write(self, buffer):
+        for value in buffer:
+            self._transfer(value)
+
+    def read(self, length, write=0x00):
+        return bytes(self._transfer(write) for i in range(length))
+
+    def readinto(self, buffer, write=0x00):
+        for i in range(len(buffer)):
+            buffer[i] = self._transfer(write)
+
+    def write_readinto(self, out, buffer):
+        for i in range(len(out)):
+            buffer[i] = self._transfer(out[i])
@@ -0,0 +1,214 @@
+#
+# A medium with geography, for many nodes.
+#
+# Radios are placed on a plane; what one hears of another follows a log-distance
+# path loss model with optional log-normal shadowing fixed per link.  A receiver
+# synchronizes to a frame only if its SNR is above the demodulation limit for the
+# spreading factor.  Frames overlapping it on the same carrier interfere: it
+# survives (capture) if it is _CAPTURE_THRESHOLD dB above their sum, with frames of
+# another spreading factor counting _SF_REJECTION dB less.  Different carriers do
+# not interfere at all.
+#
+import math
+import random
+import threading
+
+from emulator.clock import RealClock
+from emulator.sx127x_emulator import BANDWIDTHS
+
+# Lowest SNR each spreading factor demodulates at (SX1276 datasheet)
+_SNR_LIMIT = { 6: -5.0, 7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0 }
+
+_CAPTURE_THRESHOLD      = 6.0      # dB above the interference a frame needs to survive
+_SF_REJECTION           = 16.0     # dB by which another spreading factor interferes less
+_THERMAL_NOISE          = -174.0   # dBm/Hz
+
+def _mw(dbm):
+    return 10 ** (dbm / 10.0)
+
+def _dbm(mw):
+    return 10 * math.log10(mw)
+
+class Medium:
+    # <exponent> is the path loss exponent, 2 in free space and around 2.7 to 3.5 among buildings.
+    # <shadowing> is the standard deviation in dB of the per link variation.
+    def __init__(self, clock=None, exponent=2.7, shadowing=0.0, noise_figure=6.0, seed=None):
+        self.clock = clock if clock != None else RealClock()
+        self._exponent = exponent
+        self._shadowing = shadowing
+        self._noise_figure = noise_figure
+        self._random = random.Random(seed)
+        self._radios = []
+        self._positions = {}
+        self._links = {}           # Distance and shadowing part of the loss between two radios
+        self._levels = {}          # (radio, power, frequency): { radio: dBm heard }
+        self._air = []             # Frames being sent
+        self._past = []            # Finished frames that may still overlap one on the air
+        self._lock = threading.Lock()
+
+        self.monitors = []         # Called with every transmission as it starts
+        self.transmissions = 0
+        self.collisions = 0        # Frames lost to interference at a receiver
+        self.captures = 0          # Frames received in spite of interference
+        self.airtime = {}          # Seconds of frames sent by carrier frequency in Hz
+        self.busy = {}             # Seconds with anything on the air by carrier frequency
+        self._sending = {}         # Frequency: (frames on the air, busy since)
+
+    def attach(self, radio):
+        with self._lock:
+            self._radios.append(radio)
+            self._positions[radio] = (0.0, 0.0)
+            self._levels = {}
+
+    # Put <radio> at <x>, <y> meters
+    def place(self, radio, x, y):
+        with self._lock:
+            self._positions[radio] = (float(x), float(y))
+            self._links = {}
+            self._levels = {}
+
+    def position(self, radio):
+        return self._positions[radio]
+
+    # Free space loss at one meter
+    def _reference_loss(self, frequency):
+        return 20 * math.log10(frequency) - 147.55
+
+    def _noise(self, bandwidth):
+        return _THERMAL_NOISE + 10 * math.log10(bandwidth) + self._noise_figure
+
+    # Path loss in dB between radios <a> and <b>
+    def loss(self, a, b, frequency):
+        key = (id(a), id(b)) if id(a) < id(b) else (id(b), id(a))
+        if key not in self._links:
+            (ax, ay), (bx, by) = self._positions[a], self._positions[b]
+            distance = max(math.hypot(ax - bx, ay - by), 1.0)
+            self._links[key] = 10 * self._exponent * math.log10(distance) + (self._random.gauss(0, self._shadowing) if self._shadowing else 0.0)
+        return self._reference_loss(frequency) + self._links[key]
+
+    # Level at every other radio of what <radio> sends at <power> dBm on <frequency>
+    def levels(self, radio, power, frequency):
+        key = (radio, power, frequency)
+        if key not in self._levels:
+            self._levels[key] = { other: power - self.loss(radio, other, frequency) for other in self._radios if other is not radio }
+        return self._levels[key]
+
+    # Level of <transmission> at <radio> in dBm
+    def level(self, transmission, radio):
+        return self.levels(transmission.radio, transmission.power, transmission.frequency())[radio]
+
+    # Distance in meters at which a <power> dBm frame is just demodulated
+    def range(self, power, sf, bandwidth, frequency):
+        loss = power - self._noise(bandwidth) - _SNR_LIMIT[sf]
+        return 10 ** ((loss - self._reference_loss(frequency)) / (10 * self._exponent))
+
+    # Weakest level a frame sent with <tuning> is demodulated at
+    def _threshold(self, tuning):
+        return self._noise(BANDWIDTHS[tuning[2]]) + _SNR_LIMIT[tuning[1]]
+
+    def _audible(self, transmission, radio):
+        return self.level(transmission, radio) >= self._threshold(transmission.tuning)
+
+    # Seconds <frequency> has had anything on the air, up to now
+    def busy_time(self, frequency):
+        with self._lock:
+            busy = self.busy.get(frequency, 0.0)
+            if frequency in self._sending:
+                busy += self.clock.now() - self._sending[frequency][1]
+        return busy
+
+    # Frames on the air that <radio> tuned to <tuning> could synchronize to
+    def active(self, radio, tuning):
+        with self._lock:
+            return [ transmission for transmission in self._air
+                     if transmission.tuning == tuning and transmission.radio is not radio and self._audible(transmission, radio) ]
+
+    # Power <radio> measures on <tuning> right now
+    def rssi(self, radio, tuning):
+        with self._lock:
+            power = _mw(self._noise(BANDWIDTHS[tuning[2]]))
+            for transmission in self._air:
+                if transmission.tuning[0] == tuning[0] and transmission.radio is not radio:
+                    power += _mw(self.level(transmission, radio))
+        return _dbm(power)
+
+    # <transmission> has started
+    def transmit(self, transmission):
+        with self._lock:
+            self._air.append(transmission)
+            self.transmissions += 1
+            frequency = transmission.frequency()
+            self.airtime[frequency] = self.airtime.get(frequency, 0.0) + transmission.end - transmission.start
+            count, since = self._sending.get(frequency, (0, transmission.start))
+            self._sending[frequency] = (count + 1, since)
+
+            threshold = self._threshold(transmission.tuning)
+            levels = self.levels(transmission.radio, transmission.power, frequency)
+            radios = [ radio for radio in levels if levels[radio] >= threshold ]
+
+        for monitor in self.monitors:
+            monitor(transmission)
+
+        for radio in radios:
+            radio.receiving(transmission)
+
+        self.clock.call_later(transmission.end - self.clock.now(), self._finish, transmission)
+
+    # The sender left transmit mode before <transmission> was done
+    def abort(self, transmission):
+        self._finish(transmission)
+
+    # Signal and interference in dBm of <transmission> at <radio>; interference is None if nothing overlapped
+    def _reception(self, transmission, radio):
+        signal = self.level(transmission, radio)
+        interference = 0.0
+        for other in self._air + self._past:
+            if (other is not transmission and other.radio is not radio and other.tuning[0] == transmission.tuning[0] and
+                    other.start < transmission.end and other.end > transmission.start):
+                level = self.level(other, radio)
+                if other.tuning[1] != transmission.tuning[1]:
+                    level -= _SF_REJECTION
+                interference += _mw(level)
+        return signal, _dbm(interference) if interference else None
+
+    def _finish(self, transmission):
+        with self._lock:
+            if transmission not in self._air:
+                return
+
+            noise = self._noise(BANDWIDTHS[transmission.tuning[2]])
+            results = []
+            for radio in self._radios:
+                if radio.synchronized() is transmission:
+                    signal, interference = self._reception(transmission, radio)
+                    ok = not transmission.aborted
+                    if interference == None:
+                        snr = signal - noise
+                    else:
+                        snr = signal - _dbm(_mw(noise) + _mw(interference))
+                        if signal - interference >= _CAPTURE_THRESHOLD:
+                            self.captures += 1
+                        else:
+                            self.collisions += 1
+                            ok = False
+                    results.append((radio, ok, signal, snr))
+
+            frequency = transmission.frequency()
+            count, since = self._sending[frequency]
+            if count == 1:
+                del self._sending[frequency]
+                self.busy[frequency] = self.busy.get(frequency, 0.0) + self.clock.now() - since
+            else:
+                self._sending[frequency] = (count - 1, since)
+
+            # Keep what may still overlap frames on the air
+            self._air.remove(transmission)
+            if self._air:
+                self._past.append(transmission)
+                earliest = min(other.start for other in self._air)
+                self._past = [ other for other in self._past if other.end > earliest ]
+            else:
+                self._past = []
+
+        for radio, ok, rssi, snr in results:
+            radio.received(transmission, ok, rssi, snr)
@@ -0,0 +1,14 @@
+#
+# Stand-in for MicroPython's 'micropython' module.
+#
+# Interrupt handlers here already run as ordinary code, so a scheduled callback
+# runs at once.
+#
+def const(value):
+    return value
+
+def schedule(function, argument):
+    function(argument)
+
+def alloc_emergency_exception_buf(size):
+    pass
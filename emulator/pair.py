@@ -0,0 +1,56 @@
+#
+# Two MeshNet nodes on emulated radios, one sending to the other.
+#
+#    python -m emulator.pair [count] [payload bytes]
+#
+# Prints how many packets arrived and how long they took.
+#
+import sys
+
+from emulator import shims
+shims.install()
+
+import time
+
+from emulator.ether import Ether
+from emulator.sx127x_emulator import SX127xEmulator
+
+from meshdomains import US902_MESHNET
+from meshnet import MeshNet, DataPacket
+
+# Pins for the second node; the first uses MeshNet's defaults
+# Protocol number for the test data, as meshnet_main's ping uses
+_PROTOCOL = 99
+
+_PINS_2 = { 'ss': 118, 'reset': 114, 'dio': (126, 135, 134) }
+
+def main(count=10, size=16):
+    ether = Ether()
+    SX127xEmulator(medium=ether, name="node1")
+    SX127xEmulator(ss=_PINS_2['ss'], reset=_PINS_2['reset'], dio=_PINS_2['dio'], medium=ether, name="node2")
+
+    node1 = MeshNet(US902_MESHNET, 1, channel=(64, 8))
+    node2 = MeshNet(US902_MESHNET, 2, channel=(64, 8), **_PINS_2)
+    node1.start()
+    node2.start()
+
+    # Learn the route first
+    node1.send_packet(DataPacket(target=2, protocol=_PROTOCOL, payload=bytearray(size)))
+    node2.receive_packet()
+
+    latencies = []
+    for sequence in range(count):
+        started = time.monotonic()
+        node1.send_packet(DataPacket(target=2, protocol=_PROTOCOL, payload=bytearray(sequence.to_bytes(2, 'big')) + bytearray(size - 2)))
+        node2.receive_packet()
+        latencies.append(time.monotonic() - started)
+
+    print("%d packets of %d bytes delivered; latency min %.1f ms avg %.1f ms max %.1f ms; %d frames on air, %d collisions" % (
+            len(latencies), size, 1000 * min(latencies), 1000 * sum(latencies) / len(latencies), 1000 * max(latencies),
+            ether.transmissions, ether.collisions))
+
+    node1.stop()
+    node2.stop()
+
+if __name__ == "__main__":
+    main(*[ int(arg) for arg in sys.argv[1:3] ])
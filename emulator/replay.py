@@ -0,0 +1,280 @@
+#
+# Play a frame capture (see meshcapture.py) back into a MeshNet on the emulated radio.
+#
+#    python -m emulator.replay capture.bin --speed 10
+#
+# The node gets the captured node's address and channel.  Each received frame in the
+# capture is handed to its onReceive at the time it arrived, divided by <speed>, on
+# simulated time, so a replay gives the same result every run.  The frames the node
+# sends in reply are captured in turn and compared with those in the original, and
+# the node's metrics (route table, queues, latency) are reported at the end.
+#
+# Frames go straight to onReceive rather than over the air: the replaying node would
+# not always be tuned to the channel the frame was heard on.  Frames from any radio
+# of the captured node arrive on the replaying node's own radio.
+#
+# A capture taken over the console ('@' lines) is read as well as a binary file.
+#
+import argparse
+import contextlib
+import io
+import json
+import os
+import struct
+import sys
+import tracemalloc
+
+from emulator import shims
+shims.install()
+
+import time
+
+from emulator.clock import VirtualClock
+from emulator.ether import Ether
+from emulator.sx127x_emulator import SX127xEmulator
+from emulator.simulate import _FRAME_KINDS
+
+import meshdomains
+from meshcapture import *
+from meshnet import MeshNet, Packet, expand_header
+
+_LEAD       = 1.0       # Seconds the node runs before the first frame
+_DRAIN      = 5.0       # Seconds allowed after the last frame for the replies
+
+class CaptureError(Exception):
+    pass
+
+class Record:
+    def __init__(self, ticks, flags, interface, rssi, snr, frame):
+        self.ticks = ticks
+        self.flags = flags
+        self.interface = interface
+        self.rssi = rssi if rssi != CAPTURE_UNKNOWN else None
+        self.snr = snr / 4 if snr != CAPTURE_UNKNOWN else None
+        self.frame = frame
+
+    def transmitted(self):
+        return bool(self.flags & CAPTURE_TX)
+
+    def crc_ok(self):
+        return not self.flags & CAPTURE_CRC_ERROR
+
+    def implicit(self):
+        return bool(self.flags & CAPTURE_IMPLICIT)
+
+    def __repr__(self):
+        return "%s %d I%d %s" % ("tx" if self.transmitted() else "rx", self.ticks, self.interface, self.frame.hex())
+
+# Header of capture <data> as a dict
+def decode_header(data):
+    if len(data) < CAPTURE_HEADER_LEN:
+        raise CaptureError("capture too short")
+    magic, version, address, channel, datarate = struct.unpack_from(CAPTURE_HEADER_FORMAT, data, 0)
+    if magic != CAPTURE_MAGIC:
+        raise CaptureError("not a capture")
+    if version != CAPTURE_VERSION:
+        raise CaptureError("capture version %d not supported" % version)
+
+    return { 'version': version, 'address': address, 'channel': (channel, datarate) }
+
+# Header of capture <data> as a dict, and its records
+def decode(data):
+    header = decode_header(data)
+    records = []
+    offset = CAPTURE_HEADER_LEN
+    while offset + CAPTURE_RECORD_LEN <= len(data):
+        ticks, flags, interface, rssi, snr, length = struct.unpack_from(CAPTURE_RECORD_FORMAT, data, offset)
+        offset += CAPTURE_RECORD_LEN
+        if offset + length > len(data):
+            break
+        records.append(Record(ticks, flags, interface, rssi, snr, bytes(data[offset:offset + length])))
+        offset += length
+
+    return header, records
+
+# Contents of capture <filename> in the binary form
+def read(filename):
+    with open(filename, 'rb') as file:
+        data = file.read()
+
+    if not data.startswith(CAPTURE_MAGIC):
+        # Console capture: the hex of the '@' lines among whatever else was printed
+        data = b''.join(bytes.fromhex(line[1:].strip().decode()) for line in data.splitlines() if line.startswith(b'@'))
+
+    return data
+
+# Header and records of the capture in <filename>
+def load(filename):
+    return decode(read(filename))
+
+def _ticks_diff(end, start):
+    return ((end - start + (1 << 29)) % (1 << 30)) - (1 << 29)
+
+def _kind(frame, compressed):
+    try:
+        data = expand_header(bytearray(frame)) if compressed else frame
+        protocol = Packet(load=data).protocol() & 0x7F
+        return _FRAME_KINDS[protocol] if protocol in _FRAME_KINDS else 'data'
+    except (TypeError, IndexError):
+        return 'other'
+
+# Frame count by kind of the sent frames in <records>
+def _sent(records, compressed):
+    kinds = {}
+    for record in records:
+        if record.transmitted():
+            kind = _kind(record.frame, compressed)
+            kinds[kind] = kinds.get(kind, 0) + 1
+    return kinds
+
+# One replay of <records> into a fresh node.  <kwargs> go to the MeshNet, which is made
+# with the captured node's address and channel unless they are given.
+class Replay:
+    def __init__(self, header, records, domain=meshdomains.US902_MESHNET, speed=1.0, **kwargs):
+        self.clock = VirtualClock()
+        shims.install(self.clock)
+
+        self._header = header
+        self._records = records
+        self._speed = speed
+        self._compressed = kwargs['compress_header'] if 'compress_header' in kwargs else False
+
+        self.ether = Ether(self.clock)
+        self.radio = SX127xEmulator(medium=self.ether, name="replay")
+        options = { 'channel': header['channel'] }
+        options.update(kwargs)
+        address = options.pop('address', header['address'])
+        self.node = MeshNet(domain, address, **options)
+
+        self._output = io.BytesIO()
+        self._fed = 0
+        self._started = time.monotonic()
+        self.simulated = 0.0
+        self.wall = 0.0
+
+    def _receive(self):
+        while True:
+            self.node.receive_packet()
+
+    # Hand the received frames to the node at their times
+    def _feed(self, lead):
+        received = [ record for record in self._records if not record.transmitted() ]
+        if not received:
+            return
+
+        start = self.clock.now() + lead
+        for record in received:
+            when = start + _ticks_diff(record.ticks, received[0].ticks) / 1000.0 / self._speed
+            if when > self.clock.now():
+                self.clock.sleep(when - self.clock.now())
+
+            # The node reads the header mode of the radio the frame came in on
+            implicit = self.node._current_implicit_header
+            self.node._current_implicit_header = record.implicit()
+            self.node.onReceive(bytearray(record.frame), record.crc_ok(), record.rssi, record.snr)
+            self.node._current_implicit_header = implicit
+            self._fed += 1
+
+    def run(self, lead=_LEAD, drain=_DRAIN):
+        self._started = time.monotonic()
+        self.node.start()
+        capture = self.node.set_capture(self._output)
+        self.clock.start_new_thread(self._receive, ())
+
+        self._feed(lead)
+        self.clock.sleep(drain)
+
+        capture.flush()
+        report = self.report()
+        self.node.set_capture(None)
+        self.node.stop()
+        return report
+
+    # Records the node sent during the replay
+    def output(self):
+        return decode(self._output.getvalue())[1]
+
+    def report(self):
+        self.simulated = self.clock.now()
+        self.wall = time.monotonic() - self._started
+
+        return {
+            'address':      self.node.address,
+            'records':      len(self._records),
+            'fed':          self._fed,
+            'simulated':    self.simulated,
+            'wall':         self.wall,
+            'speedup':      self.simulated / self.wall if self.wall else None,
+            'sent': {
+                'recorded': _sent(self._records, self._compressed),
+                'replayed': _sent(self.output(), self._compressed),
+            },
+            'metrics':      self.node.metrics().snapshot(),
+        }
+
+def print_report(report):
+    print("Node %d: %d of %d records fed in %.1f s simulated, %.1f s wall (%.1fx real time)" % (report['address'],
+          report['fed'], report['records'], report['simulated'], report['wall'], report['speedup'] or 0))
+
+    print("Frames sent:      recorded  replayed")
+    recorded, replayed = report['sent']['recorded'], report['sent']['replayed']
+    for kind in sorted(set(recorded) | set(replayed)):
+        print("    %-10s %9d %9d" % (kind, recorded.get(kind, 0), replayed.get(kind, 0)))
+
+    print("Metrics:")
+    for name in sorted(report['metrics']):
+        print("    %s %s" % (name, report['metrics'][name]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a MeshNet frame capture into an emulated node")
+    parser.add_argument('capture', help="capture file, binary or console '@' lines")
+    parser.add_argument('--speed', type=float, default=1.0, help="times faster than captured (default 1)")
+    parser.add_argument('--domain', default='US902_MESHNET')
+    parser.add_argument('--address', type=int, help="node address (default the captured node's)")
+    parser.add_argument('--channel', type=int, help="channel (default the captured one)")
+    parser.add_argument('--datarate', type=int, help="datarate (default the captured one)")
+    parser.add_argument('--lead', type=float, default=_LEAD, help="seconds the node runs before the first frame")
+    parser.add_argument('--drain', type=float, default=_DRAIN, help="seconds allowed after the last frame")
+    parser.add_argument('--gateway', action='store_true')
+    parser.add_argument('--link-ack', action='store_true')
+    parser.add_argument('--multichannel', action='store_true')
+    parser.add_argument('--compress-header', action='store_true')
+    parser.add_argument('--trace', type=int, default=0, help="also dump a packet trace of this many records")
+    parser.add_argument('--alloc-profile', action='store_true', help="also rank packet paths by bytes allocated (CPython's)")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--verbose', action='store_true', help="show the stack's own output")
+    args = parser.parse_args(argv)
+
+    header, records = load(args.capture)
+    if args.channel != None or args.datarate != None:
+        header['channel'] = (args.channel if args.channel != None else header['channel'][0],
+                             args.datarate if args.datarate != None else header['channel'][1])
+
+    options = {}
+    if args.address != None:
+        options['address'] = args.address
+    for option in ('gateway', 'link_ack', 'multichannel', 'compress_header'):
+        if getattr(args, option):
+            options[option] = True
+    if args.trace:
+        options['trace'] = args.trace
+    if args.alloc_profile:
+        options['alloc_profile'] = True
+        tracemalloc.start()
+
+    replay = Replay(header, records, domain=getattr(meshdomains, args.domain), speed=args.speed, **options)
+
+    with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(sys.stdout if args.verbose else quiet):
+        report = replay.run(args.lead, args.drain)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+        if args.trace:
+            replay.node.trace().dump()
+        if args.alloc_profile:
+            replay.node.alloc_profile().dump()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#
+# Make CPython look enough like MicroPython on an ESP32 for the MeshNet stack.
+#
+# install() must run before any of the stack's modules are imported:
+#    - 'machine', '_thread', 'time', 'gc' and 'micropython' resolve to the stand-ins in this package
+#    - 'utime', 'ure' and 'ujson' resolve to their CPython counterparts
+#    - 'uasyncio' resolves to CPython's asyncio with a ThreadSafeFlag added
+#    - const() is a builtin
+#    - the repository root is on sys.path
+#
+# With a VirtualClock the stack's threads, locks and sleeps all run on simulated time.
+#
+import builtins
+import json
+import os
+import re
+import sys
+
+from emulator import machine
+from emulator import thread_shim
+from emulator import time_shim
+from emulator import gc_shim
+from emulator import micropython_shim
+from emulator import uasyncio_shim
+from emulator.clock import VirtualClock
+
+_installed = False
+
+def install(clock=None):
+    global _installed
+    if not _installed:
+        _installed = True
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if root not in sys.path:
+            sys.path.insert(0, root)
+
+        sys.modules['machine'] = machine
+        sys.modules['_thread'] = thread_shim
+        sys.modules['time'] = time_shim
+        sys.modules['gc'] = gc_shim
+        sys.modules['micropython'] = micropython_shim
+        sys.modules['utime'] = time_shim
+        sys.modules['ure'] = re
+        sys.modules['ujson'] = json
+        sys.modules['uasyncio'] = uasyncio_shim
+
+        if not hasattr(builtins, 'const'):
+            builtins.const = lambda value: value
+
+    if clock != None:
+        time_shim.use(clock)
+        if type(clock) == VirtualClock:
+            thread_shim.use(clock)
+
+    return time_shim.clock()
@@ -0,0 +1,324 @@
+#
+# Many MeshNet nodes in one process on simulated time.
+#
+#    python -m emulator.simulate --topology grid:10x20 --duration 600 --interval 60
+#
+# Nodes are placed by a topology (see topology.py) on a Medium and started at random
+# in the first <stagger> seconds.  Then packets go from random nodes to random others,
+# one every <interval> seconds per node on average, for <duration> seconds; those still
+# in flight have <drain> seconds more to arrive.  The report gives the packet delivery
+# ratio, latency distribution, control overhead and airtime use.
+#
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import sys
+import time
+
+from emulator import shims
+shims.install()
+
+from emulator.clock import VirtualClock
+from emulator.medium import Medium
+from emulator.sx127x_emulator import SX127xEmulator
+from emulator import topology
+
+import meshdomains
+from sx127x import compile_domain
+from meshnet import MeshNet, Packet, DataPacket, Beacon, RouteAnnounce, RouteRequest, RouteError, LinkAck, Aggregate, Fragment, expand_header
+
+_PROTOCOL           = 99       # Protocol number of the test data
+_SERIAL_LEN         = 4        # Payload bytes holding the serial number of a test packet
+_PINS               = 100      # Pin numbers given to each node
+_IRQ_LATENCY        = 0.002    # Seconds; interrupt handling is never instant on the nodes
+_SPACING_FRACTION   = 1 / 1.6  # Default spacing as a fraction of range: diagonal neighbors hear each other, two apart do not
+
+_FRAME_KINDS = {
+    Beacon.PROTOCOL_ID:         'beacon',
+    RouteAnnounce.PROTOCOL_ID:  'announce',
+    RouteRequest.PROTOCOL_ID:   'request',
+    RouteError.PROTOCOL_ID:     'error',
+    LinkAck.PROTOCOL_ID:        'ack',
+    Aggregate.PROTOCOL_ID:      'aggregate',
+    Fragment.PROTOCOL_ID:       'fragment',
+}
+
+_CONTROL_KINDS = ('beacon', 'announce', 'request', 'error', 'ack')
+
+# Output power in dBm of a domain's tx power, as set_tx_power programs it
+def _power(tx_power):
+    if tx_power[1] == "PA":
+        return min(max(int(round(tx_power[0])) - 2, 0), 15) + 2
+    return min(max(tx_power[0], 0), 15)
+
+# Spacing at which neighbors, diagonal ones included, hear each other on <channel>
+def default_spacing(domain, channel, medium):
+    table = compile_domain(domain)
+    datarate = channel[1] if table.valid_datarate(channel[0], channel[1]) else table.channel_datarates(channel[0])[0]
+    reach = medium.range(_power(table.tx_power(datarate)), table.spreading_factor(datarate),
+                         table.bandwidth(datarate), table.frequency(channel[0]))
+    return reach * _SPACING_FRACTION
+
+def _percentile(values, fraction):
+    return values[min(int(math.ceil(fraction * len(values))) - 1, len(values) - 1)] if values else None
+
+# One process holds one simulation: the stack's threads and time are those of its clock.
+# <nodes> is a list of (address, x, y) as from topology; <kwargs> go to every MeshNet.
+class Simulation:
+    def __init__(self, nodes, domain=meshdomains.US902_MESHNET, channel=(64, 8), gateways=(), seed=None,
+                 exponent=2.7, shadowing=0.0, irq_latency=_IRQ_LATENCY, **kwargs):
+        self.clock = VirtualClock()
+        shims.install(self.clock)
+
+        self.medium = Medium(self.clock, exponent=exponent, shadowing=shadowing, seed=seed)
+        self.medium.monitors.append(self._monitor)
+        self._random = random.Random(seed)
+        self._compressed = kwargs['compress_header'] if 'compress_header' in kwargs else False
+
+        self.nodes = []
+        self.radios = []
+        for index in range(len(nodes)):
+            address, x, y = nodes[index]
+            base = (index + 1) * _PINS
+            pins = { 'ss': base, 'reset': base + 1, 'dio': (base + 2, base + 3, base + 4) }
+
+            radio = SX127xEmulator(medium=self.medium, name="node%d" % address, irq_latency=irq_latency,
+                                   seed=self._random.random(), **pins)
+            self.medium.place(radio, x, y)
+            self.radios.append(radio)
+
+            options = dict(kwargs)
+            options.update(pins)
+            self.nodes.append(MeshNet(domain, address, channel=channel, gateway=address in gateways, **options))
+
+        self._sent = []            # (source, target, time sent) by serial number
+        self._latency = {}         # Seconds to deliver by serial number
+        self._duplicates = 0
+        self._frames = {}          # kind: [ count, bytes, airtime ]
+        self._started = time.monotonic()
+        self.simulated = 0.0
+        self.wall = 0.0
+
+    def _monitor(self, transmission):
+        frame = transmission.frame
+        try:
+            data = expand_header(frame) if self._compressed else frame
+            protocol = Packet(load=data).protocol() & 0x7F
+            kind = _FRAME_KINDS[protocol] if protocol in _FRAME_KINDS else 'data'
+        except (TypeError, IndexError):
+            kind = 'other'
+
+        if kind not in self._frames:
+            self._frames[kind] = [ 0, 0, 0.0 ]
+        counts = self._frames[kind]
+        counts[0] += 1
+        counts[1] += len(frame)
+        counts[2] += transmission.end - transmission.start
+
+    def _receive(self, node):
+        while True:
+            packet = node.receive_packet()
+            if packet.protocol() != _PROTOCOL:
+                continue
+            serial = int.from_bytes(bytes(packet.payload(end=_SERIAL_LEN)), 'big')
+            if serial < len(self._sent) and serial not in self._latency and self._sent[serial][1] == node.address:
+                self._latency[serial] = self.clock.now() - self._sent[serial][2]
+            else:
+                self._duplicates += 1
+
+    def _traffic(self, duration, interval, size):
+        end = self.clock.now() + duration
+        rate = len(self.nodes) / interval
+        while True:
+            self.clock.sleep(self._random.expovariate(rate))
+            if self.clock.now() >= end:
+                break
+
+            source, target = self._random.sample(self.nodes, 2)
+            self.send(source.address, target.address, size)
+
+    def node(self, address):
+        for node in self.nodes:
+            if node.address == address:
+                return node
+        raise ValueError("no node %d" % address)
+
+    # Send a <size> byte test packet from <source> to <target>.  Returns its serial number.
+    def send(self, source, target, size=16):
+        serial = len(self._sent)
+        self._sent.append((source, target, self.clock.now()))
+        payload = bytearray(serial.to_bytes(_SERIAL_LEN, 'big')) + bytearray(max(size - _SERIAL_LEN, 0))
+        self.node(source).send_packet(DataPacket(target=target, protocol=_PROTOCOL, payload=payload))
+        return serial
+
+    # Seconds test packet <serial> took to arrive; None if it has not
+    def latency(self, serial):
+        return self._latency.get(serial)
+
+    # Start the nodes at random in the next <stagger> seconds and let them all come up
+    def start(self, stagger=10.0):
+        if len(self.nodes) < 2:
+            raise ValueError("a simulation needs at least two nodes")
+
+        self._started = time.monotonic()
+        for node in self.nodes:
+            self.clock.call_later(self._random.uniform(0, stagger), node.start)
+            self.clock.start_new_thread(self._receive, (node,))
+        self.clock.sleep(stagger)
+
+    def advance(self, seconds):
+        self.clock.sleep(seconds)
+
+    # Advance until test packets <serials> have all arrived, at most <timeout> seconds.  True if they did.
+    def wait(self, serials, timeout, step=0.1):
+        end = self.clock.now() + timeout
+        while any(serial not in self._latency for serial in serials):
+            if self.clock.now() >= end:
+                return False
+            self.clock.sleep(step)
+        return True
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+
+    def run(self, duration=600.0, interval=60.0, size=16, stagger=10.0, drain=30.0):
+        self.start(stagger)
+        self.clock.start_new_thread(self._traffic, (duration, interval, size))
+        self.advance(duration + drain)
+
+        report = self.report()
+        self.stop()
+        return report
+
+    # Figures up to now
+    def report(self):
+        self.simulated = self.clock.now()
+        self.wall = time.monotonic() - self._started
+        latency = sorted(self._latency.values())
+        frames = { kind: { 'count': counts[0], 'bytes': counts[1], 'airtime': counts[2] } for kind, counts in self._frames.items() }
+        airtime = sum(counts[2] for counts in self._frames.values())
+        control = [ counts for kind, counts in self._frames.items() if kind in _CONTROL_KINDS ]
+
+        return {
+            'nodes':            len(self.nodes),
+            'simulated':        self.simulated,
+            'wall':             self.wall,
+            'speedup':          self.simulated / self.wall if self.wall else None,
+            'sent':             len(self._sent),
+            'delivered':        len(latency),
+            'duplicates':       self._duplicates,
+            'pdr':              len(latency) / len(self._sent) if self._sent else None,
+            'latency': {
+                'mean':         sum(latency) / len(latency) if latency else None,
+                'min':          latency[0] if latency else None,
+                'median':       _percentile(latency, 0.5),
+                'p90':          _percentile(latency, 0.9),
+                'p99':          _percentile(latency, 0.99),
+                'max':          latency[-1] if latency else None,
+            },
+            'frames':           frames,
+            'control_frames':   sum(counts[0] for counts in control),
+            'control_airtime':  sum(counts[2] for counts in control) / airtime if airtime else None,
+            'control_per_delivery': sum(counts[0] for counts in control) / len(latency) if latency else None,
+            'channels':         { "%.3f" % (frequency / 1E6): { 'airtime': seconds / self.simulated, 'busy': self.medium.busy_time(frequency) / self.simulated }
+                                  for frequency, seconds in self.medium.airtime.items() },
+            'transmissions':    self.medium.transmissions,
+            'collisions':       self.medium.collisions,
+            'captures':         self.medium.captures,
+            'crc_errors':       sum(radio.crc_errors for radio in self.radios),
+        }
+
+def _ms(seconds):
+    return "-" if seconds == None else "%.1f" % (seconds * 1000)
+
+def print_report(report):
+    print("%d nodes: %.1f s simulated in %.1f s (%.1fx real time)" % (report['nodes'], report['simulated'], report['wall'], report['speedup'] or 0))
+    print("Packets: %d sent, %d delivered, PDR %s, %d duplicates" % (report['sent'], report['delivered'],
+          "-" if report['pdr'] == None else "%.1f%%" % (report['pdr'] * 100), report['duplicates']))
+
+    latency = report['latency']
+    print("Latency ms: mean %s min %s median %s p90 %s p99 %s max %s" % (_ms(latency['mean']), _ms(latency['min']),
+          _ms(latency['median']), _ms(latency['p90']), _ms(latency['p99']), _ms(latency['max'])))
+
+    print("Frames:")
+    for kind in sorted(report['frames']):
+        frames = report['frames'][kind]
+        print("    %-10s %7d frames %9d bytes %9.1f s" % (kind, frames['count'], frames['bytes'], frames['airtime']))
+    print("Control: %d frames, %s of airtime, %s per delivered packet" % (report['control_frames'],
+          "-" if report['control_airtime'] == None else "%.1f%%" % (report['control_airtime'] * 100),
+          "-" if report['control_per_delivery'] == None else "%.2f" % report['control_per_delivery']))
+
+    print("Airtime use (frames sent, time busy):")
+    for channel in sorted(report['channels']):
+        use = report['channels'][channel]
+        print("    %s MHz %7.1f%% %5.1f%%" % (channel, use['airtime'] * 100, use['busy'] * 100))
+    print("Medium: %d transmissions, %d collisions, %d captures, %d CRC errors" % (report['transmissions'],
+          report['collisions'], report['captures'], report['crc_errors']))
+
+# line:<count>, grid:<rows>x<columns>, random:<count> or file:<filename>
+def make_topology(description, spacing, seed=None):
+    kind, _, value = description.partition(':')
+    if kind == 'line':
+        return topology.line(int(value), spacing)
+    if kind == 'grid':
+        rows, _, columns = value.partition('x')
+        return topology.grid(int(rows), int(columns or rows), spacing)
+    if kind == 'random':
+        # About one node per <spacing> square
+        count = int(value)
+        return topology.scatter(count, spacing * math.sqrt(count), seed=seed)
+    if kind == 'file':
+        return topology.load(value, spacing)
+    raise ValueError("unknown topology %s" % description)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a MeshNet mesh on virtual time")
+    parser.add_argument('--topology', default='grid:5x5', help="line:N, grid:RxC, random:N or file:PATH (default grid:5x5)")
+    parser.add_argument('--spacing', type=float, help="meters between neighbors (default from the datarate's range)")
+    parser.add_argument('--domain', default='US902_MESHNET')
+    parser.add_argument('--channel', type=int, default=64)
+    parser.add_argument('--datarate', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=600.0, help="seconds of traffic")
+    parser.add_argument('--interval', type=float, default=60.0, help="mean seconds between packets from each node")
+    parser.add_argument('--size', type=int, default=16, help="payload bytes")
+    parser.add_argument('--stagger', type=float, default=10.0, help="seconds over which nodes start")
+    parser.add_argument('--drain', type=float, default=30.0, help="seconds allowed for the last packets")
+    parser.add_argument('--exponent', type=float, default=2.7, help="path loss exponent")
+    parser.add_argument('--shadowing', type=float, default=0.0, help="per link shadowing in dB")
+    parser.add_argument('--irq-latency', type=float, default=_IRQ_LATENCY, help="most seconds a radio interrupt waits for its handler")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--gateway', type=int, action='append', default=[], help="address of a gateway node")
+    parser.add_argument('--link-ack', action='store_true')
+    parser.add_argument('--multichannel', action='store_true')
+    parser.add_argument('--compress-header', action='store_true')
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--verbose', action='store_true', help="show the stack's own output")
+    args = parser.parse_args(argv)
+
+    domain = getattr(meshdomains, args.domain)
+    channel = (args.channel, args.datarate)
+    spacing = args.spacing if args.spacing != None else default_spacing(domain, channel, Medium(exponent=args.exponent))
+
+    options = {}
+    for option in ('link_ack', 'multichannel', 'compress_header'):
+        if getattr(args, option):
+            options[option] = True
+
+    simulation = Simulation(make_topology(args.topology, spacing, args.seed), domain=domain, channel=channel, gateways=args.gateway,
+                            seed=args.seed, exponent=args.exponent, shadowing=args.shadowing,
+                            irq_latency=args.irq_latency, **options)
+
+    with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(sys.stdout if args.verbose else quiet):
+        report = simulation.run(args.duration, args.interval, args.size, args.stagger, args.drain)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+#
+# Register level emulation of an SX127x in LoRa mode.
+#
+# The chip is wired to machine pins like the real one: SPI transfers while its
+# select pin is low reach the register file, its reset pin restarts it and its
+# DIO lines are driven from the IRQ flags and DIO mapping.  Frames go to and
+# come from a medium (see ether.py); how long things take follows the SF, BW,
+# coding rate, preamble and header settings in the registers.
+#
+# Not emulated: FSK/OOK, frequency hopping, FIFO wrap within continuous receive
+# (every packet is stored from the RX base address) and the PA/LNA analog side.
+#
+import random
+import threading
+
+from emulator import machine
+from emulator.clock import RealClock
+
+# Register addresses
+_REG_FIFO               = 0x00
+_REG_OP_MODE            = 0x01
+_REG_FRF_MSB            = 0x06
+_REG_PA_CONFIG          = 0x09
+_REG_FIFO_PTR           = 0x0D
+_REG_TX_FIFO_BASE       = 0x0E
+_REG_RX_FIFO_BASE       = 0x0F
+_REG_RX_FIFO_CURRENT    = 0x10
+_REG_IRQ_FLAGS_MASK     = 0x11
+_REG_IRQ_FLAGS          = 0x12
+_REG_RX_NUM_BYTES       = 0x13
+_REG_RX_HEADER_CNT_MSB  = 0x14
+_REG_RX_PACKET_CNT_MSB  = 0x16
+_REG_MODEM_STATUS       = 0x18
+_REG_PACKET_SNR         = 0x19
+_REG_PACKET_RSSI        = 0x1A
+_REG_RSSI_VALUE         = 0x1B
+_REG_MODEM_CONFIG_1     = 0x1D
+_REG_MODEM_CONFIG_2     = 0x1E
+_REG_SYMBOL_TIMEOUT     = 0x1F
+_REG_PREAMBLE_MSB       = 0x20
+_REG_PREAMBLE_LSB       = 0x21
+_REG_PAYLOAD_LENGTH     = 0x22
+_REG_RX_FIFO_BYTE       = 0x25
+_REG_MODEM_CONFIG_3     = 0x26
+_REG_SYNC_WORD          = 0x39
+_REG_DIO_MAPPING_1      = 0x40
+_REG_VERSION            = 0x42
+
+# Registers the chip writes; SPI writes to them are ignored
+_READ_ONLY = (_REG_RX_FIFO_CURRENT, _REG_RX_NUM_BYTES, 0x14, 0x15, 0x16, 0x17, _REG_MODEM_STATUS,
+              _REG_PACKET_SNR, _REG_PACKET_RSSI, _REG_RSSI_VALUE, _REG_RX_FIFO_BYTE, _REG_VERSION)
+
+_MODE_LONG_RANGE        = 0x80
+_MODE_MASK              = 0x07
+MODE_SLEEP              = 0
+MODE_STANDBY            = 1
+MODE_FS_TX              = 2
+MODE_TX                 = 3
+MODE_FS_RX              = 4
+MODE_RX_CONTINUOUS      = 5
+MODE_RX_SINGLE          = 6
+MODE_CAD                = 7
+
+_IRQ_CAD_DETECTED       = 0x01
+_IRQ_FHSS_CHANGE        = 0x02
+_IRQ_CAD_DONE           = 0x04
+_IRQ_TX_DONE            = 0x08
+_IRQ_VALID_HEADER       = 0x10
+_IRQ_CRC_ERROR          = 0x20
+_IRQ_RX_DONE            = 0x40
+_IRQ_RX_TIMEOUT         = 0x80
+
+# IRQ flag behind each DIO mapping value, for DIO0..DIO3
+_DIO_FLAGS = (
+    (_IRQ_RX_DONE,    _IRQ_TX_DONE,      _IRQ_CAD_DONE,     0),
+    (_IRQ_RX_TIMEOUT, _IRQ_FHSS_CHANGE,  _IRQ_CAD_DETECTED, 0),
+    (_IRQ_FHSS_CHANGE, _IRQ_FHSS_CHANGE, _IRQ_FHSS_CHANGE,  0),
+    (_IRQ_CAD_DONE,   _IRQ_VALID_HEADER, _IRQ_CRC_ERROR,    0),
+)
+
+_MODEM_STATUS_SIGNAL    = 0x01     # Signal detected
+_MODEM_STATUS_SYNC      = 0x02     # Signal synchronized
+_MODEM_STATUS_CLEAR     = 0x10     # Modem clear
+
+BANDWIDTHS = ( 7.8E3, 10.4E3, 15.6E3, 20.8E3, 31.25E3, 41.7E3, 62.5E3, 125E3, 250E3, 500E3 )
+
+_FIFO_SIZE              = 256
+_VERSION                = 0x12
+_LOCK_SYMBOLS           = 5        # Preamble symbols a receiver needs to synchronize
+
+# Symbol time in seconds
+def symbol_time(sf, bw):
+    return (2 ** sf) / bw
+
+# Time on air in seconds of a <length> byte frame (Semtech AN1200.13)
+def airtime(length, sf, bw, cr=5, preamble=8, implicit=False, crc=True, low_rate=None):
+    symbol = symbol_time(sf, bw)
+    if low_rate == None:
+        low_rate = symbol > 0.016
+    bits = 8 * length - 4 * sf + 28 + (16 if crc else 0) - (20 if implicit else 0)
+    step = 4 * (sf - (2 if low_rate else 0))
+    symbols = 8 + max(-(-bits // step) * cr, 0)
+    return (preamble + 4.25 + symbols) * symbol
+
+# A frame on the air.  <tuning> is (frf, sf, bw index, sync word); receivers must match it.
+class Transmission:
+    def __init__(self, radio, frame, tuning, power, start, preamble_end, end, implicit, crc):
+        self.radio = radio
+        self.frame = frame
+        self.tuning = tuning
+        self.power = power
+        self.start = start
+        self.preamble_end = preamble_end
+        self.end = end
+        self.implicit = implicit
+        self.crc = crc
+        self.aborted = False
+
+    def __repr__(self):
+        return "Transmission(%s, %d bytes, %.4f-%.4f)" % (self.radio, len(self.frame), self.start, self.end)
+
+    def frequency(self, xtal=32E6):
+        return self.tuning[0] * xtal / 2**19
+
+class SX127xEmulator:
+    # Pins default to those MeshNet uses.  Each DIO change reaches the pins up to <irq_latency> seconds
+    # late, at random, like interrupt handling on the host would.
+    def __init__(self, ss=18, reset=14, dio=(26, 35, 34), medium=None, clock=None, name=None, xtal=32E6, irq_latency=0.0, seed=None):
+        self.name = name if name != None else "sx127x@%s" % ss
+        self._clock = clock if clock != None else (medium.clock if medium != None else RealClock())
+        self._medium = medium
+        self._xtal = xtal
+        self._ss = ss
+        self._reset_pin = reset
+        self._dio = tuple(dio)
+        self._irq_latency = irq_latency
+        self._random = random.Random(seed)
+
+        self._lock = threading.RLock()
+        self._spi_lock = threading.Lock()
+        self._reset_level = 1
+        self._reset()
+
+        machine.wire(ss, self)
+        machine.wire(reset, self)
+        if medium != None:
+            medium.attach(self)
+
+    def __repr__(self):
+        return self.name
+
+    def _reset(self):
+        with self._lock:
+            self._regs = bytearray(0x80)
+            self._fifo = bytearray(_FIFO_SIZE)
+            self._regs[_REG_OP_MODE] = MODE_STANDBY
+            self._regs[_REG_FRF_MSB:_REG_FRF_MSB + 3] = bytes((0x6C, 0x80, 0x00))
+            self._regs[_REG_PA_CONFIG] = 0x4F
+            self._regs[_REG_MODEM_CONFIG_1] = 0x72
+            self._regs[_REG_MODEM_CONFIG_2] = 0x70
+            self._regs[_REG_SYMBOL_TIMEOUT] = 0x64
+            self._regs[_REG_PREAMBLE_LSB] = 0x08
+            self._regs[_REG_PAYLOAD_LENGTH] = 0x01
+            self._regs[_REG_TX_FIFO_BASE] = 0x80
+            self._regs[_REG_MODEM_STATUS] = _MODEM_STATUS_CLEAR
+            self._regs[_REG_SYNC_WORD] = 0x12
+            self._regs[_REG_VERSION] = _VERSION
+            self._address = None
+            self._transmission = None   # What we are sending
+            self._receiving = None      # What we are synchronized to
+            self._generation = 0        # Bumped on every mode change to retire stale events
+            self._header_count = 0
+            self._packet_count = 0
+            self.tx_count = 0
+            self.rx_count = 0
+            self.crc_errors = 0
+            self.tx_time = 0.0          # Seconds spent transmitting
+
+        self._update_dio()
+
+    #
+    # Pin side
+    #
+    def pin_changed(self, id, level):
+        if id == self._ss:
+            if level == 0:
+                self._spi_lock.acquire()
+                self._address = None
+                machine.select(self)
+            elif self._spi_lock.locked():
+                machine.deselect(self)
+                self._address = None
+                self._spi_lock.release()
+
+        elif id == self._reset_pin:
+            # Restarts on the rising edge after being held low
+            if level and not self._reset_level:
+                self._reset()
+            self._reset_level = level
+
+    # One SPI byte.  The first after select is the address (bit 7 set to write); following bytes
+    # go to consecutive registers, except the FIFO which moves its own pointer instead.
+    def transfer(self, value):
+        with self._lock:
+            if self._address == None:
+                self._address = value
+                return 0
+
+            address = self._address & 0x7F
+            if self._address & 0x80:
+                self._write(address, value)
+                response = 0
+            else:
+                response = self._read(address)
+
+            if address != _REG_FIFO:
+                self._address = (self._address & 0x80) | ((address + 1) & 0x7F)
+
+            return response
+
+    def _read(self, address):
+        if address == _REG_FIFO:
+            pointer = self._regs[_REG_FIFO_PTR]
+            self._regs[_REG_FIFO_PTR] = (pointer + 1) % _FIFO_SIZE
+            return self._fifo[pointer]
+
+        if address == _REG_RSSI_VALUE:
+            self._regs[_REG_RSSI_VALUE] = self._rssi_register(self._channel_rssi())
+
+        return self._regs[address]
+
+    def _write(self, address, value):
+        if address == _REG_FIFO:
+            pointer = self._regs[_REG_FIFO_PTR]
+            self._fifo[pointer] = value
+            self._regs[_REG_FIFO_PTR] = (pointer + 1) % _FIFO_SIZE
+
+        elif address == _REG_IRQ_FLAGS:
+            # Write one to clear
+            self._regs[_REG_IRQ_FLAGS] &= ~value
+            self._update_dio()
+
+        elif address == _REG_OP_MODE:
+            self._regs[_REG_OP_MODE] = value
+            self._set_mode(value & _MODE_MASK)
+
+        elif address == _REG_DIO_MAPPING_1:
+            self._regs[address] = value
+            self._update_dio()
+
+        elif address not in _READ_ONLY:
+            self._regs[address] = value
+
+    #
+    # Configuration as the registers have it
+    #
+    def mode(self):
+        return self._regs[_REG_OP_MODE] & _MODE_MASK
+
+    def spreading_factor(self):
+        return min(max(self._regs[_REG_MODEM_CONFIG_2] >> 4, 6), 12)
+
+    def bandwidth(self):
+        return BANDWIDTHS[min(self._regs[_REG_MODEM_CONFIG_1] >> 4, len(BANDWIDTHS) - 1)]
+
+    def coding_rate(self):
+        return min(max(((self._regs[_REG_MODEM_CONFIG_1] >> 1) & 0x07) + 4, 5), 8)
+
+    def implicit_header(self):
+        return (self._regs[_REG_MODEM_CONFIG_1] & 0x01) != 0
+
+    def crc(self):
+        return (self._regs[_REG_MODEM_CONFIG_2] & 0x04) != 0
+
+    def preamble_length(self):
+        return (self._regs[_REG_PREAMBLE_MSB] << 8) | self._regs[_REG_PREAMBLE_LSB]
+
+    def frequency(self):
+        frf = (self._regs[_REG_FRF_MSB] << 16) | (self._regs[_REG_FRF_MSB + 1] << 8) | self._regs[_REG_FRF_MSB + 2]
+        return frf * self._xtal / 2**19
+
+    # Output power in dBm from PA_CONFIG
+    def power(self):
+        config = self._regs[_REG_PA_CONFIG]
+        if config & 0x80:
+            return 2 + (config & 0x0F)
+        return 10.8 + 0.6 * ((config >> 4) & 0x07) - (15 - (config & 0x0F))
+
+    # What a frame must match to be heard: carrier, spreading factor, bandwidth and sync word
+    def tuning(self):
+        with self._lock:
+            regs = self._regs
+            return ((regs[_REG_FRF_MSB] << 16) | (regs[_REG_FRF_MSB + 1] << 8) | regs[_REG_FRF_MSB + 2],
+                    self.spreading_factor(), min(regs[_REG_MODEM_CONFIG_1] >> 4, len(BANDWIDTHS) - 1), regs[_REG_SYNC_WORD])
+
+    def symbol_time(self):
+        return symbol_time(self.spreading_factor(), self.bandwidth())
+
+    def low_data_rate(self):
+        return (self._regs[_REG_MODEM_CONFIG_3] & 0x08) != 0
+
+    # Register value for <dbm>; the high frequency port offset applies above 779 MHz
+    def _rssi_register(self, dbm):
+        offset = -157 if self.frequency() >= 779E6 else -164
+        return min(max(int(round(dbm - offset)), 0), 255)
+
+    def _channel_rssi(self):
+        return self._medium.rssi(self, self.tuning()) if self._medium != None else -157
+
+    #
+    # Modes
+    #
+    def _set_mode(self, mode):
+        self._generation += 1
+        generation = self._generation
+
+        if self._transmission != None and mode != MODE_TX:
+            # Left transmit early; the frame is cut short
+            self._transmission.aborted = True
+            self.tx_time += self._clock.now() - self._transmission.start
+            if self._medium != None:
+                self._clock.call_later(0, self._medium.abort, self._transmission)
+            self._transmission = None
+
+        self._receiving = None
+        self._regs[_REG_MODEM_STATUS] = _MODEM_STATUS_CLEAR
+
+        if mode == MODE_SLEEP:
+            # FIFO is lost in sleep
+            self._fifo = bytearray(_FIFO_SIZE)
+
+        elif mode == MODE_TX:
+            self._start_transmit()
+
+        elif mode in (MODE_RX_CONTINUOUS, MODE_RX_SINGLE):
+            self._clock.call_later(0, self._receive_started, generation)
+            if mode == MODE_RX_SINGLE:
+                timeout = ((self._regs[_REG_MODEM_CONFIG_2] & 0x03) << 8) | self._regs[_REG_SYMBOL_TIMEOUT]
+                self._clock.call_later(timeout * self.symbol_time(), self._receive_timeout, generation)
+
+        elif mode == MODE_CAD:
+            # Roughly two symbols of correlation
+            self._clock.call_later(2 * self.symbol_time(), self._cad_done, generation)
+
+    def _start_transmit(self):
+        length = self._regs[_REG_PAYLOAD_LENGTH]
+        base = self._regs[_REG_TX_FIFO_BASE]
+        frame = bytes(self._fifo[(base + i) % _FIFO_SIZE] for i in range(length))
+
+        sf = self.spreading_factor()
+        bw = self.bandwidth()
+        preamble = self.preamble_length()
+        now = self._clock.now()
+        duration = airtime(length, sf, bw, self.coding_rate(), preamble, self.implicit_header(), self.crc(), self.low_data_rate())
+
+        transmission = Transmission(self, frame, self.tuning(), self.power(), now,
+                                    now + (preamble + 4.25) * symbol_time(sf, bw), now + duration,
+                                    self.implicit_header(), self.crc())
+        self._transmission = transmission
+        self.tx_count += 1
+
+        if self._medium != None:
+            self._clock.call_later(0, self._medium.transmit, transmission)
+        self._clock.call_later(duration, self._transmit_done, transmission)
+
+    def _transmit_done(self, transmission):
+        with self._lock:
+            if self._transmission is transmission:
+                self._transmission = None
+                self.tx_time += transmission.end - transmission.start
+                self._regs[_REG_OP_MODE] = (self._regs[_REG_OP_MODE] & ~_MODE_MASK) | MODE_STANDBY
+                self._generation += 1
+                self._raise(_IRQ_TX_DONE)
+
+    # Just entered receive: synchronize to a frame whose preamble is still going
+    def _receive_started(self, generation):
+        active = self._medium.active(self, self.tuning()) if self._medium != None else []
+        now = self._clock.now()
+        for transmission in active:
+            if now + _LOCK_SYMBOLS * self.symbol_time() <= transmission.preamble_end:
+                self.receiving(transmission, generation)
+                break
+
+    def _receive_timeout(self, generation):
+        with self._lock:
+            if generation == self._generation and self._receiving == None:
+                self._regs[_REG_OP_MODE] = (self._regs[_REG_OP_MODE] & ~_MODE_MASK) | MODE_STANDBY
+                self._generation += 1
+                self._raise(_IRQ_RX_TIMEOUT)
+
+    def _cad_done(self, generation):
+        detected = len(self._medium.active(self, self.tuning())) != 0 if self._medium != None else False
+        with self._lock:
+            if generation == self._generation:
+                self._regs[_REG_OP_MODE] = (self._regs[_REG_OP_MODE] & ~_MODE_MASK) | MODE_STANDBY
+                self._generation += 1
+                self._raise(_IRQ_CAD_DONE | (_IRQ_CAD_DETECTED if detected else 0))
+
+    #
+    # Medium side
+    #
+    # A frame started that matches our tuning.  Synchronize to it if receiving and not busy with another.
+    # Returns True if we did.
+    def receiving(self, transmission, generation=None):
+        with self._lock:
+            if generation != None and generation != self._generation:
+                return False
+            if self.mode() not in (MODE_RX_CONTINUOUS, MODE_RX_SINGLE) or self._receiving != None:
+                return False
+            if transmission.tuning != self.tuning():
+                return False
+            self._receiving = transmission
+            self._regs[_REG_MODEM_STATUS] = _MODEM_STATUS_SIGNAL | _MODEM_STATUS_SYNC
+            return True
+
+    # The frame we are synchronized to, if any
+    def synchronized(self):
+        return self._receiving
+
+    # <transmission> ended.  If we were synchronized to it, store it and flag RX_DONE; <ok> False
+    # (collision, too weak, cut short) gives a CRC error.  <rssi> and <snr> are as received.
+    def received(self, transmission, ok, rssi, snr):
+        with self._lock:
+            if self._receiving is not transmission:
+                return
+
+            self._receiving = None
+            self._regs[_REG_MODEM_STATUS] = _MODEM_STATUS_CLEAR
+
+            frame = transmission.frame
+            if self.implicit_header():
+                # No header to go by; the configured length is taken
+                length = self._regs[_REG_PAYLOAD_LENGTH]
+                frame = (frame + bytes(length))[:length]
+                ok = ok and transmission.implicit and len(transmission.frame) <= length
+            else:
+                ok = ok and not transmission.implicit
+                self._header_count += 1
+
+            base = self._regs[_REG_RX_FIFO_BASE]
+            for i in range(len(frame)):
+                self._fifo[(base + i) % _FIFO_SIZE] = frame[i]
+
+            self._regs[_REG_RX_FIFO_CURRENT] = base
+            self._regs[_REG_RX_NUM_BYTES] = len(frame)
+            self._regs[_REG_RX_FIFO_BYTE] = (base + len(frame)) % _FIFO_SIZE
+            self._regs[_REG_PACKET_SNR] = int(round(snr * 4)) & 0xFF
+            self._regs[_REG_PACKET_RSSI] = self._rssi_register(rssi)
+            self._regs[_REG_RSSI_VALUE] = self._rssi_register(self._channel_rssi())
+            self._packet_count += 1
+            self._regs[_REG_RX_HEADER_CNT_MSB:_REG_RX_HEADER_CNT_MSB + 2] = (self._header_count & 0xFFFF).to_bytes(2, 'big')
+            self._regs[_REG_RX_PACKET_CNT_MSB:_REG_RX_PACKET_CNT_MSB + 2] = (self._packet_count & 0xFFFF).to_bytes(2, 'big')
+
+            flags = _IRQ_RX_DONE | (0 if self.implicit_header() else _IRQ_VALID_HEADER)
+            if not ok and (transmission.crc or self.implicit_header()):
+                flags |= _IRQ_CRC_ERROR
+                self.crc_errors += 1
+            else:
+                self.rx_count += 1
+
+            if self.mode() == MODE_RX_SINGLE:
+                self._regs[_REG_OP_MODE] = (self._regs[_REG_OP_MODE] & ~_MODE_MASK) | MODE_STANDBY
+                self._generation += 1
+
+            self._raise(flags)
+
+    #
+    # Interrupts
+    #
+    def _raise(self, flags):
+        self._regs[_REG_IRQ_FLAGS] |= flags & ~self._regs[_REG_IRQ_FLAGS_MASK]
+        self._update_dio()
+
+    # DIO levels follow the flags they are mapped to.  Pins are driven from the clock, never
+    # from inside an SPI transfer, just as an interrupt arrives after the transaction.
+    def _update_dio(self):
+        self._clock.call_later(self._random.uniform(0, self._irq_latency) if self._irq_latency else 0, self._drive_dio)
+
+    def _drive_dio(self):
+        with self._lock:
+            mapping = self._regs[_REG_DIO_MAPPING_1]
+            flags = self._regs[_REG_IRQ_FLAGS]
+            levels = [ (flags & _DIO_FLAGS[dio][(mapping >> (6 - 2 * dio)) & 0x03]) != 0 for dio in range(len(self._dio)) ]
+
+        for dio in range(len(self._dio)):
+            machine.drive(self._dio[dio], levels[dio])
@@ -0,0 +1,33 @@
+#
+# Stand-in for the MicroPython _thread module on CPython.
+#
+# MicroPython accepts small thread stacks that CPython refuses; those requests are
+# ignored.  Everything else is CPython's own _thread until use() puts the threads on
+# a VirtualClock.
+#
+import _thread as _cpython_thread
+
+allocate_lock = _cpython_thread.allocate_lock
+get_ident = _cpython_thread.get_ident
+start_new_thread = _cpython_thread.start_new_thread
+LockType = _cpython_thread.LockType
+error = _cpython_thread.error
+
+_MIN_STACK = 32768
+_virtual = False
+
+def exit():
+    raise SystemExit
+
+def stack_size(size=0):
+    if _virtual or (size != 0 and size < _MIN_STACK):
+        return _cpython_thread.stack_size()
+    return _cpython_thread.stack_size(size)
+
+# Run threads and locks on <clock>, a VirtualClock
+def use(clock):
+    global allocate_lock, get_ident, start_new_thread, _virtual
+    allocate_lock = clock.allocate_lock
+    get_ident = clock.get_ident
+    start_new_thread = clock.start_new_thread
+    _virtual = True
@@ -0,0 +1,49 @@
+#
+# Stand-in for the MicroPython time module on CPython.
+#
+# sleep(), time() and the ticks functions follow the clock given to use(), a RealClock
+# unless a VirtualClock is wanted.  Anything else is CPython's own time.
+#
+import time as _cpython_time
+
+from emulator.clock import RealClock
+
+for _name in dir(_cpython_time):
+    if not _name.startswith('__'):
+        globals()[_name] = getattr(_cpython_time, _name)
+
+_TICKS_PERIOD = 1 << 30
+
+_clock = RealClock()
+_epoch = _cpython_time.time()
+
+def use(clock):
+    global _clock
+    _clock = clock
+
+def clock():
+    return _clock
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+def sleep_ms(ms):
+    _clock.sleep(ms / 1000.0)
+
+def sleep_us(us):
+    _clock.sleep(us / 1000000.0)
+
+def time():
+    return _epoch + _clock.now()
+
+def ticks_ms():
+    return int(_clock.now() * 1000) % _TICKS_PERIOD
+
+def ticks_us():
+    return int(_clock.now() * 1000000) % _TICKS_PERIOD
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % _TICKS_PERIOD
+
+def ticks_diff(end, start):
+    return ((end - start + _TICKS_PERIOD // 2) % _TICKS_PERIOD) - _TICKS_PERIOD // 2
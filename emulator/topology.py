@@ -0,0 +1,45 @@
+#
+# Node layouts for the simulator.
+#
+# Each returns a list of (address, x, y) with positions in meters.  Addresses are
+# numbered from <first> unless the layout names them.
+#
+import random
+
+# <count> nodes in a row
+def line(count, spacing, first=1):
+    return [ (first + index, index * spacing, 0.0) for index in range(count) ]
+
+# <rows> by <columns> nodes, numbered along the rows
+def grid(rows, columns, spacing, first=1):
+    return [ (first + row * columns + column, column * spacing, row * spacing) for row in range(rows) for column in range(columns) ]
+
+# <count> nodes placed uniformly at random in a <width> by <height> area
+def scatter(count, width, height=None, seed=None, first=1):
+    generator = random.Random(seed)
+    height = width if height == None else height
+    return [ (first + index, generator.uniform(0, width), generator.uniform(0, height)) for index in range(count) ]
+
+# A drawing like the one in route.txt: rows of tab separated node addresses, empty cells
+# leaving gaps.  The first run of such rows in <text> is used; anything else is ignored.
+#
+#    1   2   4   6
+#        3   5
+#
+def layout(text, spacing):
+    nodes = []
+    row = 0
+    for line in text.splitlines():
+        cells = [ cell.strip() for cell in line.split('\t') ]
+        if any(cells) and all(cell.isdigit() or cell == '' for cell in cells):
+            for column in range(len(cells)):
+                if cells[column] != '':
+                    nodes.append((int(cells[column]), column * spacing, row * spacing))
+            row += 1
+        elif nodes:
+            break
+    return nodes
+
+def load(filename, spacing):
+    with open(filename) as f:
+        return layout(f.read(), spacing)
@@ -0,0 +1,34 @@
+#
+# Stand-in for MicroPython's 'uasyncio' module on CPython's asyncio.
+#
+# Emulated radios raise their interrupts from threads of their own, so ThreadSafeFlag
+# hands set() to the loop with call_soon_threadsafe.
+#
+from asyncio import *
+import asyncio as _asyncio
+
+async def sleep_ms(ms):
+    await _asyncio.sleep(ms / 1000.0)
+
+class ThreadSafeFlag():
+    def __init__(self):
+        self._loop = None
+        self._set = False
+        self._event = _asyncio.Event()
+
+    # Safe from any thread, or from no loop at all
+    def set(self):
+        self._set = True
+        loop = self._loop
+        if loop != None:
+            loop.call_soon_threadsafe(self._event.set)
+
+    def clear(self):
+        self._set = False
+        self._event.clear()
+
+    async def wait(self):
+        self._loop = _asyncio.get_running_loop()
+        if not self._set:
+            await self._event.wait()
+        self.clear()
@@ -0,0 +1,127 @@
+#
+# Raw frame capture
+#
+# Every frame received or sent by a MeshNet is logged with its time, direction,
+# radio, RSSI and SNR.  Records are packed into a buffer allocated up front and
+# written out from a thread of their own, so the radio paths never touch the file.
+# When the buffer fills faster than it drains the frames are counted as dropped.
+#
+# The stream starts with a header:
+#    'MNCP'      4 bytes
+#    version     1 byte
+#    address     2 bytes   capturing node
+#    channel     1 byte    listening channel and datarate when capture began
+#    datarate    1 byte
+#
+# then one record per frame (little endian):
+#    ticks_ms    4 bytes
+#    flags       1 byte    bit 0 set for transmitted frames, bit 1 for CRC errors,
+#                          bit 2 for frames without a LoRa header (implicit)
+#    interface   1 byte
+#    rssi        2 bytes   dBm; -32768 if unknown
+#    snr         2 bytes   quarter dB; -32768 if unknown
+#    length      1 byte
+#    frame       <length> bytes, as on the air
+#
+# Capture to flash with MeshNet.set_capture(file) on a file opened 'wb', or over the
+# console with MeshNet.set_capture(SerialWriter()).  The stream stays the caller's: to
+# finish, set_capture(None), wait() on the Capture for its last write, then close the
+# file.  emulator/replay.py plays a capture back into a MeshNet on the emulated radio.
+#
+import struct
+from time import sleep, ticks_ms
+from ulock import lock
+from uthread import thread
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+CAPTURE_MAGIC       = b'MNCP'
+CAPTURE_VERSION     = const(1)
+CAPTURE_TX          = const(0x01)
+CAPTURE_CRC_ERROR   = const(0x02)
+CAPTURE_IMPLICIT    = const(0x04)
+CAPTURE_UNKNOWN     = const(-32768)
+
+CAPTURE_HEADER_FORMAT = "<4sBHBB"
+CAPTURE_RECORD_FORMAT = "<IBBhhB"
+CAPTURE_HEADER_LEN    = const(9)
+CAPTURE_RECORD_LEN    = const(11)
+
+_CAPTURE_BUFFER     = const(4096)
+_CAPTURE_INTERVAL   = 1.0          # Seconds between writes to the stream
+
+# Writes capture data to the console as '@<hex>' lines, which keep clear of the
+# REPL and the serial bridge's '$' lines
+class SerialWriter():
+    def __init__(self, width=64):
+        self._width = width
+
+    def write(self, data):
+        for start in range(0, len(data), self._width):
+            print("@" + "".join("%02x" % byte for byte in data[start:start + self._width]))
+
+    def flush(self):
+        pass
+
+class Capture(thread):
+    def __init__(self, stream, address=0, channel=None, size=_CAPTURE_BUFFER, interval=_CAPTURE_INTERVAL):
+        super().__init__("capture", stack=4096)
+        self._stream = stream
+        self._interval = interval
+        self._buffer = bytearray(size)
+        self._spare = bytearray(size)
+        self._fill = 0
+        self._lock = lock()
+        self._frames = 0
+        self._dropped = 0
+
+        channel, datarate = channel if channel != None else (0, 0)
+        self._stream.write(struct.pack(CAPTURE_HEADER_FORMAT, CAPTURE_MAGIC, CAPTURE_VERSION, address, channel & 0xFF, datarate & 0xFF))
+
+    # Log <frame>.  Called from the radio paths, so it only copies into the buffer.
+    def frame(self, flags, frame, interface=0, rssi=None, snr=None):
+        length = min(len(frame), 0xFF)
+        with self._lock:
+            offset = self._fill
+            if offset + CAPTURE_RECORD_LEN + length > len(self._buffer):
+                self._dropped += 1
+                return
+
+            struct.pack_into(CAPTURE_RECORD_FORMAT, self._buffer, offset, ticks_ms(), flags, interface,
+                             int(rssi) if rssi != None else CAPTURE_UNKNOWN,
+                             int(snr * 4) if snr != None else CAPTURE_UNKNOWN, length)
+            offset += CAPTURE_RECORD_LEN
+            self._buffer[offset:offset + length] = frame[:length]
+            self._fill = offset + length
+            self._frames += 1
+
+    # Write out what has been captured.  The buffers swap so capture goes on meanwhile.
+    def flush(self):
+        with self._lock:
+            buffer, fill = self._buffer, self._fill
+            self._buffer, self._spare = self._spare, buffer
+            self._fill = 0
+
+        if fill != 0:
+            self._stream.write(memoryview(buffer)[0:fill])
+            if hasattr(self._stream, 'flush'):
+                self._stream.flush()
+
+    def run(self):
+        while self.running:
+            sleep(self._interval)
+            self.flush()
+
+        self.flush()
+        return 0
+
+    def frames(self):
+        return self._frames
+
+    def dropped(self):
+        return self._dropped
+
+    def __str__(self):
+        return "Capture F=%d D=%d" % (self._frames, self._dropped)
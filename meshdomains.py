@@ -3,6 +3,9 @@
 #
 # Defines the channels and data rates available for communication
 #
+# The driver compiles an entry into register tables (sx127x.compile_domain); use
+# sx127x.load_domain to keep the compiled table on flash between boots.
+#
 
 US902_MESHNET = {
     'freq_range':
@@ -19,26 +22,104 @@ US902_MESHNET = {
     # <rate>: {
     #    'sf': <spreading factor>,
     #    'bw': <bandwidth>,
-    #    'tx': <tx power limit>,   # Not yet used
-    #    'n': <max user payload>,  # Not yet used
-    #    'm': <max total bytes>,   # Not yet used
+    #    'tx': <tx power limit>,   # dBm, or (dBm, "PA"|"RFO")
+    #    'n': <max user payload>,  # Informational; the driver only enforces 'm'
+    #    'm': <max total bytes>,
     # }
     'data_rates': {
         # Most to least reliable order
         # Narrow band
-        0:  { 'sf': 10, 'bw': 125e6, 'tx': 30, 'n': 11,  'm': 19  },
-        1:  { 'sf': 9,  'bw': 125e6, 'tx': 28, 'n': 53,  'm': 61  },
-        2:  { 'sf': 8,  'bw': 125e6, 'tx': 26, 'n': 124, 'm': 133 },
-        3:  { 'sf': 7,  'bw': 125e6, 'tx': 24, 'n': 242, 'm': 250 },
-        4:  { 'sf': 6,  'bw': 125e6, 'tx': 20, 'n': 255, 'm': 255 },
+        0:  { 'sf': 10, 'bw': 125e3, 'tx': 30, 'n': 11,  'm': 19  },
+        1:  { 'sf': 9,  'bw': 125e3, 'tx': 28, 'n': 53,  'm': 61  },
+        2:  { 'sf': 8,  'bw': 125e3, 'tx': 26, 'n': 124, 'm': 133 },
+        3:  { 'sf': 7,  'bw': 125e3, 'tx': 24, 'n': 242, 'm': 250 },
+        4:  { 'sf': 6,  'bw': 125e3, 'tx': 20, 'n': 255, 'm': 255 },
+
+        # Wide band
+        8:  { 'sf': 12, 'bw': 500e3, 'tx': 14, 'n': 33,  'm': 41  },
+        9:  { 'sf': 11, 'bw': 500e3, 'tx': 12, 'n': 109, 'm': 117 },
+        10: { 'sf': 10, 'bw': 500e3, 'tx': 10, 'n': 220, 'm': 230 },
+        11: { 'sf': 9,  'bw': 500e3, 'tx': 8,  'n': 220, 'm': 230 },
+        12: { 'sf': 8,  'bw': 500e3, 'tx': 6,  'n': 220, 'm': 230 },
+        13: { 'sf': 7,  'bw': 500e3, 'tx': 4,  'n': 220, 'm': 230 },
+    },
+}
+
+
+EU868_MESHNET = {
+    'freq_range':
+        (863000000, 870000000),
+
+    'channels': (
+        { 'chan': (0, 2),   'dr': (0, 5),   'freq': (868100000, 200000)  },
+        { 'chan': (3, 7),   'dr': (0, 5),   'freq': (867100000, 200000)  },
+        { 'chan': (8, 8),   'dr': (6, 6),   'freq': (868300000, 0)       },
+    ),
+
+    'data_rates': {
+        # Most to least reliable order
+        # Narrow band
+        0:  { 'sf': 12, 'bw': 125e3, 'tx': 14, 'n': 51,  'm': 59  },
+        1:  { 'sf': 11, 'bw': 125e3, 'tx': 14, 'n': 51,  'm': 59  },
+        2:  { 'sf': 10, 'bw': 125e3, 'tx': 14, 'n': 51,  'm': 59  },
+        3:  { 'sf': 9,  'bw': 125e3, 'tx': 14, 'n': 115, 'm': 123 },
+        4:  { 'sf': 8,  'bw': 125e3, 'tx': 14, 'n': 242, 'm': 250 },
+        5:  { 'sf': 7,  'bw': 125e3, 'tx': 14, 'n': 242, 'm': 250 },
+
+        # Wide band
+        6:  { 'sf': 7,  'bw': 250e3, 'tx': 14, 'n': 242, 'm': 250 },
+    },
+}
+
+AS923_MESHNET = {
+    'freq_range':
+        (915000000, 928000000),
+
+    'channels': (
+        { 'chan': (0, 7),   'dr': (0, 5),   'freq': (922000000, 200000)  },
+        { 'chan': (8, 8),   'dr': (6, 6),   'freq': (922100000, 0)       },
+    ),
+
+    'data_rates': {
+        # Most to least reliable order
+        # Narrow band
+        0:  { 'sf': 12, 'bw': 125e3, 'tx': 16, 'n': 51,  'm': 59  },
+        1:  { 'sf': 11, 'bw': 125e3, 'tx': 16, 'n': 51,  'm': 59  },
+        2:  { 'sf': 10, 'bw': 125e3, 'tx': 16, 'n': 115, 'm': 123 },
+        3:  { 'sf': 9,  'bw': 125e3, 'tx': 16, 'n': 115, 'm': 123 },
+        4:  { 'sf': 8,  'bw': 125e3, 'tx': 16, 'n': 242, 'm': 250 },
+        5:  { 'sf': 7,  'bw': 125e3, 'tx': 16, 'n': 242, 'm': 250 },
 
         # Wide band
-        8:  { 'sf': 12, 'bw': 500e6, 'tx': 14, 'n': 33,  'm': 41  },
-        9:  { 'sf': 11, 'bw': 500e6, 'tx': 12, 'n': 109, 'm': 117 },
-        10: { 'sf': 10, 'bw': 500e6, 'tx': 10, 'n': 220, 'm': 230 },
-        11: { 'sf': 9,  'bw': 500e6, 'tx': 8,  'n': 220, 'm': 230 },
-        12: { 'sf': 8,  'bw': 500e6, 'tx': 6,  'n': 220, 'm': 230 },
-        13: { 'sf': 7,  'bw': 500e6, 'tx': 4,  'n': 220, 'm': 230 },
+        6:  { 'sf': 7,  'bw': 250e3, 'tx': 16, 'n': 242, 'm': 250 },
     },
 }
 
+AU915_MESHNET = {
+    'freq_range':
+        (915000000, 928000000),
+
+    'channels': (
+        { 'chan': (0,  63), 'dr': (0, 5),   'freq': (915200000, 200000)  },
+        { 'chan': (64, 71), 'dr': (8, 13),  'freq': (915900000, 1600000) },
+    ),
+
+    'data_rates': {
+        # Most to least reliable order
+        # Narrow band
+        0:  { 'sf': 12, 'bw': 125e3, 'tx': 20, 'n': 51,  'm': 59  },
+        1:  { 'sf': 11, 'bw': 125e3, 'tx': 20, 'n': 51,  'm': 59  },
+        2:  { 'sf': 10, 'bw': 125e3, 'tx': 20, 'n': 51,  'm': 59  },
+        3:  { 'sf': 9,  'bw': 125e3, 'tx': 20, 'n': 115, 'm': 123 },
+        4:  { 'sf': 8,  'bw': 125e3, 'tx': 20, 'n': 242, 'm': 250 },
+        5:  { 'sf': 7,  'bw': 125e3, 'tx': 20, 'n': 242, 'm': 250 },
+
+        # Wide band
+        8:  { 'sf': 12, 'bw': 500e3, 'tx': 20, 'n': 53,  'm': 61  },
+        9:  { 'sf': 11, 'bw': 500e3, 'tx': 20, 'n': 129, 'm': 137 },
+        10: { 'sf': 10, 'bw': 500e3, 'tx': 20, 'n': 242, 'm': 250 },
+        11: { 'sf': 9,  'bw': 500e3, 'tx': 20, 'n': 242, 'm': 250 },
+        12: { 'sf': 8,  'bw': 500e3, 'tx': 20, 'n': 242, 'm': 250 },
+        13: { 'sf': 7,  'bw': 500e3, 'tx': 20, 'n': 242, 'm': 250 },
+    },
+}
@@ -0,0 +1,408 @@
+#
+# Metrics registry
+#
+# Counters, gauges and fixed-bucket histograms kept in arrays allocated when
+# they are registered, so updating them from interrupt handlers allocates
+# nothing.  Labels (protocol, neighbor, ...) map onto a bounded number of
+# slots; values seen after the slots are used up are counted under "other".
+#
+# IrqProfile times interrupt handlers and AllocProfile counts heap allocation by
+# packet path; see their descriptions below.
+#
+# Everything that reports statistics (display, web server, serial bridge)
+# reads Metrics.snapshot().
+#
+from array import array
+from time import ticks_us, ticks_diff
+import gc
+import struct
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+# Snapshot key of the overflow slot of a labelled metric
+OTHER_LABEL = "other"
+
+# Label values mapped to slots 0..limit-1; slot <limit> takes the rest
+class Labels():
+    def __init__(self, limit):
+        self._limit = limit
+        self._slots = {}
+
+    def limit(self):
+        return self._limit
+
+    def slot(self, label):
+        slot = self._slots.get(label)
+        if slot == None:
+            if len(self._slots) >= self._limit:
+                return self._limit
+            slot = len(self._slots)
+            self._slots[label] = slot
+        return slot
+
+    # (label, slot) pairs in use
+    def items(self):
+        return self._slots.items()
+
+class Counter():
+    def __init__(self, name, labels=None):
+        self._name = name
+        self._labels = labels
+        self._values = array('L', [0] * (labels.limit() + 1 if labels else 1))
+
+    def name(self):
+        return self._name
+
+    def inc(self, label=None, amount=1):
+        slot = self._labels.slot(label) if self._labels else 0
+        self._values[slot] += amount
+
+    # Sum over all labels
+    def total(self):
+        return sum(self._values)
+
+    def value(self, label=None):
+        return self._values[self._labels.slot(label) if self._labels else 0]
+
+    def snapshot(self):
+        if not self._labels:
+            return self._values[0]
+
+        values = { 'total': self.total() }
+        for label, slot in self._labels.items():
+            values[str(label)] = self._values[slot]
+        if self._values[self._labels.limit()] != 0:
+            values[OTHER_LABEL] = self._values[self._labels.limit()]
+        return values
+
+# A level set by its owner, or read from <read> when a snapshot is taken
+class Gauge():
+    def __init__(self, name, read=None):
+        self._name = name
+        self._read = read
+        self._value = 0
+
+    def name(self):
+        return self._name
+
+    def set(self, value):
+        self._value = value
+
+    def value(self):
+        return self._read() if self._read else self._value
+
+    def snapshot(self):
+        return self.value()
+
+# Count of observations at or below each of <bounds> (ascending) plus one
+# bucket for those above the last
+class Histogram():
+    def __init__(self, name, bounds):
+        self._name = name
+        self._bounds = tuple(bounds)
+        self._counts = array('L', [0] * (len(self._bounds) + 1))
+        self.clear()
+
+    def name(self):
+        return self._name
+
+    def clear(self):
+        for bucket in range(len(self._counts)):
+            self._counts[bucket] = 0
+        self._sum = 0
+        self._min = None
+        self._max = None
+
+    def observe(self, value):
+        bucket = 0
+        for bound in self._bounds:
+            if value <= bound:
+                break
+            bucket += 1
+        self._counts[bucket] += 1
+        self._sum += value
+        if self._min == None or value < self._min:
+            self._min = value
+        if self._max == None or value > self._max:
+            self._max = value
+
+    def count(self):
+        return sum(self._counts)
+
+    def mean(self):
+        count = self.count()
+        return self._sum / count if count else None
+
+    def min(self):
+        return self._min
+
+    def max(self):
+        return self._max
+
+    # Upper bound of the bucket holding the <fraction> point of the observations;
+    # the largest seen when that is past the last bound
+    def percentile(self, fraction):
+        count = self.count()
+        if count == 0:
+            return None
+        wanted = fraction * count
+        seen = 0
+        for bucket in range(len(self._bounds)):
+            seen += self._counts[bucket]
+            if seen >= wanted:
+                return min(self._bounds[bucket], self._max)
+        return self._max
+
+    def snapshot(self):
+        return {
+            'bounds': list(self._bounds),
+            'counts': list(self._counts),
+            'count':  self.count(),
+            'sum':    self._sum,
+            'min':    self._min,
+            'max':    self._max,
+        }
+
+# Timing of one interrupt handler in microseconds: delay from the DIO edge to the
+# handler starting, time in the handler, and time waiting for the driver lock.
+# Runs that take longer than <outlier> are kept with the first bytes of their frame.
+#
+#    profile.enter(edge)                   At handler start; <edge> is ticks_us of the edge or None
+#    with profile.locking(lock):           In place of 'with lock:'
+#    profile.leave(frame)                  At handler end with the frame handled, if any
+#
+_IRQ_BOUNDS          = (25, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+_OUTLIER_FORMAT      = "<IiII"       # ticks_us, delay (-1 unknown), duration, lock wait
+_OUTLIER_FRAME       = const(16)     # Offset of frame bytes in an outlier record
+_OUTLIER_FRAME_LEN   = const(12)     # Frame bytes kept: enough for the mesh header
+_OUTLIER_LEN         = const(29)     # Record length: fields, frame length, frame bytes
+
+class IrqProfile():
+    def __init__(self, name, outlier=2000, outliers=8):
+        self._name = name
+        self._outlier = outlier
+        self.delay = Histogram(name + ".delay_us", _IRQ_BOUNDS)
+        self.duration = Histogram(name + ".duration_us", _IRQ_BOUNDS)
+        self.lock_wait = Histogram(name + ".lock_us", _IRQ_BOUNDS)
+        self._outliers = bytearray(outliers * _OUTLIER_LEN)
+        self._outlier_slots = outliers
+        self._outlier_count = 0
+        self._lock = None
+        self._start = 0
+        self._edge_delay = None
+        self._waited = 0
+
+    def name(self):
+        return self._name
+
+    def enter(self, edge=None):
+        self._start = ticks_us()
+        self._edge_delay = ticks_diff(self._start, edge) if edge != None else None
+        self._waited = 0
+
+    def locking(self, lock):
+        self._lock = lock
+        return self
+
+    def __enter__(self):
+        started = ticks_us()
+        self._lock.acquire()
+        self._waited += ticks_diff(ticks_us(), started)
+
+    def __exit__(self, type, value, traceback):
+        self._lock.release()
+
+    def leave(self, frame=None):
+        duration = ticks_diff(ticks_us(), self._start)
+        if self._edge_delay != None:
+            self.delay.observe(self._edge_delay)
+        self.duration.observe(duration)
+        self.lock_wait.observe(self._waited)
+
+        if duration >= self._outlier or (self._edge_delay != None and self._edge_delay >= self._outlier):
+            self._keep(duration, frame)
+
+    # Store an outlier in the ring, overwriting the oldest
+    def _keep(self, duration, frame):
+        offset = (self._outlier_count % self._outlier_slots) * _OUTLIER_LEN
+        self._outlier_count += 1
+        records = self._outliers
+        struct.pack_into(_OUTLIER_FORMAT, records, offset, self._start, self._edge_delay if self._edge_delay != None else -1, duration, self._waited)
+        length = min(len(frame), _OUTLIER_FRAME_LEN) if frame else 0
+        records[offset + _OUTLIER_FRAME] = length
+        for item in range(_OUTLIER_FRAME_LEN):
+            records[offset + _OUTLIER_FRAME + 1 + item] = frame[item] if item < length else 0
+
+    # Kept outliers oldest first as (ticks_us, delay or None, duration, lock wait, frame bytes)
+    def outliers(self):
+        outliers = []
+        first = max(0, self._outlier_count - self._outlier_slots)
+        for index in range(first, self._outlier_count):
+            offset = (index % self._outlier_slots) * _OUTLIER_LEN
+            ticks, delay, duration, waited = struct.unpack_from(_OUTLIER_FORMAT, self._outliers, offset)
+            length = self._outliers[offset + _OUTLIER_FRAME]
+            frame = bytes(self._outliers[offset + _OUTLIER_FRAME + 1:offset + _OUTLIER_FRAME + 1 + length])
+            outliers.append((ticks, delay if delay >= 0 else None, duration, waited, frame))
+        return outliers
+
+    def clear(self):
+        self.delay.clear()
+        self.duration.clear()
+        self.lock_wait.clear()
+        self._outlier_count = 0
+
+    def snapshot(self):
+        return {
+            'delay_us':    _summary(self.delay),
+            'duration_us': _summary(self.duration),
+            'lock_us':     _summary(self.lock_wait),
+            'outliers':    self._outlier_count,
+            'recent':      [ (duration, delay, waited, ''.join("%02x" % byte for byte in frame))
+                             for ticks, delay, duration, waited, frame in self.outliers() ],
+        }
+
+# Count, range, mean and percentiles of <histogram>
+def _summary(histogram):
+    return {
+        'count': histogram.count(),
+        'min':   histogram.min(),
+        'mean':  histogram.mean(),
+        'max':   histogram.max(),
+        'p50':   histogram.percentile(0.5),
+        'p90':   histogram.percentile(0.9),
+        'p99':   histogram.percentile(0.99),
+    }
+
+# Bytes allocated on each packet path, by protocol, from gc.mem_alloc() before and after.
+#
+#    start = profile.begin()
+#    ...                                   The path
+#    profile.end(ALLOC_RX_WRAP, start, packet.protocol())
+#
+# Figures include what paths called from the path allocate (processing a packet
+# includes sending the reply) and what other threads allocate meanwhile.  A path
+# run that saw a collection gives no figure and is counted under 'collected'.
+ALLOC_RX_READ       = const(0)    # FIFO read and metadata in the receive interrupt
+ALLOC_RX_WRAP       = const(1)    # Header expansion, slicing and wrapping as a Packet
+ALLOC_RX_DEBUG      = const(2)    # Formatting of debug output
+ALLOC_RX_PROCESS    = const(3)    # Protocol handler
+ALLOC_TX_SEND       = const(4)    # send_packet: routing and queueing
+ALLOC_TX_QUEUE      = const(5)    # Transmit queue, aggregation and interface choice
+ALLOC_TX_ENCODE     = const(6)    # Frame encoding and header compression
+ALLOC_TIMER         = const(7)    # Per-packet timer threads
+
+ALLOC_PATHS = ( "rx-read", "rx-wrap", "rx-debug", "rx-process", "tx-send", "tx-queue", "tx-encode", "timer" )
+
+class AllocProfile():
+    def __init__(self, name, labels=16):
+        self._name = name
+        self._labels = Labels(labels)
+        self._width = labels + 1
+        size = len(ALLOC_PATHS) * self._width
+        self._bytes = array('L', [0] * size)
+        self._counts = array('L', [0] * size)
+        self._max = array('L', [0] * size)
+        self._collected = 0
+
+    def name(self):
+        return self._name
+
+    def begin(self):
+        return gc.mem_alloc()
+
+    def end(self, path, start, label=None):
+        allocated = gc.mem_alloc() - start
+        if allocated < 0:
+            self._collected += 1
+            return
+
+        slot = path * self._width + self._labels.slot(label)
+        self._bytes[slot] += allocated
+        self._counts[slot] += 1
+        if allocated > self._max[slot]:
+            self._max[slot] = allocated
+
+    def clear(self):
+        for slot in range(len(self._bytes)):
+            self._bytes[slot] = 0
+            self._counts[slot] = 0
+            self._max[slot] = 0
+        self._collected = 0
+
+    # (bytes, runs, largest run, path, label) of every path and label seen, most bytes first
+    def ranked(self):
+        labels = list(self._labels.items()) + [ (OTHER_LABEL, self._labels.limit()) ]
+        ranked = []
+        for path in range(len(ALLOC_PATHS)):
+            for label, slot in labels:
+                slot += path * self._width
+                if self._counts[slot] != 0:
+                    ranked.append((self._bytes[slot], self._counts[slot], self._max[slot], ALLOC_PATHS[path], label))
+        ranked.sort(key=lambda entry: entry[0], reverse=True)
+        return ranked
+
+    # Text lines of the ranking
+    def lines(self):
+        lines = [ "%10s %8s %8s %8s  %-10s %s" % ("bytes", "runs", "mean", "max", "path", "protocol") ]
+        for allocated, runs, largest, path, label in self.ranked():
+            lines.append("%10d %8d %8d %8d  %-10s %s" % (allocated, runs, allocated // runs, largest, path, "-" if label == None else label))
+        if self._collected:
+            lines.append("%d runs lost to collections" % self._collected)
+        return lines
+
+    def dump(self, write=print):
+        for line in self.lines():
+            write(line)
+
+    def snapshot(self):
+        return {
+            'collected': self._collected,
+            'ranked':    [ { 'path': path, 'protocol': label, 'bytes': allocated, 'runs': runs, 'max': largest }
+                           for allocated, runs, largest, path, label in self.ranked() ],
+        }
+
+class Metrics():
+    def __init__(self):
+        self._metrics = {}
+
+    # Return the metric <name>, registering it with <create>() if new.  Radios sharing
+    # a registry share their metrics.
+    def _register(self, name, create):
+        metric = self._metrics.get(name)
+        if metric == None:
+            metric = create()
+            self._metrics[name] = metric
+        return metric
+
+    def counter(self, name, labels=None):
+        return self._register(name, lambda: Counter(name, Labels(labels) if labels else None))
+
+    def gauge(self, name, read=None):
+        return self._register(name, lambda: Gauge(name, read))
+
+    def histogram(self, name, bounds):
+        return self._register(name, lambda: Histogram(name, bounds))
+
+    def irq_profile(self, name, outlier=2000):
+        return self._register(name, lambda: IrqProfile(name, outlier))
+
+    def alloc_profile(self, name, labels=16):
+        return self._register(name, lambda: AllocProfile(name, labels))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def names(self):
+        names = list(self._metrics)
+        names.sort()
+        return names
+
+    # Dict of every metric's current value by name
+    def snapshot(self):
+        return { name: self._metrics[name].snapshot() for name in self._metrics }
+
+    # One 'name value' text line per metric, by name
+    def lines(self):
+        return [ "%s %s" % (name, self._metrics[name].snapshot()) for name in self.names() ]
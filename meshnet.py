@@ -3,11 +3,16 @@
 #
 
 import gc
-from time import sleep, time
+import micropython
+import umemory
+from time import sleep, time, ticks_ms, ticks_us, ticks_diff, ticks_add
 from ulock import *
 from uqueue import *
-from uthread import thread, timer
+from uthread import thread
 from sx127x import SX127x_driver as RadioDriver
+from meshtrace import *
+from meshcapture import Capture, CAPTURE_TX, CAPTURE_CRC_ERROR, CAPTURE_IMPLICIT
+from meshmetrics import ALLOC_RX_WRAP, ALLOC_RX_DEBUG, ALLOC_RX_PROCESS, ALLOC_TX_SEND, ALLOC_TX_QUEUE, ALLOC_TX_ENCODE, ALLOC_TIMER
 from machine import SPI, Pin
 
 _SX127x_DIO0  = const(26)   # DIO0 interrupt pin
@@ -35,6 +40,45 @@ _ANNOUNCE_INTERVAL_DEFAULT        = const(15000)   # 15 seconds
 _REPLY_TIMEOUT                    = 5.0
 _ROUTEREQUEST_TIMEOUT             = 5.0
 _ROUTEREQUEST_RETRIES             = 5
+_MAX_NEIGHBORS                    = const(32)
+_NEIGHBOR_LIFETIME                = 120.0          # Seconds without hearing from a neighbor before it is dropped
+_LINK_ACK_RETRIES                 = const(3)       # Retransmissions before link is declared failed
+_LINK_ACK_TIMEOUT                 = const(2000)    # Initial retransmit timeout in ms (before any RTT samples)
+_LINK_ACK_TIMEOUT_MIN             = const(250)     # Lower bound of adaptive retransmit timeout in ms
+_LINK_ACK_TIMEOUT_MAX             = const(16000)   # Upper bound of adaptive retransmit timeout in ms
+_LINK_ACK_POLL                    = 0.1            # Interval of maintenance thread when link acks are enabled
+_LINK_ACK_TURNAROUND              = const(100)     # ms allowed beyond airtime for the next hop to start its acks
+_LINK_SEQUENCE_WINDOW             = const(8)       # Recent link sequences remembered per neighbor for duplicates
+_ADR_INTERVAL                     = 10.0           # Seconds between listen datarate evaluations
+_ADR_MARGIN                       = 10.0           # dB of SNR/RSSI headroom required above demodulator limit
+_ADR_HYSTERESIS                   = 3.0            # Extra dB needed before moving to a faster datarate
+_ADR_WEIGHT                       = const(4)       # SNR/RSSI average weight (1/N of new sample)
+_BEACON_INTERVAL                  = 30.0           # Seconds between beacons when ADR or multichannel is enabled
+_BEACON_SKEW                      = const(2)       # Most whole seconds added to a beacon interval so neighbors do not stay in step
+_RENDEZVOUS_MARGIN                = 2.0            # Seconds beyond a beacon interval on the control channel after start (at least _BEACON_SKEW)
+_TDMA_SLOTS                       = const(16)      # Slots per TDMA frame
+_TDMA_SLOT_TIME                   = const(500)     # ms per slot
+_TDMA_GUARD                       = const(20)      # ms kept clear at the end of each slot
+_TIME_SOURCE_LIFETIME             = 120.0          # Seconds before an unheard time source is replaced
+_CLOCK_DRIFT_MAX                  = const(200)     # Largest believable clock drift in ppm
+_CLOCK_DRIFT_WEIGHT               = const(4)       # Drift average weight (1/N of new estimate)
+_AGGREGATE_HOLD                   = 0.0            # Seconds a lone packet waits for company before sending
+_REASSEMBLY_TIMEOUT               = 30.0           # Seconds to wait for the rest of a fragmented packet
+_REASSEMBLY_MAX_MESSAGES          = const(4)       # Fragmented packets reassembled at once
+_REASSEMBLY_MAX_BYTES             = const(4096)    # Memory allowed for all reassembly buffers
+_SCAN_INTERVAL                    = 5.0            # Seconds between noise samples of the next channel
+_SCAN_SAMPLES                     = const(8)       # RSSI readings per channel sample
+_SCAN_BINS                        = const(16)      # Noise histogram bins per channel
+_SCAN_FLOOR                       = const(-140)    # dBm at bottom of the lowest bin
+_SCAN_BIN_WIDTH                   = const(4)       # dB per bin
+_SCAN_PERCENTILE                  = 0.9            # Channels are compared by the level this share of samples stay below
+_SCAN_HYSTERESIS                  = 6.0            # dB quieter another channel must be before the mesh moves
+_CHANNEL_MIGRATE_DELAY            = 10.0           # Seconds from a channel change announce to switching
+_METRICS_PROTOCOLS                = const(16)      # Protocols counted separately
+_METRICS_SIZE_BOUNDS              = (16, 32, 64, 128, 192, 255)              # Received frame size histogram buckets
+_METRICS_LATENCY_BOUNDS           = (10, 50, 100, 250, 500, 1000, 5000)      # Queue to sent histogram buckets in ms
+_DATARATE_UNKNOWN                 = const(0xFF)
+_CHANNEL_UNKNOWN                  = const(0xFF)
 
 # Lengths of various fields in packets
 _PROTOCOL_LEN                     = const(1)
@@ -46,6 +90,14 @@ _METRIC_LEN                       = const(1)
 _TTL_LEN                          = const(1)
 _BEACON_NAME_LEN                  = const(16)
 _REASON_LEN                       = const(1)
+_MAX_PACKET_LENGTH                = const(255)
+_DATARATE_LEN                     = const(1)
+_CHANNEL_LEN                      = const(1)
+_LISTEN_INTERVAL_LEN              = const(2)
+_TIME_LEN                         = const(4)
+_AGGREGATE_ITEM_LEN               = const(1)
+_FRAGMENT_INDEX_LEN               = const(1)
+_LINK_SEQUENCE_LEN                = const(2)
 
 # Helper functions used to build packet field items
 def create_field(len, origin=0):
@@ -59,6 +111,10 @@ def create_field(len, origin=0):
 def end_field(field):
     return field[0] + field[1]
 
+# True if route <sequence> is later than <current>, allowing for the field wrapping around
+def sequence_newer(sequence, current):
+    return 0 < (sequence - current) % (1 << (8 * _SEQUENCE_NUMBER_LEN)) < (1 << (8 * _SEQUENCE_NUMBER_LEN - 1))
+
 
 #########################################################################
 # Supporting classes
@@ -96,7 +152,7 @@ class FieldRef(object):
 
         elif type(value) == str or type(value) == bytearray:
             # Convert string to bytes
-            v = bytearray(value)
+            v = bytearray(value.encode() if type(value) == str else value)
 
             # Extend to width of destination field
             if len(v) < field[1]:
@@ -149,6 +205,141 @@ _HEADER_TTL                 = create_field(_TTL_LEN, _HEADER_PROTOCOL)
 _HEADER_LENGTH              = end_field(_HEADER_TTL)
 _HEADER_PAYLOAD             = _HEADER_LENGTH
 
+# On the air, the high bit of the protocol byte flags a frame that wants a link ack.
+# The link sequence number to acknowledge is appended to the end of such a frame.
+# Protocols carried with link acks must therefore be below 0x80.
+_PROTOCOL_ACK_REQUEST           = const(0x80)
+
+# Protocols below this are the mesh's own packets (Beacon through Fragment, with room to
+# grow).  DataPacket may use _PROTOCOL_RESERVED up to but not including _PROTOCOL_ACK_REQUEST.
+_PROTOCOL_RESERVED              = const(8)
+
+# Raise unless <protocol> is free for a DataPacket
+def check_data_protocol(protocol):
+    if protocol < _PROTOCOL_RESERVED or protocol & _PROTOCOL_ACK_REQUEST:
+        raise MeshNetException("Data protocol must be %d to %d: %d" % (_PROTOCOL_RESERVED, _PROTOCOL_ACK_REQUEST - 1, protocol))
+
+#
+# Compressed header (when enabled mesh-wide).  A flags byte is followed by only the
+# fields that cannot be inferred, in header order:
+#    [nexthop] [target] previous [source] (ttl << 4 | protocol) or (protocol, ttl)
+#
+_COMPRESS_FLAGS_LEN             = const(1)
+_COMPRESS_NEXTHOP_BROADCAST     = const(0x01)   # nexthop is BROADCAST_ADDRESS
+_COMPRESS_TARGET_IS_NEXTHOP     = const(0x02)   # target == nexthop
+_COMPRESS_SOURCE_IS_PREVIOUS    = const(0x04)   # source == previous
+_COMPRESS_SHORT_TTL             = const(0x08)   # ttl and protocol both below 16; one byte
+_COMPRESS_ACK_REQUEST           = const(0x10)   # replaces _PROTOCOL_ACK_REQUEST
+_COMPRESS_RESERVED              = const(0xE0)
+
+# Size of compressed header for the given field values
+def compressed_header_length(nexthop, target, previous, source, protocol, ttl):
+    length = _COMPRESS_FLAGS_LEN + _ADDRESS_LEN
+    if nexthop != BROADCAST_ADDRESS:
+        length += _ADDRESS_LEN
+    if target != nexthop:
+        length += _ADDRESS_LEN
+    if source != previous:
+        length += _ADDRESS_LEN
+    return length + (_TTL_LEN if (protocol & ~_PROTOCOL_ACK_REQUEST) < 16 and ttl < 16 else _TTL_LEN + _PROTOCOL_LEN)
+
+# Convert a frame with a full header to one with a compressed header
+def compress_header(data):
+    frame = bytearray(_COMPRESS_FLAGS_LEN)
+    flags = 0
+
+    nexthop = data[_HEADER_NEXTHOP[0]:end_field(_HEADER_NEXTHOP)]
+    target = data[_HEADER_TARGET[0]:end_field(_HEADER_TARGET)]
+    previous = data[_HEADER_PREVIOUS[0]:end_field(_HEADER_PREVIOUS)]
+    source = data[_HEADER_SOURCE[0]:end_field(_HEADER_SOURCE)]
+    protocol = data[_HEADER_PROTOCOL[0]]
+    ttl = data[_HEADER_TTL[0]]
+
+    if nexthop == b'\xff\xff':
+        flags |= _COMPRESS_NEXTHOP_BROADCAST
+    else:
+        frame.extend(nexthop)
+
+    if target == nexthop:
+        flags |= _COMPRESS_TARGET_IS_NEXTHOP
+    else:
+        frame.extend(target)
+
+    frame.extend(previous)
+
+    if source == previous:
+        flags |= _COMPRESS_SOURCE_IS_PREVIOUS
+    else:
+        frame.extend(source)
+
+    if protocol & _PROTOCOL_ACK_REQUEST:
+        flags |= _COMPRESS_ACK_REQUEST
+        protocol &= ~_PROTOCOL_ACK_REQUEST
+
+    if protocol < 16 and ttl < 16:
+        flags |= _COMPRESS_SHORT_TTL
+        frame.append((ttl << 4) | protocol)
+    else:
+        frame.append(protocol)
+        frame.append(ttl)
+
+    frame[0] = flags
+    frame.extend(memoryview(data)[_HEADER_PAYLOAD:])
+    return frame
+
+# Convert a frame with a compressed header back to a full header.  None if malformed.
+def expand_header(frame):
+    if len(frame) < _COMPRESS_FLAGS_LEN or frame[0] & _COMPRESS_RESERVED:
+        return None
+
+    flags = frame[0]
+    index = _COMPRESS_FLAGS_LEN
+    data = bytearray(_HEADER_LENGTH)
+
+    try:
+        if flags & _COMPRESS_NEXTHOP_BROADCAST:
+            data[_HEADER_NEXTHOP[0]:end_field(_HEADER_NEXTHOP)] = b'\xff\xff'
+        else:
+            data[_HEADER_NEXTHOP[0]:end_field(_HEADER_NEXTHOP)] = frame[index:index + _ADDRESS_LEN]
+            index += _ADDRESS_LEN
+
+        if flags & _COMPRESS_TARGET_IS_NEXTHOP:
+            data[_HEADER_TARGET[0]:end_field(_HEADER_TARGET)] = data[_HEADER_NEXTHOP[0]:end_field(_HEADER_NEXTHOP)]
+        else:
+            data[_HEADER_TARGET[0]:end_field(_HEADER_TARGET)] = frame[index:index + _ADDRESS_LEN]
+            index += _ADDRESS_LEN
+
+        data[_HEADER_PREVIOUS[0]:end_field(_HEADER_PREVIOUS)] = frame[index:index + _ADDRESS_LEN]
+        index += _ADDRESS_LEN
+
+        if flags & _COMPRESS_SOURCE_IS_PREVIOUS:
+            data[_HEADER_SOURCE[0]:end_field(_HEADER_SOURCE)] = data[_HEADER_PREVIOUS[0]:end_field(_HEADER_PREVIOUS)]
+        else:
+            data[_HEADER_SOURCE[0]:end_field(_HEADER_SOURCE)] = frame[index:index + _ADDRESS_LEN]
+            index += _ADDRESS_LEN
+
+        if flags & _COMPRESS_SHORT_TTL:
+            data[_HEADER_TTL[0]] = frame[index] >> 4
+            data[_HEADER_PROTOCOL[0]] = frame[index] & 0x0F
+            index += _TTL_LEN
+        else:
+            data[_HEADER_PROTOCOL[0]] = frame[index]
+            data[_HEADER_TTL[0]] = frame[index + _PROTOCOL_LEN]
+            index += _PROTOCOL_LEN + _TTL_LEN
+
+    except IndexError:
+        return None
+
+    # Short frames leave the header partly zero-filled by slicing; reject them
+    if index > len(frame):
+        return None
+
+    if flags & _COMPRESS_ACK_REQUEST:
+        data[_HEADER_PROTOCOL[0]] |= _PROTOCOL_ACK_REQUEST
+
+    data.extend(memoryview(frame)[index:])
+    return data
+
 def ADDR_OF(addr):
     if addr == 0:
         return "NULL"
@@ -170,6 +361,11 @@ class Packet(FieldRef):
 
         self._rssi = None
         self._promiscuous = False
+        self._link_sequence = None
+        self._channel = None
+        self._datarate = None
+        self._implicit = False
+        self._queued = None
 
         # Set defaults if no origin data
         if 'load' not in kwargs:
@@ -186,6 +382,9 @@ class Packet(FieldRef):
         # RSSI of receiver if present
         self.rssi(kwargs['rssi'] if 'rssi' in kwargs else None)
 
+        # Receiver link data (RxMetadata) if present
+        self._metadata = kwargs['metadata'] if 'metadata' in kwargs else None
+
 
     def __str__(self):
         return "Packet N=%s P=%s T=%s S=%s TTL=%d Proto=%d Len=%d" % (ADDR_OF(self.nexthop()), ADDR_OF(self.previous()), ADDR_OF(self.target()), ADDR_OF(self.source()), self.ttl(), self.protocol(), len(self.data()))
@@ -200,6 +399,42 @@ class Packet(FieldRef):
             self._rssi = value
         return self._rssi
 
+    # RxMetadata of the frame this packet arrived in
+    def metadata(self, value=None):
+        if value != None:
+            self._metadata = value
+        return self._metadata
+
+    # Channel to transmit this packet on (None for listening channel)
+    def channel(self, value=None):
+        if value != None:
+            self._channel = value
+        return self._channel
+
+    # Datarate to transmit this packet at (None for channel datarate)
+    def datarate(self, value=None):
+        if value != None:
+            self._datarate = value
+        return self._datarate
+
+    # True if this packet is sent (or was received) as an implicit header control frame
+    def implicit(self, value=None):
+        if value != None:
+            self._implicit = value
+        return self._implicit
+
+    # Link sequence number if this packet is sent with link ack requested
+    def link_sequence(self, value=None):
+        if value != None:
+            self._link_sequence = value
+        return self._link_sequence
+
+    # ticks_ms when last put on a transmit queue
+    def queued(self, value=None):
+        if value != None:
+            self._queued = value
+        return self._queued
+
     def nexthop(self, value=None):
         return self._field(_HEADER_NEXTHOP, value) 
 
@@ -218,14 +453,26 @@ class Packet(FieldRef):
     def protocol(self, value=None):
         return self._field(_HEADER_PROTOCOL, value)
 
+    # Size of the header of this packet when compressed
+    def compressed_header_length(self):
+        return compressed_header_length(self.nexthop(), self.target(), self.previous(), self.source(), self.protocol(), self.ttl())
+
     def process(self, parent):
         raise MeshNetException("Packet.process is not callable")
 
 #########################################################################
 # Beacon packet
 #########################################################################
+#
+# Beacons are broadcast to direct neighbors only.  Besides the name of the
+# sender they advertise the channel and datarate the sender listens on, and
+# how often it wakes to listen (0 if always listening).
+#
 _BEACON_NAME                = create_field(_BEACON_NAME_LEN, _HEADER_PAYLOAD)
-_BEACON_LENGTH              = end_field(_BEACON_NAME)
+_BEACON_DATARATE            = create_field(_DATARATE_LEN, _BEACON_NAME)
+_BEACON_CHANNEL             = create_field(_CHANNEL_LEN, _BEACON_DATARATE)
+_BEACON_LISTEN_INTERVAL     = create_field(_LISTEN_INTERVAL_LEN, _BEACON_CHANNEL)
+_BEACON_LENGTH              = end_field(_BEACON_LISTEN_INTERVAL)
 
 class Beacon(Packet):
     PROTOCOL_ID = 0
@@ -237,20 +484,42 @@ class Beacon(Packet):
         kwargs['nexthop'] = BROADCAST_ADDRESS
         super(Beacon, self).__init__(**kwargs)
 
-        self.name(kwargs['name'] if 'name' in kwargs else "Beacon")
+        if 'load' not in kwargs:
+            self.name(kwargs['name'] if 'name' in kwargs else "Beacon")
+            self.listen_datarate(kwargs['datarate'] if 'datarate' in kwargs else _DATARATE_UNKNOWN)
+            self.listen_channel(kwargs['channel'] if 'channel' in kwargs else _CHANNEL_UNKNOWN)
+            self.listen_interval(kwargs['listen_interval'] if 'listen_interval' in kwargs else 0)
 
     def __str__(self):
-        return "Beacon: [%s] N='%s'" % (super().__str__(), self.name())
+        return "Beacon: [%s] N='%s' C=%d DR=%d LI=%d" % (super().__str__(), self.name(), self.listen_channel(), self.listen_datarate(), self.listen_interval())
 
     def name(self, value=None):
-        return self._fields(_BEACON_NAME, value, return_type=str)
+        return self._field(_BEACON_NAME, value, return_type=str)
+
+    # Datarate the sender is listening at
+    def listen_datarate(self, value=None):
+        return self._field(_BEACON_DATARATE, value)
+
+    # Channel the sender is listening on
+    def listen_channel(self, value=None):
+        return self._field(_BEACON_CHANNEL, value)
+
+    # Milliseconds between the sender's listen sniffs
+    def listen_interval(self, value=None):
+        return self._field(_BEACON_LISTEN_INTERVAL, value)
 
     def process(self, parent):
         with parent._packet_lock:
-            # For now we just print them out
             if parent._debug:
                 print(str(self))
 
+            channel = self.listen_channel()
+            datarate = self.listen_datarate()
+            parent.beacon_received(self.previous(),
+                                   None if channel == _CHANNEL_UNKNOWN else channel,
+                                   None if datarate == _DATARATE_UNKNOWN else datarate,
+                                   self.listen_interval() / 1000.0)
+
 #########################################################################
 # Route announce
 #########################################################################
@@ -263,22 +532,36 @@ class Beacon(Packet):
 #
 _RANN_FLAGS                 = create_field(_FLAGS_LEN, _HEADER_PAYLOAD)
 _RANN_FLAGS_GATEWAY             = const(0)
+_RANN_FLAGS_TIME                = const(1)   # Network time reference follows
+_RANN_FLAGS_CHANNEL             = const(2)   # Gateway moves the mesh to the channel that follows
 _RANN_SEQUENCE              = create_field(_SEQUENCE_NUMBER_LEN, _RANN_FLAGS)
 _RANN_METRIC                = create_field(_METRIC_LEN, _RANN_SEQUENCE)
 _RANN_LENGTH                = end_field(_RANN_METRIC)
+_RANN_TIME                  = create_field(_TIME_LEN, _RANN_METRIC)
+_RANN_TIME_LENGTH           = end_field(_RANN_TIME)
+_RANN_CHANNEL               = create_field(_CHANNEL_LEN, _RANN_TIME)
+_RANN_CHANNEL_LENGTH        = end_field(_RANN_CHANNEL)
 
 class RouteAnnounce(Packet):
     PROTOCOL_ID = 1
 
     def __init__(self, **kwargs):
-        kwargs['len'] = _RANN_LENGTH
+        # Time reference is only carried when asked for; it is stamped as the frame is sent.
+        # A mesh channel change needs room for the time field too, used or not.
+        timed = 'time' in kwargs and kwargs['time']
+        mesh_channel = kwargs['mesh_channel'] if 'mesh_channel' in kwargs else None
+        kwargs['len'] = _RANN_CHANNEL_LENGTH if mesh_channel != None else _RANN_TIME_LENGTH if timed else _RANN_LENGTH
         kwargs['protocol'] = self.PROTOCOL_ID
         super(RouteAnnounce, self).__init__(**kwargs)
 
         if 'load' not in kwargs:
-            self.gateway_flag(kwargs['gateway'] if 'gateway' in kwargs else False)
+            self.gateway_flag(kwargs['gateway_flag'] if 'gateway_flag' in kwargs else False)
             self.metric(kwargs['metric'] if 'metric' in kwargs else 1)
             self.sequence(kwargs['sequence'] if 'sequence' in kwargs else 0)
+            self.time_flag(timed)
+            if mesh_channel != None:
+                self.channel_flag(True)
+                self.mesh_channel(mesh_channel)
 
     def __str__(self):
         return "RouteAnnounce: [%s] Seq=%d M=%d F=%02x" % (super().__str__(), self.sequence(), self.metric(), self.flags())
@@ -295,12 +578,36 @@ class RouteAnnounce(Packet):
     def metric(self, value=None):
         return self._field(_RANN_METRIC, value)
 
+    def time_flag(self, value=None):
+        return self._field_bit(_RANN_FLAGS, _RANN_FLAGS_TIME, value)
+
+    # Network time (ms) when the frame was sent
+    def timestamp(self, value=None):
+        return self._field(_RANN_TIME, value)
+
+    def channel_flag(self, value=None):
+        return self._field_bit(_RANN_FLAGS, _RANN_FLAGS_CHANNEL, value)
+
+    # Channel the gateway is moving the mesh to
+    def mesh_channel(self, value=None):
+        return self._field(_RANN_CHANNEL, value)
+
     #
     # Capture the route to the <source> and rebroadcast if TTL is non-zero
     # If we already have a route to this node, only capture updated metric if it gets better
     #
     def process(self, parent):
         with parent._packet_lock:
+            # Our own announce coming back from a neighbor
+            if self.source() == parent.address:
+                return
+
+            if self.time_flag() and len(self) >= _RANN_TIME_LENGTH:
+                parent.time_reference(self.source(), self.timestamp(), parent._frame_airtime(self))
+
+            if self.channel_flag() and self.gateway_flag() and len(self) >= _RANN_CHANNEL_LENGTH:
+                parent.channel_announced(self.mesh_channel())
+
             route = parent.update_route(target=self.source(), nexthop=self.previous(), sequence=self.sequence(), metric=self.metric(), gateway_flag=self.gateway_flag())
             if route != None:
                 if parent._debug:
@@ -313,8 +620,8 @@ class RouteAnnounce(Packet):
                         route.release_pending_routerequest(parent)
 
                 else:
-                    # Mark as NULL so the route gets recomputed
-                    self.nexthop(NULL_ADDRESS)
+                    # Mark as NULL so the route gets recomputed; broadcasts stay broadcast
+                    self.nexthop(BROADCAST_ADDRESS if self.target() == BROADCAST_ADDRESS else NULL_ADDRESS)
                     self.metric(self.metric() + 1)
                     parent.send_packet(self, ttl=True)
 
@@ -347,7 +654,7 @@ class RouteRequest(Packet):
 
         # Set defaults if no origin data
         if 'load' not in kwargs:
-            self.gateway_flag(kwargs['gateway'] if 'gateway' in kwargs else False)
+            self.gateway_flag(kwargs['gateway_flag'] if 'gateway_flag' in kwargs else False)
             self.sequence(kwargs['sequence'] if 'sequence' in kwargs else None)
             self.metric(kwargs['metric'] if 'metric' in kwargs else 1)
 
@@ -370,12 +677,18 @@ class RouteRequest(Packet):
     # TODO: Need brakes to avoid transmitting too many at once !! (Maybe ok for testing)
     def process(self, parent):
         with parent._packet_lock:
+            # Our own request coming back from a neighbor
+            if self.source() == parent.address:
+                return
+
             # Update route to the source to reflect a possibe path to the source
             route = parent.update_route(target=self.source(), nexthop=self.previous(), sequence=self.sequence(), metric=self.metric(), gateway_flag=self.gateway_flag())
 
             # If packet is asking us, create the RouteAnnounce
             if self.target() == parent.address:
-                parent.send_packet(RouteAnnounce(target=self.previous(), sequence=self.sequence(), metric=self.metric(), gateway_flag=parent._gateway))
+                # Answer the source, first hop back through the node that passed the request to us.
+                # Routes to us carry our own sequence so they compare with our announces.
+                parent.send_packet(RouteAnnounce(target=self.source(), nexthop=self.previous(), sequence=parent._create_sequence_number(), metric=self.metric(), gateway_flag=parent._gateway))
 
             # Otherwise send the packet on if the route is better than the last time (ignoring duplicate paths through this node)
             elif self.nexthop() == BROADCAST_ADDRESS and route != None:
@@ -394,6 +707,8 @@ _RERR_ADDRESS               = create_field(_ADDRESS_LEN, _HEADER_PAYLOAD)
 _RERR_SEQUENCE              = create_field(_SEQUENCE_NUMBER_LEN, _RERR_ADDRESS)
 _RERR_REASON                = create_field(_REASON_LEN, _RERR_SEQUENCE)
 _RERR_LENGTH                = end_field(_RERR_REASON)
+_RERR_REASON_UNKNOWN            = const(0)
+_RERR_REASON_LINK_FAILURE       = const(1)   # Next hop stopped acknowledging packets
 
 class RouteError(Packet):
     PROTOCOL_ID = 4
@@ -408,7 +723,7 @@ class RouteError(Packet):
         self.reason(kwargs['reason'] if 'reason' in kwargs else 0)
 
     def __str__(self):
-        return "RouteError: [%s] A=%d Seq=%d R=%d" % (super().__str__(), self.address(), self.sequence(), self.readon())
+        return "RouteError: [%s] A=%d Seq=%d R=%d" % (super().__str__(), self.address(), self.sequence(), self.reason())
 
     def address(self, value=None):
         return self._field(_RERR_ADDRESS, value)
@@ -425,6 +740,166 @@ class RouteError(Packet):
             if parent._debug:
                 print(str(self))
 
+            if self.target() == parent.address:
+                # Our route to <address> is broken; drop it so the next packet rediscovers it
+                parent.remove_route(self.address())
+
+            else:
+                # Reset nexthop so route is recomputed
+                self.nexthop(NULL_ADDRESS)
+                parent.send_packet(self, ttl=True)
+
+
+#########################################################################
+# Link Ack
+#########################################################################
+#
+# A LinkAck is returned to the previous hop for every unicast packet received
+# with a link ack request.  It is never routed; it only travels one hop.
+#
+_LACK_SEQUENCE              = create_field(_LINK_SEQUENCE_LEN, _HEADER_PAYLOAD)
+_LACK_LENGTH                = end_field(_LACK_SEQUENCE)
+
+class LinkAck(Packet):
+    PROTOCOL_ID = 5
+
+    def __init__(self, **kwargs):
+        kwargs['len'] = _LACK_LENGTH
+        kwargs['protocol'] = self.PROTOCOL_ID
+        kwargs['ttl'] = 1
+        super(LinkAck, self).__init__(**kwargs)
+
+        if 'load' not in kwargs:
+            self.sequence(kwargs['sequence'] if 'sequence' in kwargs else 0)
+
+    def __str__(self):
+        return "LinkAck: [%s] Seq=%d" % (super().__str__(), self.sequence())
+
+    def sequence(self, value=None):
+        return self._field(_LACK_SEQUENCE, value)
+
+    def process(self, parent):
+        parent.link_ack_received(self.previous(), self.sequence())
+
+
+#########################################################################
+# Aggregate
+#########################################################################
+#
+# An Aggregate carries several small packets for the same next hop in one
+# frame.  Each is stored as a length byte followed by the packet's frame.
+# The receiver hands each one to onReceive as though it arrived alone.
+#
+_AGGR_ITEMS                 = _HEADER_PAYLOAD
+_AGGR_LENGTH                = _HEADER_LENGTH
+
+class Aggregate(Packet):
+    PROTOCOL_ID = 6
+
+    def __init__(self, **kwargs):
+        kwargs['len'] = _AGGR_LENGTH
+        kwargs['protocol'] = self.PROTOCOL_ID
+        kwargs['ttl'] = 1
+        super(Aggregate, self).__init__(**kwargs)
+
+        # Packets waiting to be encoded when sending
+        self._packets = []
+
+        # Link data of the frame it arrived in, for the packets inside
+        self._snr = None
+        self._interface = None
+
+    def __str__(self):
+        return "Aggregate: [%s] Count=%d" % (super().__str__(), len(self._packets) if self._packets else len(self.frames()))
+
+    def add(self, packet):
+        self._packets.append(packet)
+
+    def packets(self):
+        return self._packets
+
+    # List of the frames in a received aggregate.  An item running past the end or empty
+    # ends the list with None, since nothing after it can be trusted.
+    def frames(self):
+        frames = []
+        index = _AGGR_ITEMS
+        while index < len(self._data):
+            length = self._data[index]
+            index += _AGGREGATE_ITEM_LEN
+            if length == 0 or index + length > len(self._data):
+                frames.append(None)
+                break
+            frames.append(self._data[index:index + length])
+            index += length
+        return frames
+
+    # Note the SNR and interface the aggregate frame was received with
+    def received(self, snr, interface):
+        self._snr = snr
+        self._interface = interface
+
+    def process(self, parent):
+        for frame in self.frames():
+            if frame == None:
+                parent._packets_ignored.inc()
+            else:
+                parent.onReceive(frame, True, self.rssi(), self._snr, self.metadata(), interface=self._interface, aggregated=True)
+
+
+#########################################################################
+# Fragment
+#########################################################################
+#
+# A packet too large for one frame is sent as a series of Fragments, each
+# carrying a slice of the original packet.  Fragments are routed like data
+# and put back together by the target.
+#
+_FRAG_MESSAGE               = create_field(_SEQUENCE_NUMBER_LEN, _HEADER_PAYLOAD)
+_FRAG_INDEX                 = create_field(_FRAGMENT_INDEX_LEN, _FRAG_MESSAGE)
+_FRAG_COUNT                 = create_field(_FRAGMENT_INDEX_LEN, _FRAG_INDEX)
+_FRAG_LENGTH                = end_field(_FRAG_COUNT)
+_FRAGMENT_MAX_COUNT         = const(255)
+
+class Fragment(Packet):
+    PROTOCOL_ID = 7
+
+    def __init__(self, **kwargs):
+        payload = kwargs['payload'] if 'payload' in kwargs else bytearray()
+        kwargs['len'] = _FRAG_LENGTH + len(payload)
+        kwargs['protocol'] = self.PROTOCOL_ID
+        super(Fragment, self).__init__(**kwargs)
+
+        if 'load' not in kwargs:
+            self.message(kwargs['message'] if 'message' in kwargs else 0)
+            self.index(kwargs['index'] if 'index' in kwargs else 0)
+            self.count(kwargs['count'] if 'count' in kwargs else 1)
+            self._data[_FRAG_LENGTH:] = payload
+
+    def __str__(self):
+        return "Fragment: [%s] Msg=%d %d/%d" % (super().__str__(), self.message(), self.index() + 1, self.count())
+
+    def message(self, value=None):
+        return self._field(_FRAG_MESSAGE, value)
+
+    def index(self, value=None):
+        return self._field(_FRAG_INDEX, value)
+
+    def count(self, value=None):
+        return self._field(_FRAG_COUNT, value)
+
+    def payload(self):
+        return self._data[_FRAG_LENGTH:]
+
+    def process(self, parent):
+        with parent._packet_lock:
+            if self.target() == parent.address or self.target() == BROADCAST_ADDRESS:
+                parent.reassemble(self)
+
+            else:
+                # Reset nexthop so route is recomputed
+                self.nexthop(NULL_ADDRESS)
+                parent.send_packet(self, ttl=True)
+
 
 #########################################################################
 # Data packet.
@@ -439,7 +914,11 @@ class DataPacket(Packet):
     def __init__(self, **kwargs):
         payload = kwargs['payload'] if 'payload' in kwargs else bytearray()
         if type(payload) == str:
-            payload = bytearray(payload)
+            payload = bytearray(payload.encode())
+
+        # Protocol numbers of the mesh's own packets would be parsed as those at the other end
+        if 'load' not in kwargs:
+            check_data_protocol(kwargs['protocol'] if 'protocol' in kwargs else 0)
 
         kwargs['len'] = _DATA_LENGTH + len(payload)
         # Create base items in packet
@@ -495,7 +974,7 @@ class Route():
         self._metric = kwargs['metric'] if 'metric' in kwargs else 0
         self._target = kwargs['target'] if 'target' in kwargs else NULL_ADDRESS
         self._nexthop = kwargs['nexthop'] if 'nexthop' in kwargs else NULL_ADDRESS
-        self._gateway = kwargs['gateway'] if 'gateway' in kwargs else False
+        self._gateway = kwargs['gateway_flag'] if 'gateway_flag' in kwargs else False
         self._pending_routerequest = None
         self._pending_routerequest_retry_timer = 0
         self._pending_routerequest_retry_timeout = 0
@@ -577,11 +1056,452 @@ class Route():
         else:
             self._gateway = value
 
+#
+# Link state of a directly heard node.  Tracks the round trip time of
+# acknowledged packets to derive the retransmit timeout (Jacobson/Karels).
+#
+class Neighbor():
+    def __init__(self, **kwargs):
+        self._address = kwargs['address'] if 'address' in kwargs else NULL_ADDRESS
+        self._srtt = None
+        self._rttvar = 0
+        self._rto = _LINK_ACK_TIMEOUT
+        self._failures = 0
+        self._rx_sequences = []
+        self._snr = None
+        self._rssi = None
+        self._channel = None
+        self._channel_until = 0
+        self._datarate = None
+        self._listen_interval = None
+        self._interface = None
+        self.heard()
+
+    def __str__(self):
+        return "Neighbor A=%d RTT=%s RTO=%d F=%d SNR=%s RSSI=%s C=%s DR=%s LI=%s I=%s Age=%.1f" % (
+                    self._address, "%d" % self._srtt if self._srtt != None else "-", self._rto, self._failures,
+                    "%.1f" % self._snr if self._snr != None else "-", "%.1f" % self._rssi if self._rssi != None else "-",
+                    self._channel, self._datarate, self._listen_interval, self._interface, time() - self._last_heard)
+
+    def address(self):
+        return self._address
+
+    def heard(self):
+        self._last_heard = time()
+
+    def is_expired(self):
+        return time() >= self._last_heard + _NEIGHBOR_LIFETIME
+
+    # Feed a round trip measurement in ms
+    def rtt_sample(self, rtt):
+        if self._srtt == None:
+            self._srtt = rtt
+            self._rttvar = rtt // 2
+        else:
+            self._rttvar += (abs(self._srtt - rtt) - self._rttvar) // 4
+            self._srtt += (rtt - self._srtt) // 8
+
+        self._rto = min(max(self._srtt + 4 * self._rttvar, _LINK_ACK_TIMEOUT_MIN), _LINK_ACK_TIMEOUT_MAX)
+        self._failures = 0
+
+    # Smoothed round trip time in ms (None before the first sample)
+    def srtt(self):
+        return self._srtt
+
+    # Retransmit timeout in ms, doubled for each retry already made
+    def rto(self, retries=0):
+        return min(self._rto << retries, _LINK_ACK_TIMEOUT_MAX)
+
+    def failures(self, value=None):
+        if value == None:
+            return self._failures
+        else:
+            self._failures = value
+
+    # Fold signal quality of a frame received from this neighbor into the running average
+    def signal_sample(self, rssi, snr):
+        if rssi != None:
+            self._rssi = rssi if self._rssi == None else self._rssi + (rssi - self._rssi) / _ADR_WEIGHT
+        if snr != None:
+            self._snr = snr if self._snr == None else self._snr + (snr - self._snr) / _ADR_WEIGHT
+
+    def snr(self):
+        return self._snr
+
+    def rssi(self):
+        return self._rssi
+
+    # Channel this neighbor listens on (None if not advertised)
+    def channel(self, value=None):
+        if value == None:
+            return self._channel
+        else:
+            self._channel = value
+
+    # Time the advertised channel is left for another (0 if it is kept)
+    def channel_until(self, value=None):
+        if value == None:
+            return self._channel_until
+        else:
+            self._channel_until = value
+
+    # Datarate this neighbor listens at (None if not advertised)
+    def datarate(self, value=None):
+        if value == None:
+            return self._datarate
+        else:
+            self._datarate = value
+
+    # Seconds between this neighbor's listen sniffs; 0 if always listening (None if not advertised)
+    def listen_interval(self, value=None):
+        if value == None:
+            return self._listen_interval
+        else:
+            self._listen_interval = value
+
+    # Index of the radio interface this neighbor was last heard on (None if not yet heard)
+    def interface(self, value=None):
+        if value == None:
+            return self._interface
+        else:
+            self._interface = value
+
+    # Returns True if <sequence> is a repeat of a recent link sequence received.
+    # Retransmissions may arrive after newer frames, so more than the last one is kept.
+    def duplicate(self, sequence):
+        if sequence in self._rx_sequences:
+            return True
+        self._rx_sequences.append(sequence)
+        if len(self._rx_sequences) > _LINK_SEQUENCE_WINDOW:
+            self._rx_sequences.pop(0)
+        return False
+
+#
+# A packet sent with link ack requested that has not yet been acknowledged
+#
+class PendingAck():
+    def __init__(self, packet, timeout):
+        self.packet = packet
+        self.retries = 0
+        self.sent(timeout)
+
+    def sent(self, timeout):
+        self.started = ticks_ms()
+        self.timeout = timeout
+
+    def is_expired(self, now):
+        return ticks_diff(now, self.started) >= self.timeout
+
+#
+# Fragments received so far of one fragmented packet
+#
+class Reassembly():
+    def __init__(self, count):
+        self.fragments = [ None ] * count
+        self.received = 0
+        self.size = 0
+        self.started = time()
+
+    def add(self, index, payload):
+        if index < len(self.fragments) and self.fragments[index] == None:
+            self.fragments[index] = payload
+            self.received += 1
+            self.size += len(payload)
+
+    def complete(self):
+        return self.received == len(self.fragments)
+
+    def data(self):
+        data = bytearray()
+        for fragment in self.fragments:
+            data.extend(fragment)
+        return data
+
+    def is_expired(self):
+        return time() >= self.started + _REASSEMBLY_TIMEOUT
+
+#
+# Noise floor samples of one channel, one byte per bin.  When a bin fills
+# all bins are halved so older samples fade.
+#
+class NoiseHistogram():
+    def __init__(self):
+        self.bins = bytearray(_SCAN_BINS)
+        self.samples = 0
+
+    def __str__(self):
+        return "Noise %s dBm over %d samples" % (self.level(), self.samples)
+
+    def add(self, rssi):
+        index = min(max(int(rssi - _SCAN_FLOOR) // _SCAN_BIN_WIDTH, 0), _SCAN_BINS - 1)
+        if self.bins[index] == 255:
+            for bin in range(_SCAN_BINS):
+                self.bins[bin] >>= 1
+        self.bins[index] += 1
+        self.samples += 1
+
+    # dBm that <fraction> of the samples stay below (None if no samples)
+    def level(self, fraction=_SCAN_PERCENTILE):
+        total = sum(self.bins)
+        count = 0
+        for bin in range(_SCAN_BINS):
+            count += self.bins[bin]
+            if count != 0 and count >= total * fraction:
+                return _SCAN_FLOOR + (bin + 1) * _SCAN_BIN_WIDTH
+        return None
+
+#########################################################################
+# An SX127x on the SPI bus with its own select, reset and DIO pins.
+# The bus itself is shared by all radios of a node.
+#########################################################################
+# Notes the time of a DIO edge in hard interrupt context, then schedules the real
+# handler.  The bound method is made once since hard interrupts must not allocate.
+class EdgeStamp():
+    def __init__(self):
+        self.ticks = None
+        self.callback = None
+        self.handler = self._interrupt
+
+    def _interrupt(self, pin):
+        self.ticks = ticks_us()
+        micropython.schedule(self.callback, pin)
+
+class SpiRadio(RadioDriver):
+
+    def __init__(self, domain, **kwargs):
+        super(SpiRadio, self).__init__(domain, **kwargs)
+
+        self._ss_pin    = kwargs['ss']    if 'ss'    in kwargs else _SX127x_SS
+        self._reset_pin = kwargs['reset'] if 'reset' in kwargs else _SX127x_RESET
+        self._dio_pins  = kwargs['dio']   if 'dio'   in kwargs else (_SX127x_DIO0, _SX127x_DIO1, _SX127x_DIO2)
+        self._spi = None
+        self._dio_table = []
+        self._edge_stamps = None
+        # Class of the DIO interrupt stubs; EdgeStamp when profiling unless another is given
+        self._edge_stamp = kwargs['edge_stamp'] if 'edge_stamp' in kwargs else None
+        self._capture = None
+        self._capture_interface = 0
+
+    # Claim our pins on <spi>
+    def _open(self, spi):
+        self._spi = spi
+        self._ss = Pin(self._ss_pin, Pin.OUT)
+        # Deselected so other radios on the bus can talk
+        self._ss.value(1)
+        self._reset = Pin(self._reset_pin, Pin.OUT)
+        self._dio_table = [ Pin(dio, Pin.IN) for dio in self._dio_pins ]
+        if self._edge_stamp:
+            self._edge_stamps = [ self._edge_stamp() for dio in self._dio_pins ]
+        elif self._rx_profile:
+            # Note edge times for the handler delay
+            self._edge_stamps = [ EdgeStamp() for dio in self._dio_pins ]
+
+    # Close DIO interrupts
+    def _close(self):
+        for dio in self._dio_table:
+            dio.irq(handler=None, trigger=0)
+
+    # Reset device
+    def reset(self):
+        self._reset.value(0)
+        sleep(0.1)
+        self._reset.value(1)
+
+    # Read register from SPI port
+    def read_register(self, address):
+        value = int.from_bytes(self._spi_transfer(address & 0x7F), 'big')
+        # print("%02x from %02x" % (value, address))
+        return value
+
+    # Write register to SPI port
+    def write_register(self, address, value):
+        # print("write %02x to %02x" % (value, address))
+        self._spi_transfer(address | 0x80, value)
+
+    def _spi_transfer(self, address, value=0):
+        response = bytearray(1)
+        self._ss.value(0)
+        self._spi.write(bytes([address]))
+        self._spi.write_readinto(bytes([value]), response)
+        self._ss.value(1)
+        return response
+
+    # Read block of data from SPI port
+    def read_buffer(self, address, length):
+        try:
+            response = bytearray(length)
+            self._ss.value(0)
+            self._spi.write(bytes([address & 0x7F]))
+            self._spi.readinto(response)
+            self._ss.value(1)
+
+        except:
+            # No room.  Have the memory manager collect as soon as it can
+            umemory.request(urgent=True)
+            response = None
+
+        return response
+
+    # Burst read of consecutive registers into <buffer>
+    def read_registers(self, address, buffer):
+        self._ss.value(0)
+        self._spi.write(bytes([address & 0x7F]))
+        self._spi.readinto(buffer)
+        self._ss.value(1)
+        return buffer
+
+    # Write consecutive registers in one SPI burst
+    def write_registers(self, address, buffer):
+        self._ss.value(0)
+        self._spi.write(bytes([address | 0x80]))
+        self._spi.write(buffer)
+        self._ss.value(1)
+
+    # Write block of data to SPI port
+    def write_buffer(self, address, buffer, size):
+        self._ss.value(0)
+        self._spi.write(bytes([address | 0x80]))
+        self._spi.write(memoryview(buffer)[0:size])
+        self._ss.value(1)
+
+    def attach_interrupt(self, dio, edge, callback):
+        # if self._debug:
+        #    print("attach_interrupt dio %d rising %s with callback %s" % (dio, edge, callback))
+
+        if dio < 0 or dio >= len(self._dio_table):
+            raise Exception("DIO %d out of range (0..%d)" % (dio, len(self._dio_table) - 1))
+
+        edge = Pin.IRQ_RISING if edge else Pin.IRQ_FALLING
+        if self._edge_stamps and callback:
+            stamp = self._edge_stamps[dio]
+            stamp.callback = callback
+            self._dio_table[dio].irq(handler=stamp.handler, trigger=edge, hard=True)
+        else:
+            self._dio_table[dio].irq(handler=callback, trigger=edge if callback else 0)
+
+    def edge_time(self, dio):
+        return self._edge_stamps[dio].ticks if self._edge_stamps else None
+
+    def attach_capture(self, capture, interface=0):
+        self._capture = capture
+        self._capture_interface = interface
+
+    def transmit_packet(self, packet, implicit_header=False):
+        if self._capture:
+            self._capture.frame(CAPTURE_TX | (CAPTURE_IMPLICIT if self._current_implicit_header else 0), packet, self._capture_interface)
+        super(SpiRadio, self).transmit_packet(packet, implicit_header)
+
+    def dump(self):
+        item = 0
+        for reg in range(0x43):
+            print("%02x: %02x" % (reg, self.read_register(reg)), end="    " if item != 7 else "\n")
+            item = (item + 1) % 8
+        print("")
+
+#########################################################################
+# An additional radio of a MeshNet with its own pins, channel and transmit
+# queue.  Frames it receives and completed transmissions are handed back
+# to the MeshNet, which decides what each radio sends.
+#########################################################################
+class RadioInterface(SpiRadio):
+
+    def __init__(self, mesh, index, domain, **kwargs):
+        kwargs['metrics'] = mesh.metrics()
+        kwargs['irq_name'] = "irq%d" % index
+        super(RadioInterface, self).__init__(domain, **kwargs)
+
+        self._mesh = mesh
+        self._index = index
+        self._transmit_queue = queue()
+        self._head_sent = False
+        self._restart_timer_pending = False
+        self._ack_window = None
+
+    def __str__(self):
+        return "Interface %d C=%s Q=%d" % (self._index, self.get_channel(), len(self._transmit_queue))
+
+    def index(self):
+        return self._index
+
+    # Number of packets waiting to be sent
+    def pending(self):
+        return len(self._transmit_queue)
+
+    def onReceive(self, data, crc_ok, rssi, snr=None, metadata=None):
+        self._mesh.onReceive(data, crc_ok, rssi, snr, metadata, interface=self)
+
+    # Put <packet> on our transmit queue and start the transmitter if idle
+    def queue_packet(self, packet):
+        with self._mesh._meshlock:
+            if self._trace:
+                self._trace.record(TRACE_TX_ENQUEUE, packet.data(), self._index)
+            packet.queued(ticks_ms())
+            if isinstance(packet, LinkAck):
+                # Ahead of anything not yet on the air; the sender is holding its next frame for it
+                self._transmit_queue.insert(1 if self._head_sent else 0, packet)
+            else:
+                self._transmit_queue.put(packet)
+            if len(self._transmit_queue) == 1:
+                self._transmit_head(packet)
+
+    def onTransmit(self):
+        packet = self._transmit_queue.get(wait=0)
+        if self._trace and packet:
+            self._trace.record(TRACE_TX_DONE, packet.data(), self._index)
+        self._mesh._transmitted(packet, self)
+        self._head_sent = False
+
+        packet = self._transmit_queue.head()
+        if packet and self._mesh._ack_wait(self) != 0:
+            # Listen for the acks; the restart timer sends it
+            self._transmit_head(packet)
+            packet = None
+
+        if packet:
+            self._head_sent = True
+
+        return self._frame(packet) if packet else None
+
+    # Send <packet> at the head of our queue now, or arm the restart timer if acks are due
+    def _transmit_head(self, packet):
+        wait = self._mesh._ack_wait(self)
+        if wait == 0:
+            self._head_sent = True
+            self.transmit_packet(self._frame(packet))
+
+        elif not self._restart_timer_pending:
+            self._restart_timer_pending = True
+            self._call_later(wait / 1000.0, self._restart_timer)
+
+    # Restart transmit queue when the ack window closes
+    def _restart_timer(self, timer):
+        with self._mesh._meshlock:
+            self._restart_timer_pending = False
+            packet = self._transmit_queue.head()
+            if packet and not self._head_sent:
+                self._transmit_head(packet)
+
+    # Tune for <packet> and return its frame.  The channel and datarate the mesh picked only
+    # mean something if we share its domain; otherwise we send on our own channel.
+    def _frame(self, packet):
+        preamble = self._mesh._wake_preamble(packet, self)
+        if self._domain is self._mesh._domain:
+            self.set_transmit_channel(packet.channel(), packet.datarate(), packet.implicit(), preamble)
+        else:
+            self.set_transmit_channel(preamble=preamble)
+        if not self._alloc:
+            return self._mesh._encode(packet)
+
+        allocated = self._alloc.begin()
+        frame = self._mesh._encode(packet)
+        self._alloc.end(ALLOC_TX_ENCODE, allocated, packet.protocol())
+        return frame
+
 #########################################################################
 # This level maintains handles the routing protocol
 # and will deliver non-routing messages to the inheriter.
 #########################################################################
-class MeshNet(RadioDriver):
+class MeshNet(SpiRadio):
 
     def __init__(self, domain, address, **kwargs):
         super(MeshNet, self).__init__(domain, **kwargs)
@@ -597,25 +1517,153 @@ class MeshNet(RadioDriver):
         self._debug = False
 
         self._announce_thread = None
+        self._retry_routerequests_thread = None
 
         # Defines routes to nodes
         self._routes = {}
-        self._packet_errors_crc = 0
-        self._packet_received = 0
-        self._packet_transmitted = 0
-        self._packet_ignored = 0
         self._packet_lock = rlock()
 
+        # Statistics
+        self._packets_crc_errors = self._metrics.counter("packets.crc_errors")
+        self._packets_received = self._metrics.counter("packets.received", labels=_METRICS_PROTOCOLS)
+        self._packets_transmitted = self._metrics.counter("packets.transmitted", labels=_METRICS_PROTOCOLS)
+        self._packets_ignored = self._metrics.counter("packets.ignored")
+        self._packets_size = self._metrics.histogram("packets.size", _METRICS_SIZE_BOUNDS)
+        self._transmit_latency = self._metrics.histogram("transmit.latency_ms", _METRICS_LATENCY_BOUNDS)
+        self._neighbor_frames = self._metrics.counter("neighbor.frames", labels=_MAX_NEIGHBORS)
+        self._metrics.gauge("transmit.queue", lambda: len(self._transmit_queue))
+        self._metrics.gauge("routes", lambda: len(self._routes))
+        self._metrics.gauge("neighbors", lambda: len(self._neighbors))
+        self._metrics.gauge("memory.free", gc.mem_free)
+
+        # Link layer acknowledgement of unicast data packets
+        self._link_ack = kwargs['link_ack'] if 'link_ack' in kwargs else False
+        self._link_ack_retries = kwargs['link_ack_retries'] if 'link_ack_retries' in kwargs else _LINK_ACK_RETRIES
+        self._link_sequence_number = 0
+        self._ack_pending = {}
+        # (address, acks, ticks_ms) while holding transmission for acks on each radio
+        self._ack_window = None
+        self._link_failures = self._metrics.counter("link.failures")
+        self._link_retransmits = self._metrics.counter("link.retransmits")
+
+        # Directly heard nodes
+        self._neighbors = {}
+        self._neighbor_lock = rlock()
+
+        # Adaptive datarate: listen at the fastest rate all neighbors can reach us at
+        self._adr = kwargs['adr'] if 'adr' in kwargs else False
+        self._adr_margin = kwargs['adr_margin'] if 'adr_margin' in kwargs else _ADR_MARGIN
+        self._beacon_interval = kwargs['beacon_interval'] if 'beacon_interval' in kwargs else _BEACON_INTERVAL
+        self._adr_timer = 0
+        self._beacon_timer = 0
+        self._beacon_count = 0
+        self._beacon_all = True
+        self._broadcast_sent = {}      # (channel, datarate): time() a broadcast was last queued there
+
+        # Multichannel: listen on a data channel hashed from our address; the configured
+        # channel is the rendezvous channel used for discovery and broadcasts
+        self._multichannel = kwargs['multichannel'] if 'multichannel' in kwargs else False
+        self._rendezvous_until = 0
+
+        self._control_channel = None
+        self._control_datarate = None
+
+        # TDMA: only transmit in our own slot of a frame timed from gateway announces
+        self._tdma = kwargs['tdma'] if 'tdma' in kwargs else False
+        self._tdma_slots = kwargs['tdma_slots'] if 'tdma_slots' in kwargs else _TDMA_SLOTS
+        self._tdma_slot_time = kwargs['tdma_slot_time'] if 'tdma_slot_time' in kwargs else _TDMA_SLOT_TIME
+        self._tdma_slot = ((address * 0x9E37) >> 4) % self._tdma_slots
+        self._restart_timer_pending = False
+        if self._tdma:
+            # Slots pace transmissions instead
+            self._delay = 0
+
+        # Implicit header control: route announces and requests on the rendezvous channel are sent
+        # without a LoRa header, padded to one fixed length.  Nodes listening there can then receive
+        # nothing else, so data must be on other channels.
+        self._implicit_control = kwargs['implicit_control'] if 'implicit_control' in kwargs else False
+        if self._implicit_control and not self._multichannel:
+            raise MeshNetException("implicit_control requires multichannel")
+        self._control_length = _RANN_TIME_LENGTH if self._tdma else max(_RANN_LENGTH, _RREQ_LENGTH)
+
+        # Aggregation of small unicast packets waiting for the same next hop
+        self._aggregate = kwargs['aggregate'] if 'aggregate' in kwargs else False
+        self._aggregate_hold = kwargs['aggregate_hold'] if 'aggregate_hold' in kwargs else _AGGREGATE_HOLD
+        self._hold_timer_pending = False
+        self._head_sent = False
+
+        # Background noise scan of the domain's channels while idle.  With auto_channel a gateway
+        # moves the mesh to a quieter channel by announcing it.
+        self._scan = kwargs['scan'] if 'scan' in kwargs else False
+        self._scan_interval = kwargs['scan_interval'] if 'scan_interval' in kwargs else _SCAN_INTERVAL
+        self._auto_channel = kwargs['auto_channel'] if 'auto_channel' in kwargs else False
+        self._scan_timer = 0
+        self._scan_index = 0
+        self._noise = {}
+        self._migrate_channel = None
+        self._migrate_at = 0
+
+        # Compressed headers must be enabled on every node of the mesh
+        self._compress_header = kwargs['compress_header'] if 'compress_header' in kwargs else False
+
+        # Fragmentation of packets too large for one frame
+        self._fragment_sequence_number = 0
+        self._reassembly = {}
+        self._reassembly_bytes = 0
+        self._reassembly_failures = self._metrics.counter("reassembly.failures")
+
+        # Network time is ticks_ms() + offset, corrected for drift since last sync
+        self._time_source = None
+        self._time_source_heard = 0
+        self._clock_offset = 0
+        self._clock_drift = 0
+        self._clock_synced = None
+
+        # Additional radios, each a dict of RadioInterface parameters: ss, reset and dio pins,
+        # channel, and a domain of its own if it works another band.  Unicast packets go out on
+        # the radio the next hop was heard on and broadcasts on every radio.
+        self._interfaces = [ self ]
+        for config in kwargs['interfaces'] if 'interfaces' in kwargs else []:
+            config = dict(config)
+            domain = config.pop('domain', self._domain)
+            # Every radio is profiled, scheduled and interrupted the way we are
+            for key in ('irq_profile', 'irq_outlier', 'alloc_profile', 'call_later', 'edge_stamp'):
+                if key in kwargs and key not in config:
+                    config[key] = kwargs[key]
+            self._interfaces.append(RadioInterface(self, len(self._interfaces), domain, **config))
+
+        # Split control: this radio stays on the rendezvous channel for broadcasts and route
+        # control while the others share the unicast traffic.  The first of them listens on our
+        # data channel; any more keep the channel they were given so frames are not heard twice.
+        self._split_control = kwargs['split_control'] if 'split_control' in kwargs else False
+        if self._split_control:
+            if not self._multichannel or len(self._interfaces) < 2:
+                raise MeshNetException("split_control requires multichannel and a second interface")
+            for interface in self._interfaces[1:]:
+                if interface._domain is not self._domain:
+                    raise MeshNetException("split_control interfaces must share the domain")
+
+        # Radio whose channel is advertised in beacons and tuned by ADR
+        self._data_interface = self._interfaces[1] if self._split_control else self
+
+        # Packet lifecycle trace of this many records; 0 for none
+        if 'trace' in kwargs and kwargs['trace']:
+            self.set_trace(kwargs['trace'])
+
         self._gateway = kwargs['gateway'] if 'gateway' in kwargs else False
         if self._gateway:
-            self._announce_interval = float(kwargs['interval']) if 'interval' in kwargs else _ANOUNCE_DEFAULT_INTERVAL
+            self._announce_interval = float(kwargs['interval']) if 'interval' in kwargs else _ANNOUNCE_INTERVAL_DEFAULT
         else:
             self._announce_interval = 0
 
         self._PROTOCOLS = {
+                Beacon.PROTOCOL_ID:        Beacon,
                 RouteAnnounce.PROTOCOL_ID: RouteAnnounce,
                 RouteRequest.PROTOCOL_ID:  RouteRequest,
                 RouteError.PROTOCOL_ID:    RouteError,
+                LinkAck.PROTOCOL_ID:       LinkAck,
+                Aggregate.PROTOCOL_ID:     Aggregate,
+                Fragment.PROTOCOL_ID:      Fragment,
                 None:                      DataPacket,   # Data packet protocol id is a wildcard
         }
 
@@ -627,15 +1675,53 @@ class MeshNet(RadioDriver):
     def set_debug(self, mode = True):
         self._debug = mode
 
+    # Start tracing packets into a ring of <records> entries; 0 stops tracing
+    def set_trace(self, records=256):
+        trace = Trace(records) if records else None
+        for index, interface in enumerate(self._interfaces):
+            interface.attach_trace(trace, index)
+        return trace
+
+    # The packet trace ring, or None when not tracing
+    def trace(self):
+        return self._trace
+
+    # Log every frame sent and received to <stream> (see meshcapture); None stops capturing
+    def set_capture(self, stream, size=4096):
+        if self._capture:
+            self._capture.stop()
+        capture = Capture(stream, self.address, self.get_channel(), size) if stream else None
+        for index, interface in enumerate(self._interfaces):
+            interface.attach_capture(capture, index)
+        if capture:
+            capture.start()
+        return capture
+
+    # The frame capture, or None when not capturing
+    def capture(self):
+        return self._capture
+
+    # Start or stop counting heap allocation by packet path (metrics "alloc")
+    def set_alloc_profile(self, enable=True):
+        profile = self._metrics.alloc_profile("alloc") if enable else None
+        for interface in self._interfaces:
+            interface.attach_alloc_profile(profile)
+        return profile
+
+    # The allocation profile, or None when not profiling
+    def alloc_profile(self):
+        return self._alloc
+
     def start(self):
-        self._spi = SPI(baudrate=10000000, polarity=0, phase=0, bits=8, firstbit = SPI.MSB,
-                        sck = Pin(_SX127x_SCK, Pin.OUT, Pin.PULL_DOWN),
-                        mosi = Pin(_SX127x_MOSI, Pin.OUT, Pin.PULL_UP),
-                        miso = Pin(_SX127x_MISO, Pin.IN, Pin.PULL_UP))
-
-        self._ss = Pin(_SX127x_SS, Pin.OUT)
-        self._reset = Pin(_SX127x_RESET, Pin.OUT)
-        self._dio_table = [ Pin(_SX127x_DIO0, Pin.IN), Pin(_SX127x_DIO1, Pin.IN), Pin(_SX127x_DIO2, Pin.IN) ]
+        spi = SPI(baudrate=10000000, polarity=0, phase=0, bits=8, firstbit = SPI.MSB,
+                  sck = Pin(_SX127x_SCK, Pin.OUT, Pin.PULL_DOWN),
+                  mosi = Pin(_SX127x_MOSI, Pin.OUT, Pin.PULL_UP),
+                  miso = Pin(_SX127x_MISO, Pin.IN, Pin.PULL_UP))
+
+        # Every radio must be deselected before any of them is used
+        for interface in self._interfaces:
+            interface._open(spi)
+
         self._ping_count = 0
         self._power = None # not True nor False
 
@@ -643,17 +1729,46 @@ class MeshNet(RadioDriver):
         # super(MeshNet, self).start(_SX127x_WANTED_VERSION)
         super().start(_SX127x_WANTED_VERSION, activate=False)
 
+        for interface in self._interfaces[1:]:
+            interface.start(_SX127x_WANTED_VERSION, activate=False)
+
         # Set power state
         self.set_power()
 
-        # A timer than can be started to do retries; not started until needed
-        self._retry_routerequests_thread = thread(run=self._retry_routerequests, stack=8192)
-        self._retry_routerequests_thread.start(timeout=0.5)
+        # Broadcasts always go out on the configured channel and datarate so new nodes can find us
+        self._control_channel, self._control_datarate = self.get_channel()
+
+        # Only possible if the domain has data channels besides the rendezvous channel
+        if self._implicit_control and self._hash_channel(self.address) == self._control_channel:
+            self._implicit_control = False
+
+        if self._split_control:
+            # We never leave the rendezvous channel; the data radio listens on our data channel
+            with self._data_interface._lock:
+                self._data_interface.set_standby_mode()
+                self._data_interface.set_channel(self._hash_channel(self.address))
+                self._data_interface.set_receive_mode()
+
+        elif self._multichannel:
+            # Stay on the rendezvous channel long enough to hear every neighbor's beacon once;
+            # our beacons say so until we leave
+            self._rendezvous_until = time() + self._beacon_interval + _RENDEZVOUS_MARGIN
+            with self._lock:
+                self.set_standby_mode()
+                self.set_channel(self._hash_channel(self.address))
+                self.set_receive_mode()
+
+        self._start_maintenance(_LINK_ACK_POLL if self._link_ack else 0.5)
 
         # Start announce if requested
         if self._gateway:
             self.announce_start(self._announce_interval / 1000.0)
 
+    # A thread to do retries and upkeep every <timeout> seconds
+    def _start_maintenance(self, timeout):
+        self._retry_routerequests_thread = thread(run=self._retry_routerequests, stack=8192)
+        self._retry_routerequests_thread.start(timeout=timeout)
+
     def announce_start(self, interval):
         print("Announce gateway every %.1f seconds" % interval)
         self._announce_thread = thread(run=self._announce, stack=8192)
@@ -668,11 +1783,15 @@ class MeshNet(RadioDriver):
             countdown -= 1
             if countdown <= 0:
                 countdown += interval
-                packet = RouteAnnounce(target=BROADCAST_ADDRESS, nexthop=BROADCAST_ADDRESS, sequence=self._create_sequence_number(), gateway_flag=self._gateway)
-                self.send_packet(packet)
+                self._send_announce()
 
         return 0
 
+    def _send_announce(self):
+        packet = RouteAnnounce(target=BROADCAST_ADDRESS, nexthop=BROADCAST_ADDRESS, sequence=self._create_sequence_number(), gateway_flag=self._gateway, time=self._tdma,
+                               mesh_channel=self._migrate_channel)
+        self.send_packet(packet)
+
     # Return the protocol wrapper or Data is not otherwise defined
     def get_protocol_wrapper(self, protocol):
         return self._PROTOCOLS[protocol] if protocol in self._PROTOCOLS else self._PROTOCOLS[None]
@@ -681,9 +1800,11 @@ class MeshNet(RadioDriver):
     def remove_route(self, address):
         with self._route_lock:
             if address in self._routes:
-                del(self_routes[address])
+                del(self._routes[address])
 
-    # Update a route.  If route is not defined, create it.  If defined but metric is better or sequence is different, update it.
+    # Update a route.  If route is not defined or still awaiting an announce, create it.  If defined,
+    # update it for a newer sequence, or the same sequence with a better metric.  Anything else is a
+    # stale or repeated copy and returns None so it is not forwarded again.
     # Return True if new or updated route
     def update_route(self, target, nexthop, sequence, metric=_MAX_METRIC, gateway_flag=False, force=False):
         with self._route_lock:
@@ -694,8 +1815,8 @@ class MeshNet(RadioDriver):
                 if self._debug:
                     print("Created %s" % str(route))
 
-            # Else if we are forcing creation, or the sequence number is different or the metric is better, create a new route
-            elif sequence != self._routes[target].sequence() or metric < self._routes[target].metric():
+            elif self._routes[target].nexthop() == NULL_ADDRESS or sequence_newer(sequence, self._routes[target].sequence()) or \
+                 (sequence == self._routes[target].sequence() and metric < self._routes[target].metric()):
                 # Update route
                 route = self._routes[target]
                 route.nexthop(nexthop)
@@ -716,80 +1837,633 @@ class MeshNet(RadioDriver):
         with self._route_lock:
             return self._routes[address] if address in self._routes and not self._routes[address].is_expired() else None
 
-    # Reset device
-    def reset(self):
-        self._reset.value(0)
-        sleep(0.1)
-        self._reset.value(1)
-
-    # Read register from SPI port
-    def read_register(self, address):
-        value = int.from_bytes(self._spi_transfer(address & 0x7F), 'big')
-        # print("%02x from %02x" % (value, address))
-        return value
+    # Return neighbor record for <address>, creating it if needed.
+    # When the table is full the least recently heard neighbor is dropped.
+    def update_neighbor(self, address):
+        with self._neighbor_lock:
+            neighbor = self._neighbors[address] if address in self._neighbors else None
+            if neighbor == None:
+                if len(self._neighbors) >= _MAX_NEIGHBORS:
+                    oldest = None
+                    for item in self._neighbors.values():
+                        if oldest == None or item._last_heard < oldest._last_heard:
+                            oldest = item
+                    del(self._neighbors[oldest.address()])
+
+                neighbor = Neighbor(address=address)
+                if self._multichannel:
+                    # Until it tells us, it may still be in its rendezvous window
+                    neighbor.channel_until(time() + self._beacon_interval + _RENDEZVOUS_MARGIN)
+                self._neighbors[address] = neighbor
+            else:
+                neighbor.heard()
+
+        return neighbor
+
+    def find_neighbor(self, address):
+        with self._neighbor_lock:
+            return self._neighbors[address] if address in self._neighbors else None
+
+    # Pick the fastest datarate whose limits all fresh neighbors clear by the ADR margin.
+    # Slowing down is immediate; speeding up needs an extra hysteresis margin.
+    def _adr_select(self):
+        channel, current = self._data_interface.get_channel()
+        snr = None
+        rssi = None
+        with self._neighbor_lock:
+            for neighbor in self._neighbors.values():
+                if not neighbor.is_expired() and neighbor.snr() != None:
+                    snr = neighbor.snr() if snr == None else min(snr, neighbor.snr())
+                    rssi = neighbor.rssi() if rssi == None else min(rssi, neighbor.rssi())
+
+        if snr == None:
+            return self._control_datarate
+
+        rates = self._domain.channel_datarates(channel)
+        best = rates[0]
+        for datarate in range(rates[0], rates[1] + 1):
+            if self.valid_datarate(channel, datarate):
+                min_snr, sensitivity = self.get_datarate_limits(datarate)
+                margin = self._adr_margin + (_ADR_HYSTERESIS if datarate > current else 0)
+                if snr - min_snr >= margin and (rssi == None or rssi - sensitivity >= margin):
+                    best = datarate
+
+        return best
+
+    # Periodic ADR work: re-evaluate listen datarate and advertise it
+    def _adr_update(self):
+        now = time()
+        if now >= self._adr_timer:
+            self._adr_timer = now + _ADR_INTERVAL
+            datarate = self._adr_select()
+            radio = self._data_interface
+            if datarate != radio.get_channel()[1]:
+                if self._debug:
+                    print("ADR listen datarate %d -> %d" % (radio.get_channel()[1], datarate))
+                with self._meshlock:
+                    if len(radio._transmit_queue) == 0:
+                        with radio._lock:
+                            radio.set_standby_mode()
+                            radio.set_channel(datarate=datarate)
+                            radio.set_receive_mode()
+                    else:
+                        # Transmitter is busy; picked up when it returns to receive
+                        radio._channel = (radio._channel[0], datarate)
+                # Tell neighbors right away
+                self._beacon_timer = 0
+
+    # Advertise where we listen: the rendezvous channel while we are still there after start,
+    # else our data channel, which we then never leave.  With implicit control the rendezvous
+    # channel carries nothing but route control, so the data channel is advertised and we
+    # move there as soon as there is a neighbor to tell.
+    def _beacon_update(self):
+        if time() >= self._beacon_timer:
+            # What changed goes to every neighbor; otherwise a beacon only goes where nothing else has lately
+            self._beacon_all = self._beacon_timer == 0
+
+            # Nodes with one interval keep the same phase, so a pair whose beacons overlap would never
+            # hear each other.  Vary it from beacon to beacon, differently on each node.
+            self._beacon_count += 1
+            self._beacon_timer = time() + self._beacon_interval + ((((self.address ^ self._beacon_count) * 0x9E37) >> 4) % (_BEACON_SKEW + 1))
+            channel, datarate = self._data_interface.get_channel()
+            if self._rendezvous_until != 0:
+                if not self._implicit_control:
+                    channel, datarate = self._control_channel, self._control_datarate
+                elif len(self._neighbors) != 0:
+                    self._rendezvous_until = time()
+            self.send_packet(Beacon(channel=channel, datarate=datarate, listen_interval=int(self._listen_interval * 1000)))
+
+    # Record where and when <address> listens.  A neighbor we knew nothing about gets our beacon soon.
+    # One advertising the rendezvous channel is in its window after start and moves to its data
+    # channel within a beacon interval, so its beacon saying so cannot be the only way we learn it.
+    def beacon_received(self, address, channel, datarate, listen_interval=0):
+        neighbor = self.update_neighbor(address)
+        if neighbor.channel() == None and neighbor.datarate() == None:
+            self._beacon_timer = 0
+        neighbor.channel(channel)
+        if self._multichannel and channel == self._control_channel and self._hash_channel(address) != channel:
+            neighbor.channel_until(time() + self._beacon_interval + _RENDEZVOUS_MARGIN)
+        else:
+            neighbor.channel_until(0)
+        neighbor.datarate(datarate)
+        neighbor.listen_interval(listen_interval)
+
+    # Preamble length that wakes the neighbors <packet> is sent to, or None if all listen
+    # continuously.  Neighbors that have not told us are assumed to sniff as often as we do.
+    # <radio> is the interface sending it, if not this one.
+    def _wake_preamble(self, packet, radio=None):
+        with self._neighbor_lock:
+            if packet.nexthop() == BROADCAST_ADDRESS:
+                # New nodes may be listening too
+                interval = self._listen_interval
+                for neighbor in self._neighbors.values():
+                    if not neighbor.is_expired() and neighbor.listen_interval() != None:
+                        interval = max(interval, neighbor.listen_interval())
+            else:
+                neighbor = self.find_neighbor(packet.nexthop())
+                interval = neighbor.listen_interval() if neighbor and neighbor.listen_interval() != None else self._listen_interval
+
+        if interval == 0:
+            return None
+        if radio == None or radio._domain is self._domain:
+            return self.get_preamble_length(interval, packet.datarate())
+        return radio.get_preamble_length(interval)
+
+    # Choose our data channel from the channels sharing the rendezvous channel's datarates
+    def _hash_channel(self, address):
+        rates = self._domain.channel_datarates(self._control_channel)
+        channels = [ c for c in self._domain.channels() if c != self._control_channel and self._domain.channel_datarates(c) == rates ]
+        if len(channels) == 0:
+            return self._control_channel
+        return channels[((address * 0x9E37) & 0xFFFF) % len(channels)]
+
+    # Listen on the rendezvous channel until the window after start is closed
+    def _listen_channel(self):
+        if self._rendezvous_until != 0:
+            return (self._control_channel, self._control_datarate)
+        return self.get_channel()
+
+    # Channels the mesh could move to: those usable at the rendezvous datarate
+    def _scan_channels(self):
+        return [ channel for channel in self._domain.channels() if self.valid_datarate(channel, self._control_datarate) ]
+
+    # Sample the noise on the next channel if the transmitter is idle.  A gateway with
+    # auto_channel starts moving the mesh once a clearly quieter channel shows up.
+    def _scan_update(self):
+        if time() >= self._scan_timer:
+            self._scan_timer = time() + self._scan_interval
+            channels = self._scan_channels()
+            with self._meshlock:
+                if len(self._transmit_queue) == 0:
+                    self._scan_index = (self._scan_index + 1) % len(channels)
+                    self._scan_noise(channels[self._scan_index], _SCAN_SAMPLES)
+
+            if self._gateway and self._auto_channel and self._migrate_channel == None:
+                best = self.recommended_channel()
+                if best != None and best != self._control_channel and \
+                   self._noise[self._control_channel].level() - self._noise[best].level() >= _SCAN_HYSTERESIS:
+                    if self._debug:
+                        print("Moving mesh from channel %d to %d" % (self._control_channel, best))
+                    self.channel_announced(best)
+                    # Tell everyone now rather than at the next announce
+                    self.send_packet(RouteAnnounce(target=BROADCAST_ADDRESS, nexthop=BROADCAST_ADDRESS, sequence=self._create_sequence_number(),
+                                                   gateway_flag=self._gateway, mesh_channel=best))
+
+    # Take <samples> noise readings of <channel> into its histogram
+    def _scan_noise(self, channel, samples):
+        self._scan_done(channel, self.scan_channel(channel, samples, self._control_datarate))
+
+    # <values> were read from <channel>; None if the scan was cut short
+    def _scan_done(self, channel, values):
+        if values != None:
+            if channel not in self._noise:
+                self._noise[channel] = NoiseHistogram()
+            for rssi in values:
+                self._noise[channel].add(rssi)
+
+    # Quietest channel the mesh could use, or None until every channel has been sampled
+    def recommended_channel(self):
+        best = None
+        for channel in self._scan_channels():
+            if channel not in self._noise or self._noise[channel].samples < _SCAN_SAMPLES:
+                return None
+            if best == None or self._noise[channel].level() < self._noise[best].level():
+                best = channel
+        return best
+
+    # Noise histograms by channel
+    def noise(self):
+        return self._noise
+
+    # A gateway is moving the mesh to <channel>; follow after a delay so the announce can spread
+    def channel_announced(self, channel):
+        if self._domain.has_channel(channel) and channel != self._control_channel and channel != self._migrate_channel:
+            self._migrate_channel = channel
+            self._migrate_at = time() + _CHANNEL_MIGRATE_DELAY
+
+    # Switch to the announced channel once due and the transmitter is idle
+    def _migrate_update(self):
+        if time() >= self._migrate_at:
+            with self._meshlock:
+                if len(self._transmit_queue) == 0:
+                    channel = self._migrate_channel
+                    self._migrate_channel = None
+                    with self._lock:
+                        self.set_standby_mode()
+                        self._control_channel = channel
+                        # Data channels hash around the rendezvous channel, so they move too
+                        self.set_channel(self._hash_channel(self.address) if self._multichannel and not self._split_control else channel)
+                        self.set_receive_mode()
+                    if self._split_control:
+                        with self._data_interface._lock:
+                            self._data_interface.set_standby_mode()
+                            self._data_interface.set_channel(self._hash_channel(self.address))
+                            self._data_interface.set_receive_mode()
+                    # A full sweep is needed before judging again
+                    self._noise = {}
+                    self._beacon_timer = 0
+
+    # Expect fixed size implicit header control frames while on the rendezvous channel
+    def _listen_length(self, channel, datarate):
+        if self._implicit_control and (channel, datarate) == (self._control_channel, self._control_datarate):
+            return self._control_length
+        return 0
 
-    # Write register to SPI port
-    def write_register(self, address, value):
-        # print("write %02x to %02x" % (value, address))
-        self._spi_transfer(address | 0x80, value)
+    # True if <packet> may be sent as an implicit header control frame
+    def _control_frame(self, packet):
+        return self._implicit_control and isinstance(packet, (RouteAnnounce, RouteRequest)) and len(packet) <= self._control_length
+
+    # Close an expired rendezvous window once the transmitter is idle and tell the
+    # neighbors, who were sending to us on the rendezvous channel, where we are now.
+    # With no neighbor to tell yet we stay, or nobody would ever hear from us again.
+    def _rendezvous_update(self):
+        if self._rendezvous_until != 0 and time() >= self._rendezvous_until:
+            with self._meshlock:
+                if len(self._transmit_queue) == 0 and len(self._neighbors) != 0:
+                    self._rendezvous_until = 0
+                    with self._lock:
+                        self.set_standby_mode()
+                        self.set_receive_mode()
+                    if not self._implicit_control:
+                        self._beacon_timer = 0
+
+    # Set the channel and datarate <packet> is sent on: where the next hop listens if known,
+    # else the rendezvous channel.  Broadcasts are queued once per distinct listening channel,
+    # leaving out channels where the only neighbors are the source and <heard_from>, who have it.
+    # With implicit control only route announces and requests go to the rendezvous channel.
+    def _link_packets(self, packet, heard_from=NULL_ADDRESS):
+        control = (self._control_channel, self._control_datarate)
+
+        if packet.nexthop() != BROADCAST_ADDRESS:
+            neighbor = self.find_neighbor(packet.nexthop())
+            link = self._neighbor_link(neighbor) if neighbor else (self._default_channel(packet.nexthop()), self._control_datarate)
+            packet.channel(link[0])
+            packet.datarate(link[1])
+            packet.implicit(False)
+            return [ packet ]
+
+        # Beacons find nodes that have not told us where they listen, as does anything while we are
+        # still meeting our neighbors; else the rendezvous channel is only for neighbors still there,
+        # unless it carries route control
+        if self._implicit_control:
+            links = [ control ] if self._control_frame(packet) else []
+        else:
+            links = [ control ] if self._split_control or isinstance(packet, Beacon) or self._rendezvous_until != 0 else []
+        with self._neighbor_lock:
+            for neighbor in self._neighbors.values():
+                link = self._neighbor_link(neighbor)
+                if link not in links and not neighbor.is_expired() and neighbor.address() not in (packet.source(), heard_from):
+                    links.append(link)
+
+            # The target answers a request as soon as it hears it.  A neighbor's channel is then the
+            # only one the request needs; with implicit control, where route control is on the
+            # rendezvous channel, its copy goes last so we are back listening when the announce comes.
+            target = self._neighbors[packet.target()] if isinstance(packet, RouteRequest) and packet.target() in self._neighbors else None
+            if target and not target.is_expired() and not self._implicit_control:
+                links = [ self._neighbor_link(target) ]
+            elif target:
+                link = self._neighbor_link(target)
+                if link in links:
+                    links.remove(link)
+                    links.append(link)
+
+        # Neighbors on a data channel only need a beacon to keep hearing from us; anything sent there does
+        if isinstance(packet, Beacon) and not self._beacon_all:
+            links = [ link for link in links if link == control or time() >= self._broadcast_sent.get(link, 0) + self._beacon_interval ]
+        for link in links:
+            self._broadcast_sent[link] = time()
+
+        packets = []
+        for link in links:
+            copy = self.dup_packet(packet) if len(packets) != 0 else packet
+            copy.channel(link[0])
+            copy.datarate(link[1])
+            copy.implicit(self._implicit_control and link == control)
+            packets.append(copy)
+
+        return packets
+
+    # Channel and datarate <neighbor> listens on; unknown parts fall back to the rendezvous values.
+    # Past the end of its rendezvous window a neighbor is on the data channel its address hashes to.
+    def _neighbor_link(self, neighbor):
+        channel = neighbor.channel() if self._multichannel and neighbor.channel() != None else self._default_channel(neighbor.address())
+        if neighbor.channel_until() != 0 and time() >= neighbor.channel_until():
+            channel = self._hash_channel(neighbor.address())
+        datarate = neighbor.datarate() if self._adr and neighbor.datarate() != None else self._control_datarate
+        return (channel, datarate)
+
+    # Channel to reach <address> on before it has told us.  The rendezvous channel unless that
+    # only carries implicit control frames; then the channel <address> hashes to.
+    def _default_channel(self, address):
+        return self._hash_channel(address) if self._implicit_control else self._control_channel
+
+    # True if we have a network time to schedule slots from.  Gateways are their own reference.
+    def time_synced(self):
+        return self._gateway or self._clock_synced != None
+
+    # Current network time in ms (ticks_ms domain)
+    def network_time(self):
+        now = ticks_ms()
+        if self._gateway or self._clock_synced == None:
+            return now
+        elapsed = ticks_diff(now, self._clock_synced)
+        return ticks_add(now, self._clock_offset + elapsed * self._clock_drift // 1000000)
+
+    # An announce from <source> carried network time <stamp> in a frame <airtime> ms long.
+    # Adjust our offset and estimate drift from the error since the last sync.
+    def time_reference(self, source, stamp, airtime):
+        if self._gateway:
+            return
+
+        if self._time_source != source:
+            if self._time_source != None and time() < self._time_source_heard + _TIME_SOURCE_LIFETIME:
+                # Stick with the current source while it is alive
+                return
+            self._time_source = source
+            self._clock_synced = None
+            self._clock_drift = 0
+
+        self._time_source_heard = time()
+
+        # The stamp was taken when the frame started; it arrived after its time on air
+        now = ticks_ms()
+        stamp = ticks_add(stamp, int(airtime))
+
+        if self._clock_synced != None:
+            interval = ticks_diff(now, self._clock_synced)
+            if interval > 0:
+                error = ticks_diff(stamp, self.network_time())
+                drift = self._clock_drift + error * 1000000 // interval // _CLOCK_DRIFT_WEIGHT
+                self._clock_drift = min(max(drift, -_CLOCK_DRIFT_MAX), _CLOCK_DRIFT_MAX)
+
+        self._clock_offset = ticks_diff(stamp, now)
+        self._clock_synced = now
+
+    # Milliseconds until a <airtime> ms frame fits inside our slot (0 if now)
+    def _slot_wait(self, airtime):
+        frame = self._tdma_slots * self._tdma_slot_time
+        start = self._tdma_slot * self._tdma_slot_time
+        position = self.network_time() % frame
+        # A frame too long for a slot may still start early in the slot
+        needed = min(airtime + _TDMA_GUARD, self._tdma_slot_time - _TDMA_GUARD)
+        if start <= position and position + needed <= start + self._tdma_slot_time:
+            return 0
+        wait = (start - position) % frame
+        return wait if wait != 0 else frame
+
+    # Length of the frame _frame() will build for <packet>
+    def _frame_length(self, packet):
+        if packet.implicit():
+            return self._control_length
+
+        length = len(packet)
+        if self._compress_header:
+            length += packet.compressed_header_length() - _HEADER_LENGTH
+
+        if isinstance(packet, Aggregate):
+            for item in packet.packets():
+                length += _AGGREGATE_ITEM_LEN + self._frame_length(item)
+            return length
+
+        return length + (_LINK_SEQUENCE_LEN if packet.link_sequence() != None else 0)
+
+    # Time on air in ms of the frame _frame() will build for <packet>
+    def _frame_airtime(self, packet):
+        return self.get_airtime(self._frame_length(packet), packet.datarate(), packet.implicit(), self._wake_preamble(packet))
+
+    # Largest frame allowed at the datarate <packet> will be sent at
+    def _max_frame_length(self, packet):
+        return min(self._domain.max_length(packet.datarate() if packet.datarate() != None else self.get_channel()[1]), _MAX_PACKET_LENGTH)
+
+    # Unicast data that is not yet on the air may be merged with others
+    def _aggregatable(self, packet):
+        return isinstance(packet, (DataPacket, Aggregate)) and packet.nexthop() not in (BROADCAST_ADDRESS, NULL_ADDRESS)
+
+    # Merge <packet> into a queued packet for the same next hop if the result fits in a frame.
+    # Returns True if merged.
+    def _aggregate_packet(self, packet):
+        if not self._aggregatable(packet):
+            return False
+
+        limit = self._max_frame_length(packet)
+        length = _AGGREGATE_ITEM_LEN + self._frame_length(packet)
+
+        queued = self._transmit_queue.items()
+        for entry in queued[1 if self._head_sent else 0:]:
+            if self._aggregatable(entry) and entry.nexthop() == packet.nexthop() and \
+               entry.channel() == packet.channel() and entry.datarate() == packet.datarate():
+                total = self._frame_length(entry) + length
+                if not isinstance(entry, Aggregate):
+                    total += _AGGR_LENGTH + _AGGREGATE_ITEM_LEN
+
+                if total <= limit:
+                    if not isinstance(entry, Aggregate):
+                        aggregate = Aggregate(nexthop=entry.nexthop(), target=entry.nexthop(), previous=self.address, source=self.address)
+                        aggregate.channel(entry.channel())
+                        aggregate.datarate(entry.datarate())
+                        aggregate.queued(entry.queued())
+                        aggregate.add(entry)
+                        self._transmit_queue.replace(entry, aggregate)
+                        entry = aggregate
+
+                    entry.add(packet)
+                    return True
+
+        return False
+
+    # True if <packet> will be sent with a link ack request
+    def _wants_link_ack(self, packet):
+        return self._link_ack and isinstance(packet, (DataPacket, Fragment)) and packet.nexthop() != BROADCAST_ADDRESS
+
+    # Split <packet> into Fragments that each fit in a frame at its datarate
+    def _fragment(self, packet):
+        data = packet.data()
+        size = self._max_frame_length(packet) - _FRAG_LENGTH - (_LINK_SEQUENCE_LEN if self._wants_link_ack(packet) else 0)
+        if size <= 0 or (len(data) + size - 1) // size > _FRAGMENT_MAX_COUNT:
+            raise MeshNetException("Packet too large to fragment: %d bytes" % len(data))
+        count = (len(data) + size - 1) // size
 
-    def _spi_transfer(self, address, value=0):
-        response = bytearray(1)
-        self._ss.value(0)
-        self._spi.write(bytes([address]))
-        self._spi.write_readinto(bytes([value]), response)
-        self._ss.value(1)
-        return response
+        with self._hwmp_sequence_lock:
+            self._fragment_sequence_number = (self._fragment_sequence_number + 1) % 0x10000
+            message = self._fragment_sequence_number
+
+        fragments = []
+        for index in range(count):
+            fragment = Fragment(nexthop=packet.nexthop(), target=packet.target(), previous=packet.previous(), source=packet.source(), ttl=packet.ttl(),
+                                message=message, index=index, count=count, payload=data[index * size:(index + 1) * size])
+            fragment.channel(packet.channel())
+            fragment.datarate(packet.datarate())
+            fragments.append(fragment)
+
+        return fragments
+
+    # Collect a fragment addressed to us.  When all have arrived, process the original packet.
+    def reassemble(self, fragment):
+        key = (fragment.source(), fragment.message())
+        payload = fragment.payload()
+
+        if key not in self._reassembly:
+            # A source sends its messages one after another, so a newer one means the rest of older ones is not coming
+            for item in list(self._reassembly):
+                if item[0] == key[0] and sequence_newer(key[1], item[1]):
+                    self._drop_reassembly(item)
+
+            # Make room: drop the oldest partial packets when over the limits
+            while len(self._reassembly) != 0 and (len(self._reassembly) >= _REASSEMBLY_MAX_MESSAGES or
+                                                  self._reassembly_bytes + len(payload) > _REASSEMBLY_MAX_BYTES):
+                oldest = None
+                for item in self._reassembly:
+                    if oldest == None or self._reassembly[item].started < self._reassembly[oldest].started:
+                        oldest = item
+                self._drop_reassembly(oldest)
+
+            self._reassembly[key] = Reassembly(fragment.count())
+
+        entry = self._reassembly[key]
+        if self._reassembly_bytes + len(payload) > _REASSEMBLY_MAX_BYTES:
+            # Too big to ever fit
+            self._drop_reassembly(key)
+            return
+
+        size = entry.size
+        entry.add(fragment.index(), payload)
+        self._reassembly_bytes += entry.size - size
+
+        if entry.complete():
+            del(self._reassembly[key])
+            self._reassembly_bytes -= entry.size
+            packet = self.wrap_packet(entry.data(), fragment.rssi(), fragment.metadata())
+            if self._debug:
+                print("Reassembled: %s" % str(packet))
+            packet.process(self)
+
+    def _drop_reassembly(self, key):
+        self._reassembly_bytes -= self._reassembly[key].size
+        del(self._reassembly[key])
+        self._reassembly_failures.inc()
+
+    # Hold time is over; send whatever has gathered at the head of the queue
+    def _hold_timer(self, timer):
+        with self._meshlock:
+            self._hold_timer_pending = False
+            packet = self._transmit_queue.head()
+            if packet and not self._head_sent:
+                self._transmit_head(packet)
+
+    # Milliseconds <packet> must wait before it may be sent: for acks to our last frame,
+    # or for our slot if TDMA is running
+    def _transmit_wait(self, packet):
+        wait = self._ack_wait(self)
+        if wait != 0 or not self._tdma or not self.time_synced():
+            return wait
+        return self._slot_wait(self._frame_airtime(packet))
+
+    # Restart transmit queue at the start of our slot or when the ack window closes
+    def _restart_timer(self, timer):
+        with self._meshlock:
+            self._restart_timer_pending = False
+            packet = self._transmit_queue.head()
+            if packet and not self._head_sent:
+                self._transmit_head(packet)
+
+    # Send <packet> at the head of the transmit queue now, or arm restart timer if not our turn
+    def _transmit_head(self, packet):
+        wait = self._transmit_wait(packet)
+        if wait == 0:
+            self._head_sent = True
+            self.transmit_packet(self._frame(packet))
+            if self._debug:
+                print("Transmitted: %s" % str(packet))
+            return True
 
-    # Read block of data from SPI port
-    def read_buffer(self, address, length):
-        try:
-            response = bytearray(length)
-            self._ss.value(0)
-            self._spi.write(bytes([address & 0x7F]))
-            self._spi.readinto(response)
-            self._ss.value(1)
+        if not self._restart_timer_pending:
+            self._restart_timer_pending = True
+            allocated = self._alloc.begin() if self._alloc else 0
+            self._call_later(wait / 1000.0, self._restart_timer)
+            if self._alloc:
+                self._alloc.end(ALLOC_TIMER, allocated, packet.protocol())
 
-        except:
-            # No room.  gc now
-            gc.collect()
-            response = None
+        # Have it in the FIFO when the slot comes, if the radio is idle in Standby
+        self.preload_packet(self._encode(packet))
+        return False
 
-        return response
+    # Enwrap the packet with a class object for the particular message type
+    def wrap_packet(self, data, rssi=None, metadata=None):
+        return self.get_protocol_wrapper(data[_HEADER_PROTOCOL[0]])(load=data, rssi=rssi, metadata=metadata)
+        
+    # Duplicate packet with new private data
+    def dup_packet(self, packet):
+        return self.wrap_packet(bytearray(packet.data()), rssi=packet.rssi(), metadata=packet.metadata())
 
-    # Write block of data to SPI port
-    def write_buffer(self, address, buffer, size):
-        self._ss.value(0)
-        self._spi.write(bytes([address | 0x80]))
-        self._spi.write(memoryview(buffer)[0:size])
-        self._ss.value(1)
+    # Frames from our own radio, or from <interface> for the others
+    # <aggregated> packets came inside an Aggregate, whose frame was already captured and traced
+    def onReceive(self, data, crc_ok, rssi, snr=None, metadata=None, interface=None, aggregated=False):
+        # Frames received without a header are implicit control frames with the full header
+        implicit = (self if interface == None else interface)._current_implicit_header
 
-    def attach_interrupt(self, dio, edge, callback):
-        # if self._debug:
-        #    print("attach_interrupt dio %d rising %s with callback %s" % (dio, edge, callback))
+        if self._capture and not aggregated:
+            self._capture.frame((0 if crc_ok else CAPTURE_CRC_ERROR) | (CAPTURE_IMPLICIT if implicit else 0),
+                                data, 0 if interface == None else interface.index(), rssi, snr)
 
-        if dio < 0 or dio >= len(self._dio_table):
-            raise Exception("DIO %d out of range (0..%d)" % (dio, len(self._dio_table) - 1))
+        allocated = self._alloc.begin() if self._alloc else 0
 
-        edge = Pin.IRQ_RISING if edge else Pin.IRQ_FALLING
-        self._dio_table[dio].irq(handler=callback, trigger=edge if callback else 0)
+        if crc_ok and self._compress_header and not implicit:
+            data = expand_header(data)
+            if data == None:
+                self._packets_ignored.inc()
+                return
 
-    # Enwrap the packet with a class object for the particular message type
-    def wrap_packet(self, data, rssi=None):
-        return self.get_protocol_wrapper(data[_HEADER_PROTOCOL[0]])(load=data, rssi=rssi)
-        
-    # Duplicate packet with new private data
-    def dup_packet(self, packet):
-        return self.wrap_packet(bytearray(packet.data()), rssi=packet.rssi())
+        if crc_ok and (len(data) < _HEADER_LENGTH or
+                       (data[_HEADER_PROTOCOL[0]] & _PROTOCOL_ACK_REQUEST and len(data) < _HEADER_LENGTH + _LINK_SEQUENCE_LEN)):
+            # Too short for the header it claims
+            self._packets_ignored.inc()
+            return
 
-    def onReceive(self, data, crc_ok, rssi):
         if crc_ok:
-            packet = self.wrap_packet(data, rssi)
+            # Remove link sequence number if sender wants an ack
+            sequence = None
+            if data[_HEADER_PROTOCOL[0]] & _PROTOCOL_ACK_REQUEST:
+                sequence = (data[-2] << 8) | data[-1]
+                data = data[:-_LINK_SEQUENCE_LEN]
+                data[_HEADER_PROTOCOL[0]] &= ~_PROTOCOL_ACK_REQUEST
+
+            if implicit and data[_HEADER_PROTOCOL[0]] == RouteRequest.PROTOCOL_ID:
+                # Drop the padding up to the control frame length
+                data = data[:_RREQ_LENGTH]
+
+            packet = self.wrap_packet(data, rssi, metadata)
+            if isinstance(packet, Aggregate):
+                packet.received(snr, interface)
+            if self._trace and not aggregated:
+                self._trace.record(TRACE_WRAP, data, 0 if interface == None else interface.index())
+
+            if implicit:
+                packet.implicit(True)
+                packet.datarate(self._control_datarate)
 
             nexthop = packet.nexthop()
+            neighbor = self.update_neighbor(packet.previous())
+            if not aggregated:
+                # Once per frame on the air
+                neighbor.signal_sample(rssi, snr)
+                self._neighbor_frames.inc(packet.previous())
+            self._packets_size.observe(len(data))
+            neighbor.interface(0 if interface == None else interface.index())
+            if self._alloc:
+                self._alloc.end(ALLOC_RX_WRAP, allocated, packet.protocol())
+
+            if sequence != None and nexthop == self.address:
+                # Ack even if a duplicate, since our earlier ack may have been lost
+                self.send_packet(LinkAck(nexthop=packet.previous(), target=packet.previous(), sequence=sequence))
+                if neighbor.duplicate(sequence):
+                    self._packets_ignored.inc()
+                    return
 
             if self._debug:
-                print("Received: %s" % (str(packet)))
+                allocated = self._alloc.begin() if self._alloc else 0
+                print("Received: %s%s" % (str(packet), "" if metadata == None else " " + str(metadata)))
+                if self._alloc:
+                    self._alloc.end(ALLOC_RX_DEBUG, allocated, packet.protocol())
 
             # In promiscuous, deliver to receiver so it can handle it (but not process it)
             if self._promiscuous:
@@ -798,25 +2472,31 @@ class MeshNet(RadioDriver):
                 self.put_receive_packet(packet_copy)
 
             if nexthop == BROADCAST_ADDRESS or nexthop == self.address:
-                self._packet_received += 1
+                self._packets_received.inc(packet.protocol())
+                if self._trace and not aggregated:
+                    self._trace.record(TRACE_PROCESS, packet.data(), 0 if interface == None else interface.index())
+
                 # To us or broadcasted
+                allocated = self._alloc.begin() if self._alloc else 0
                 packet.process(self)
+                if self._alloc:
+                    self._alloc.end(ALLOC_RX_PROCESS, allocated, packet.protocol())
 
             else:
                 # It is non processed
-                self._packet_ignored += 1
+                self._packets_ignored.inc()
 
         else:
-            self._packet_errors_crc += 1
+            self._packets_crc_errors.inc()
 
 
     def receive_packet(self):
-        gc.collect()
+        umemory.request()
         return self._receive_queue.get()
 
     def put_receive_packet(self, packet):
         self._receive_queue.put(packet)
-        gc.collect()
+        umemory.request()
 
     # Finished transmitting - see if we can transmit another
     # If we have another packet, return it to caller.
@@ -824,33 +2504,233 @@ class MeshNet(RadioDriver):
         # if self._debug:
         #    print("onTransmit complete")
 
-        self._packet_transmitted += 1
-
         # Delete top packet in queue
         packet = self._transmit_queue.get(wait=0)
-        del packet
+        if self._trace and packet:
+            self._trace.record(TRACE_TX_DONE, packet.data())
+        self._transmitted(packet)
+        self._head_sent = False
 
         # Return head of queue if one exists
         packet = self._transmit_queue.head()
 
-        gc.collect()
+        # Interrupt path: never collect here
+        umemory.request()
+
+        if packet and self._transmit_wait(packet) != 0:
+            # Not our turn; receive until the restart timer restarts the queue
+            self._transmit_head(packet)
+            packet = None
+
+        if packet:
+            self._head_sent = True
+
+        return self._frame(packet) if packet else None
+
+    # <packet> has gone out on <radio>, this one if not given.
+    # Hold on to packets needing a link ack until acked or retries exhausted.
+    def _transmitted(self, packet, radio=None):
+        if packet:
+            self._packets_transmitted.inc(packet.protocol())
+            if packet.queued() != None:
+                self._transmit_latency.observe(ticks_diff(ticks_ms(), packet.queued()))
+
+        acks = 0
+        for item in (packet.packets() if isinstance(packet, Aggregate) else [ packet ]) if packet else []:
+            if item.link_sequence() != None:
+                key = (item.nexthop(), item.link_sequence())
+                pending = self._ack_pending[key] if key in self._ack_pending else None
+                if pending == None:
+                    self._ack_pending[key] = PendingAck(item, self._link_rto(key[0]))
+                else:
+                    pending.sent(self._link_rto(key[0], pending.retries))
+                acks += 1
+
+        if acks != 0:
+            self._open_ack_window(self if radio == None else radio, packet.nexthop(), acks)
+
+    # The radio is half duplex: after a frame asking <address> for <acks> acks, <radio> only
+    # listens until they are in or have had time to arrive, so its next frame cannot bury them.
+    # <hold> ms more are added for anything else <address> has to send first.
+    def _open_ack_window(self, radio, address, acks, hold=0):
+        datarate = radio.get_channel()[1]
+        preamble = radio.get_preamble_length(radio._listen_interval, datarate) if radio._listen_interval != 0 else None
+        airtime = radio.get_airtime(_LACK_LENGTH, datarate, False, preamble)
+        window = int(acks * (airtime + radio._delay * 1000) + _LINK_ACK_TURNAROUND + hold)
+        radio._ack_window = (address, acks, ticks_add(ticks_ms(), window))
+
+    # Milliseconds <radio> must keep listening for acks before sending again
+    def _ack_wait(self, radio):
+        window = radio._ack_window
+        if window == None:
+            return 0
+        wait = ticks_diff(window[2], ticks_ms())
+        if wait <= 0:
+            radio._ack_window = None
+            return 0
+        return wait
+
+    # Build the over-the-air frame for <packet> and tune the transmitter for it
+    def _frame(self, packet):
+        self.set_transmit_channel(packet.channel(), packet.datarate(), packet.implicit(), self._wake_preamble(packet))
+        if not self._alloc:
+            return self._encode(packet)
+
+        allocated = self._alloc.begin()
+        frame = self._encode(packet)
+        self._alloc.end(ALLOC_TX_ENCODE, allocated, packet.protocol())
+        return frame
+
+    # Over-the-air bytes for <packet>
+    def _encode(self, packet):
+        if packet.implicit():
+            # Full header and a fixed length, since the receiver has no LoRa header to go by
+            frame = bytearray(self._encode_packet(packet))
+            frame.extend(bytearray(self._control_length - len(frame)))
+            return frame
+
+        frame = self._encode_packet(packet)
+        return compress_header(frame) if self._compress_header else frame
+
+    # Bytes for <packet> with a full header
+    def _encode_packet(self, packet):
+        if isinstance(packet, Aggregate):
+            frame = bytearray(packet.data())
+            for item in packet.packets():
+                data = self._encode(item)
+                frame.append(len(data))
+                frame.extend(data)
+            return frame
+
+        # Stamp time references as late as possible; drop them if we have no time to give
+        if isinstance(packet, RouteAnnounce) and packet.time_flag():
+            if self._tdma and self.time_synced() and len(packet) >= _RANN_TIME_LENGTH:
+                packet.timestamp(self.network_time())
+            else:
+                packet.time_flag(False)
+
+        if packet.link_sequence() == None:
+            return packet.data()
+
+        frame = bytearray(packet.data())
+        frame[_HEADER_PROTOCOL[0]] |= _PROTOCOL_ACK_REQUEST
+        frame.extend(packet.link_sequence().to_bytes(_LINK_SEQUENCE_LEN, 'big'))
+        return frame
+
+    # Retransmit timeout for packets sent to <address>
+    def _link_rto(self, address, retries=0):
+        neighbor = self.find_neighbor(address)
+        if neighbor and neighbor.srtt() != None:
+            return neighbor.rto(retries)
+        # Until measured, allow for the ack's wake preamble if we sniff
+        rto = neighbor.rto(retries) if neighbor else min(_LINK_ACK_TIMEOUT << retries, _LINK_ACK_TIMEOUT_MAX)
+        return rto + int(self._listen_interval * 1000)
+
+    def _create_link_sequence_number(self):
+        with self._hwmp_sequence_lock:
+            self._link_sequence_number = (self._link_sequence_number + 1) % 0x10000
+            return self._link_sequence_number
+
+    # A LinkAck arrived from <address> for <sequence>
+    def link_ack_received(self, address, sequence):
+        with self._meshlock:
+            key = (address, sequence)
+            if key in self._ack_pending:
+                pending = self._ack_pending.pop(key)
+                # Karn's rule: only sample packets that were not retransmitted
+                if pending.retries == 0:
+                    self.update_neighbor(address).rtt_sample(ticks_diff(ticks_ms(), pending.started))
+
+                # Once every ack a radio is waiting for is in, it may send again
+                for radio in self._interfaces:
+                    window = radio._ack_window
+                    if window != None and window[0] == address:
+                        if window[1] > 1:
+                            radio._ack_window = (address, window[1] - 1, window[2])
+                        else:
+                            radio._ack_window = None
+                            if pending.packet.target() != address:
+                                # The next hop passes it on now; wait until that and its ack are done
+                                # so our next frame does not bury them at the next hop
+                                self._open_ack_window(radio, address, 1, self._frame_airtime(pending.packet))
+                            radio._restart_timer(None)
+
+    # Resend packets whose ack has timed out; declare link failure when retries run out
+    def _retry_link_acks(self):
+        now = ticks_ms()
+        failed = []
+        with self._meshlock:
+            for key in list(self._ack_pending):
+                pending = self._ack_pending[key]
+                if pending.is_expired(now):
+                    if pending.retries < self._link_ack_retries:
+                        pending.retries += 1
+                        # Restart timer now; restarted again when transmit actually completes
+                        pending.sent(_LINK_ACK_TIMEOUT_MAX)
+                        self._link_retransmits.inc()
+                        if self._debug:
+                            print("Link retry %d %s" % (pending.retries, str(pending.packet)))
+                        if self._adr or self._multichannel:
+                            # Next hop may have moved since
+                            self._link_packets(pending.packet)
+                        self._queue_packet(pending.packet)
+                    else:
+                        del(self._ack_pending[key])
+                        failed.append((key[0], pending.packet))
+
+        # Outside of meshlock since this takes the route lock
+        for address, packet in failed:
+            self._link_failed(address, packet)
+
+    # The link to <address> has failed while sending <packet>.
+    # Remove routes through that neighbor and tell the source.
+    def _link_failed(self, address, packet):
+        self._link_failures.inc()
+
+        neighbor = self.find_neighbor(address)
+        if neighbor:
+            neighbor.failures(neighbor.failures() + 1)
+
+        if self._debug:
+            print("Link to %s failed: %s" % (ADDR_OF(address), str(packet)))
+
+        with self._route_lock:
+            for target in list(self._routes):
+                if self._routes[target].nexthop() == address:
+                    del(self._routes[target])
 
-        return packet.data() if packet else None
+        if packet.source() != self.address:
+            self.send_packet(RouteError(target=packet.source(), address=packet.target(), reason=_RERR_REASON_LINK_FAILURE))
 
     def _create_sequence_number(self):
         with self._hwmp_sequence_lock:
-            self._hwmp_sequence_number += 1
+            self._hwmp_sequence_number = (self._hwmp_sequence_number + 1) % (1 << (8 * _SEQUENCE_NUMBER_LEN))
             return self._hwmp_sequence_number
 
     # A packet with a source and destination is ready to transmit.
     # Label the from address and if no to address, attempt to route
     # If ttl is true, decrease ttl and discard packet if 0
     def send_packet(self, packet, ttl=False):
+        # Data from here; the protocol may have been changed since it was made
+        if isinstance(packet, DataPacket) and packet.source() in (NULL_ADDRESS, self.address):
+            check_data_protocol(packet.protocol())
+
+        if not self._alloc:
+            return self._send_packet(packet, ttl)
+
+        allocated = self._alloc.begin()
+        self._send_packet(packet, ttl)
+        self._alloc.end(ALLOC_TX_SEND, allocated, packet.protocol())
+
+    def _send_packet(self, packet, ttl):
         if ttl and packet.ttl(packet.ttl() - 1) == 0:
             # Packet has expired
             if self._debug:
                 print("Expired: %s" % str(packet))
         else:
+            # Passed on from this neighbor, if not our own
+            heard_from = packet.previous()
+
             # Label packets as coming from us
             packet.previous(self.address)
             # print("%s: set previous to %d" % (str(packet), self.address))
@@ -866,6 +2746,8 @@ class MeshNet(RadioDriver):
                 with self._route_lock:
                     # Look up the route to the destination
                     route = self.find_route(packet.target())
+                    if self._trace:
+                        self._trace.record(TRACE_ROUTE_LOOKUP, packet.data())
 
                     # If no route, create a dummy route and queue the results
                     if route == None:
@@ -874,6 +2756,8 @@ class MeshNet(RadioDriver):
 
                         # Save packet in route for later delivery
                         route.put_pending_packet(packet)
+                        if self._trace:
+                            self._trace.record(TRACE_PENDING_ENQUEUE, packet.data())
 
                         if self._debug:
                             print("Routing %s" % str(packet))
@@ -886,6 +2770,8 @@ class MeshNet(RadioDriver):
                         # We still have a pending route, so append packet to queue only.
                         request = None
                         route.put_pending_packet(packet)
+                        if self._trace:
+                            self._trace.record(TRACE_PENDING_ENQUEUE, packet.data())
 
                     else:
                         # Label the destination for the packet
@@ -908,46 +2794,155 @@ class MeshNet(RadioDriver):
                 # if self._debug:
                 #     print("sending: %s" % str(packet))
 
-                with self._meshlock:
-                    # print("Appending to queue: %s" % packet.decode())
-                    self._transmit_queue.put(packet)
-                    if len(self._transmit_queue) == 1:
-                        self.transmit_packet(packet.data())
-                        if self._debug:
-                            print("Transmitted: %s" % str(packet))
+                for packet in self._link_packets(packet, heard_from) if self._adr or self._multichannel else [ packet ]:
+                    # Split what does not fit in one frame at this datarate
+                    length = self._frame_length(packet) + (_LINK_SEQUENCE_LEN if self._wants_link_ack(packet) else 0)
+                    for packet in self._fragment(packet) if length > self._max_frame_length(packet) else [ packet ]:
+                        # Unicast data gets a link sequence number so the next hop can ack it
+                        if self._wants_link_ack(packet):
+                            packet.link_sequence(self._create_link_sequence_number())
+
+                        self._queue_packet(packet)
+
+    # Radio to send <packet> on.  With split control, broadcasts and route control stay on
+    # this radio and unicast goes to the least busy data radio.  Otherwise unicast goes where
+    # the next hop was last heard.
+    def _select_interface(self, packet):
+        if self._split_control:
+            if packet.nexthop() == BROADCAST_ADDRESS or packet.implicit():
+                return self
+            best = self._data_interface
+            for interface in self._interfaces[2:]:
+                if interface.pending() < best.pending():
+                    best = interface
+            return best
+
+        neighbor = self.find_neighbor(packet.nexthop()) if packet.nexthop() != BROADCAST_ADDRESS else None
+        return self._interfaces[neighbor.interface()] if neighbor and neighbor.interface() != None else self
+
+    # Put packet on transmit queue and start transmitter if idle
+    def _queue_packet(self, packet):
+        if not self._alloc:
+            return self._enqueue_packet(packet)
+
+        allocated = self._alloc.begin()
+        self._enqueue_packet(packet)
+        self._alloc.end(ALLOC_TX_QUEUE, allocated, packet.protocol())
+
+    def _enqueue_packet(self, packet):
+        if len(self._interfaces) > 1:
+            if packet.nexthop() == BROADCAST_ADDRESS and not self._split_control:
+                # Every radio reaches its own neighbors
+                for interface in self._interfaces[1:]:
+                    interface.queue_packet(self.dup_packet(packet))
+            else:
+                interface = self._select_interface(packet)
+                if interface is not self:
+                    interface.queue_packet(packet)
+                    return
+
+        with self._meshlock:
+            if self._trace:
+                self._trace.record(TRACE_TX_ENQUEUE, packet.data())
+            packet.queued(ticks_ms())
+
+            if self._aggregate and self._aggregate_packet(packet):
+                return
+
+            # print("Appending to queue: %s" % packet.decode())
+            if isinstance(packet, LinkAck):
+                # Ahead of anything not yet on the air; the sender is holding its next frame for it
+                self._transmit_queue.insert(1 if self._head_sent else 0, packet)
+            else:
+                self._transmit_queue.put(packet)
+            if len(self._transmit_queue) == 1:
+                if self._aggregate and self._aggregate_hold != 0 and self._aggregatable(packet):
+                    # Give others a moment to join this one
+                    if not self._hold_timer_pending:
+                        self._hold_timer_pending = True
+                        allocated = self._alloc.begin() if self._alloc else 0
+                        self._call_later(self._aggregate_hold, self._hold_timer)
+                        if self._alloc:
+                            self._alloc.end(ALLOC_TIMER, allocated, packet.protocol())
+                else:
+                    self._transmit_head(packet)
 
     # A thread to check all routes and those with resend the packets for those with retry requests
     def _retry_routerequests(self, thread, timeout):
         while thread.running:
             sleep(timeout)
-            with self._route_lock:
-                # Go through all routes looking for those with pending requests.
-                for target in list(self._routes):
-                    route = self._routes[target]
-                    # If route is expired, remove it
-                    if route.is_expired():
-                        # Clean up route
-                        del(self._routes[target])
-
-                    # Otherwise if it has a pending request, resend it
-                    else:
-                        packet = route.get_pending_routerequest()
-                        if packet:
-                            if self._debug:
-                                print("Retry route request %s" % str(packet))
-                            self.send_packet(packet)
+            self._maintain()
+
+    # Periodic upkeep: route request and link ack retries, ADR, beacons, channel
+    # scanning and migration, and expiry of reassemblies and neighbors
+    def _maintain(self):
+        with self._route_lock:
+            # Go through all routes looking for those with pending requests.
+            for target in list(self._routes):
+                route = self._routes[target]
+                # If route is expired, remove it
+                if route.is_expired():
+                    # Clean up route
+                    del(self._routes[target])
+
+                # Otherwise if it has a pending request, resend it
+                else:
+                    packet = route.get_pending_routerequest()
+                    if packet:
+                        # A new sequence so the nodes that passed on the last try do so again
+                        packet.sequence(self._create_sequence_number())
+                        if self._debug:
+                            print("Retry route request %s" % str(packet))
+                        self.send_packet(packet)
+
+        if self._link_ack:
+            self._retry_link_acks()
+
+        if self._adr:
+            self._adr_update()
+
+        if self._adr or self._multichannel or self._listen_interval != 0:
+            self._beacon_update()
+
+        if self._multichannel:
+            self._rendezvous_update()
+
+        if self._scan:
+            self._scan_update()
+
+        if self._migrate_channel != None:
+            self._migrate_update()
+
+        # Give up on fragmented packets that never completed
+        with self._packet_lock:
+            for key in list(self._reassembly):
+                if self._reassembly[key].is_expired():
+                    self._drop_reassembly(key)
+
+        # Forget neighbors not heard from in a while
+        with self._neighbor_lock:
+            for address in list(self._neighbors):
+                if self._neighbors[address].is_expired():
+                    del(self._neighbors[address])
 
     def stop(self):
+        # Never started or already stopped
+        if self._spi == None:
+            return
+
         # Stop announce if running
         if self._announce_thread:
             self._announce_thread.stop()
             self._announce_thread.wait()
             self._announce_thread = None
 
-        if self._retry_routerequest_thread != None:
-            self._retry_routerequest_thread.stop()
-            self._retry_routerequest_thread.wait()
-            self._retry_routerequest_thread = None
+        if self._retry_routerequests_thread != None:
+            self._retry_routerequests_thread.stop()
+            self._retry_routerequests_thread.wait()
+            self._retry_routerequests_thread = None
+
+        for interface in self._interfaces[1:]:
+            interface.stop()
 
         super(MeshNet, self).stop()
 
@@ -956,13 +2951,14 @@ class MeshNet(RadioDriver):
 
         print("MeshNet handler close called")
         # Close DIO interrupts
-        for dio in self._dio_table:
-            dio.irq(handler=None, trigger=0)
+        for interface in self._interfaces:
+            interface._close()
 
-        # Close SPI channel if opened
+        # Close SPI channel if opened; it is shared by all radios
         if self._spi:
             self._spi.deinit()
-            self._spi = None
+            for interface in self._interfaces:
+                interface._spi = None
 
     def set_power(self, power=True):
         # print("set_power %s" % power)
@@ -973,13 +2969,8 @@ class MeshNet(RadioDriver):
             # Call base class
             super(MeshNet, self).set_power(power)
 
+            for interface in self._interfaces[1:]:
+                interface.set_power(power)
+
     def __del__(self):
         self.stop()
-
-    def dump(self):
-        item = 0
-        for reg in range(0x43):
-            print("%02x: %02x" % (reg, self.read_register(reg)), end="    " if item != 7 else "\n")
-            item = (item + 1) % 8
-        print("")
-
@@ -0,0 +1,135 @@
+#
+# uasyncio engine for MeshNet
+#
+# AsyncMeshNet runs the stack as tasks on one uasyncio loop instead of threads:
+#    - DIO interrupts only stamp the time and set a ThreadSafeFlag; a task per pin runs
+#      the driver's handler
+#    - route request and link ack retries, ADR, beacons and expiry run in one task, and
+#      gateway announces in another
+#    - per-packet timers (transmit delay, aggregate hold, TDMA slot) are tasks that sleep
+#    - noise scans take one RSSI reading per task step instead of sleeping between them
+#    - applications await receive_packet_async() and send_packet_async()
+#
+# Every handler runs to completion on the one thread, so the locks the stack takes are
+# never contended; acquiring one is a flag test.  There are no 8 KB thread stacks.
+#
+#    async def main():
+#        mesh = AsyncMeshNet(domain, address, channel=(64, 8))
+#        mesh.start()
+#        asyncio.create_task(manage_memory(MemoryManager(metrics=mesh.metrics())))
+#        asyncio.create_task(MeshNetWebServer(config, meshnet=mesh).serve())
+#        while True:
+#            packet = await mesh.receive_packet_async()
+#
+#    asyncio.run(main())
+#
+# start() must be called from a task.  It blocks the loop for the 100 ms radio reset, as
+# do channel migrations for the few SPI writes of retuning.  Low power listening
+# (listen_interval) and frame capture still use a thread of their own when turned on.
+#
+import uasyncio as asyncio
+from time import ticks_us
+from meshnet import MeshNet
+
+_TRANSMIT_BACKLOG   = 8         # send_packet_async waits while this many packets are queued
+_TRANSMIT_POLL      = 0.01      # Seconds between checks of a full transmit queue
+
+# Call <func>(None, *<args>) after <delay> seconds from a task
+def task_call_later(delay, func, *args):
+    asyncio.create_task(_later(delay, func, args))
+
+async def _later(delay, func, args):
+    await asyncio.sleep(delay)
+    func(None, *args)
+
+# DIO interrupt stub: notes the edge time and wakes the task that runs the handler.
+# The bound method is made once since hard interrupts must not allocate.
+class IrqFlag():
+    def __init__(self):
+        self.ticks = None
+        self.callback = None
+        self.handler = self._interrupt
+        self._pin = None
+        self._flag = asyncio.ThreadSafeFlag()
+
+    def _interrupt(self, pin):
+        self.ticks = ticks_us()
+        self._pin = pin
+        self._flag.set()
+
+    async def run(self):
+        while True:
+            await self._flag.wait()
+            if self.callback:
+                self.callback(self._pin)
+
+# Run a umemory.MemoryManager as a task instead of a thread
+async def manage_memory(manager):
+    manager.install()
+    while True:
+        await asyncio.sleep(manager.interval())
+        manager.poll()
+
+class AsyncMeshNet(MeshNet):
+    def __init__(self, domain, address, **kwargs):
+        kwargs['call_later'] = task_call_later
+        kwargs['edge_stamp'] = IrqFlag
+        super().__init__(domain, address, **kwargs)
+
+        self._tasks = []
+        self._received = asyncio.Event()
+
+    def start(self):
+        super().start()
+        for interface in self._interfaces:
+            for stamp in interface._edge_stamps:
+                self._tasks.append(asyncio.create_task(stamp.run()))
+
+    # Upkeep as a task in place of the route request retry thread
+    def _start_maintenance(self, timeout):
+        self._tasks.append(asyncio.create_task(self._maintenance(timeout)))
+
+    async def _maintenance(self, timeout):
+        while True:
+            await asyncio.sleep(timeout)
+            self._maintain()
+
+    # Scan in steps so the loop keeps running between readings
+    def _scan_noise(self, channel, samples):
+        self.scan_channel_later(channel, samples, self._control_datarate, lambda values: self._scan_done(channel, values))
+
+    def announce_start(self, interval):
+        print("Announce gateway every %.1f seconds" % interval)
+        self._tasks.append(asyncio.create_task(self._announcing(interval)))
+
+    async def _announcing(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self._send_announce()
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        super().stop()
+
+    def put_receive_packet(self, packet):
+        super().put_receive_packet(packet)
+        self._received.set()
+
+    # Next packet delivered to us, waiting as long as it takes
+    async def receive_packet_async(self):
+        while True:
+            # Clear before looking, so a packet put by another thread in between still wakes us
+            self._received.clear()
+            packet = self._receive_queue.get(wait=0)
+            if packet != None:
+                return packet
+            await self._received.wait()
+
+    # Send <packet>, first letting the transmit queue drain below its backlog
+    async def send_packet_async(self, packet, ttl=False):
+        while len(self._transmit_queue) >= _TRANSMIT_BACKLOG:
+            await asyncio.sleep(_TRANSMIT_POLL)
+        self.send_packet(packet, ttl)
+        await asyncio.sleep(0)
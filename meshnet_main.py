@@ -54,10 +54,15 @@ CONFIG_DATA = ConfigData(read = storage,
                                 'address': '1',
                                 'channel': '0',
                                 'datarate': '0',
+                                'trace': '0',
+                                'capture': '',
+                                'alloc': '0',
+                            },
+                            'memory': {
+                                'budget': '20',
                             },
                          })
 
-gc.threshold(20000)
 gc.collect()
 
 from ssd1306_i2c import Display
@@ -66,23 +71,42 @@ display.show_text_wrap("Starting...")
 
 _ADDRESS = int(CONFIG_DATA.get("mesh.address", "1"))
 
-from meshdomains import US902_MESHNET as domain
+from meshdomains import US902_MESHNET
+from sx127x import load_domain
 from meshnet import MeshNet, DataPacket, BROADCAST_ADDRESS
 
+domain = load_domain(US902_MESHNET, "US902_MESHNET.tbl")
+
 meshnet=MeshNet(
         domain,
         enable_crc=True,
         address=_ADDRESS,
         channel=(int(CONFIG_DATA.get("mesh.channel", default='64')), int(CONFIG_DATA.get("mesh.datarate", default='-1'))),
+        trace=int(CONFIG_DATA.get("mesh.trace", default='0')),
+        alloc_profile=CONFIG_DATA.get("mesh.alloc", default='0') == '1',
 )
+# Collect from a thread of its own, within a time budget, instead of in the radio paths
+from umemory import MemoryManager
+memory = MemoryManager(budget=int(CONFIG_DATA.get("memory.budget", default='20')), metrics=meshnet.metrics())
+memory.start()
+
 # meshnet.set_promiscuous(True)
 # meshnet.set_debug(True)
 meshnet.start()
 
+# Log raw frames to a file on flash for emulator/replay.py
+# The file is kept so it can be closed, after the capture's last flush, on shutdown.
+_CAPTURE = CONFIG_DATA.get("mesh.capture", default='')
+capture_file = None
+if _CAPTURE:
+    capture_file = open(_CAPTURE, 'wb')
+    meshnet.set_capture(capture_file)
+
 # Start web server
 from meshnetwebserver import *
 webserver = MeshNetWebServer(
         config=CONFIG_DATA,
+        meshnet=meshnet,
         display=lambda text, line=4, clear=False : display.show_text_wrap(text, start_line=line, clear_first=clear),
 )
 webserver.start()
@@ -90,6 +114,7 @@ webserver.start()
 led = machine.Pin(25, machine.Pin.OUT)
 
 import sys
+import ujson
 
 # Input is a byte array of data.  Output is bytes with escape chars
 def escape_buffer(data):
@@ -172,6 +197,7 @@ def checksum_buffer(buffer):
     return sum
 
 # $<address>;<protocol>;<payload>:<checksum>
+# ? writes the metrics snapshot as #<json>
 def handle_meshnet_send(t):
     state = 'start'
 
@@ -183,6 +209,10 @@ def handle_meshnet_send(t):
                 state = 'data'
                 buffer = bytearray()
 
+            elif ch == '?':
+                # Metrics snapshot as one JSON line
+                sys.stdout.write("#%s\r\n" % ujson.dumps(meshnet.metrics().snapshot()))
+
         elif state == 'data':
             if ch == ':':
                 # End of data
@@ -274,9 +304,18 @@ display.show_text_wrap(CONFIG_DATA.get("apmode.essid"), clear_first=False)
 
 
 # Watch memory
-while True:
-    sleep(5)
-    gc.collect()
-    display.show_text_wrap("Mem: %d" % gc.mem_free(), start_line=6, clear_first=False)
-    display.show_text_wrap("T%d R%d I%d E%d" % (meshnet._packet_transmitted, meshnet._packet_received, meshnet._packet_ignored, meshnet._packet_errors_crc ), start_line=7, clear_first=False)
+try:
+    while True:
+        sleep(5)
+        display.show_text_wrap("Mem: %d/%d" % (gc.mem_free(), memory.low_water()), start_line=6, clear_first=False)
+        stats = meshnet.metrics().snapshot()
+        display.show_text_wrap("T%d R%d I%d E%d" % (stats['packets.transmitted']['total'], stats['packets.received']['total'], stats['packets.ignored'], stats['packets.crc_errors']), start_line=7, clear_first=False)
+finally:
+    # Stopping the capture writes out what it holds; wait for that before closing the file
+    capture = meshnet.capture()
+    if capture:
+        meshnet.set_capture(None)
+        capture.wait()
+    if capture_file:
+        capture_file.close()
 
@@ -4,11 +4,13 @@ import network
 import socket
 from time import sleep
 import sys
+import ujson
 
 class MeshNetWebServer(thread):
-    def __init__(self, config, name="MeshNetWebServer", apmode=True, display=None):
+    def __init__(self, config, name="MeshNetWebServer", apmode=True, display=None, meshnet=None):
         super().__init__(name, stack=8192)
         self._config = config
+        self._meshnet = meshnet
         self._apmode = apmode
         self._display = display if display else lambda text : None
 
@@ -33,14 +35,7 @@ class MeshNetWebServer(thread):
 
                 self._display("Web running", clear = False, line=5)
 
-                server.run(s,
-                           page_data={
-                               '/': self.home_page,
-                               '/config': self.config_page,
-                               '/reboot': self.reboot_page,
-                               # Default for invalid page reference
-                               None: self.not_found_page,
-                           })
+                server.run(s, page_data=self.pages())
                     
                 s.close()
 
@@ -52,6 +47,40 @@ class MeshNetWebServer(thread):
 
         return rc
 
+    def pages(self):
+        return {
+            '/': self.home_page,
+            '/config': self.config_page,
+            '/reboot': self.reboot_page,
+            '/trace': self.trace_page,
+            '/metrics': self.metrics_page,
+            '/alloc': self.alloc_page,
+            # Default for invalid page reference
+            None: self.not_found_page,
+        }
+
+    # Serve as a uasyncio task instead of our thread (see meshnet_async)
+    async def serve(self):
+        import uasyncio as asyncio
+
+        if not ((    self._apmode and self.create_accesspoint(self._config.get('apmode'))) or
+                (not self._apmode and self.connect_to_accesspoint(self._config.get('host.ap')))):
+            self._display("Web failed", clear=False, line=5)
+            return
+
+        server = WebServer()
+        pages = self.pages()
+        listener = await asyncio.start_server(lambda reader, writer: server.handle(reader, writer, pages), '0.0.0.0', 80)
+        self._display("Web running", clear=False, line=5)
+
+        try:
+            while True:
+                await asyncio.sleep(60)
+        finally:
+            listener.close()
+            self.disconnect()
+            self._display("Web stopped", clear=False, line=5)
+
     def connect_to_accesspoint(self, config):
         try:
             self._wlan = network.WLAN(network.STA_IF)
@@ -206,6 +235,35 @@ class MeshNetWebServer(thread):
     
         return header, html
 
+    # Packet trace ring as text, oldest first.  POST clears it.
+    def trace_page(self, request=None, notice=None):
+        trace = self._meshnet.trace() if self._meshnet else None
+        if trace == None:
+            return build_header("404 Not Found", "text/plain"), "Tracing is off\n"
+
+        if request is not None and request.method == 'POST':
+            trace.clear()
+
+        return build_header("200 OK", "text/plain"), "\n".join(trace.lines()) + "\n"
+
+    # Metrics snapshot as JSON
+    def metrics_page(self, request=None, notice=None):
+        if self._meshnet == None:
+            return build_header("404 Not Found", "text/plain"), "No mesh\n"
+
+        return build_header("200 OK", "application/json"), ujson.dumps(self._meshnet.metrics().snapshot()) + "\n"
+
+    # Allocation by packet path as text, most bytes first.  POST clears it.
+    def alloc_page(self, request=None, notice=None):
+        profile = self._meshnet.alloc_profile() if self._meshnet else None
+        if profile == None:
+            return build_header("404 Not Found", "text/plain"), "Allocation profiling is off\n"
+
+        if request is not None and request.method == 'POST':
+            profile.clear()
+
+        return build_header("200 OK", "text/plain"), "\n".join(profile.lines()) + "\n"
+
     def reboot_delay(self, t):
         sleep(1)
         import machine
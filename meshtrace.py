@@ -0,0 +1,109 @@
+#
+# Per-packet lifecycle tracing
+#
+# Trace points in the driver and MeshNet write a fixed size record into a ring
+# buffer allocated once up front, so tracing a busy relay does not disturb it
+# much.  With tracing off the only cost at each point is one attribute test.
+#
+# Record layout (16 bytes):
+#    ticks_us    4 bytes, little endian
+#    stage       1 byte
+#    interface   1 byte     radio the record came from
+#    header     10 bytes    mesh header of the packet as held in memory; zero when
+#                           the stage has no packet yet (rx-irq, tx-start)
+#
+# Dump the ring at the REPL with meshnet.trace().dump(), or fetch /trace from
+# the web server.
+#
+from time import ticks_us, ticks_diff
+import struct
+try:
+    _UNUSED_=const(1)
+except:
+    const = lambda x: x
+
+TRACE_RX_IRQ          = const(0)    # Receive interrupt entered
+TRACE_WRAP            = const(1)    # Frame read and wrapped as a packet
+TRACE_PROCESS         = const(2)    # Packet handed to its protocol handler
+TRACE_ROUTE_LOOKUP    = const(3)    # Next hop looked up in the route table
+TRACE_PENDING_ENQUEUE = const(4)    # Parked on a route awaiting RouteAnnounce
+TRACE_TX_ENQUEUE      = const(5)    # Put on a transmit queue
+TRACE_TX_START        = const(6)    # Radio switched to transmit
+TRACE_TX_DONE         = const(7)    # Transmission complete
+
+TRACE_STAGES = ( "rx-irq", "wrap", "process", "route-lookup", "pending-enqueue", "tx-enqueue", "tx-start", "tx-done" )
+
+_RECORD_LEN          = const(16)
+_RECORD_HEADER       = const(6)     # Offset of the packet header in a record
+_HEADER_LEN          = const(10)
+_RECORD_FORMAT       = "<IBB"
+_HEADER_FORMAT       = ">HHHHBB"    # nexthop, target, previous, source, protocol, ttl
+
+class Trace():
+    def __init__(self, records=256):
+        self._records = records
+        self._ring = bytearray(records * _RECORD_LEN)
+        self._next = 0
+        self._count = 0
+
+    # Total records written, including those since overwritten
+    def count(self):
+        return self._count
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    # Write a record for <stage>.  <data> is the packet's buffer, header first.
+    # Called from interrupt handlers, so it only stores into the ring.
+    def record(self, stage, data=None, interface=0):
+        index = self._next
+        self._next = index + 1 if index + 1 < self._records else 0
+        self._count += 1
+
+        offset = index * _RECORD_LEN
+        ring = self._ring
+        struct.pack_into(_RECORD_FORMAT, ring, offset, ticks_us(), stage, interface)
+        offset += _RECORD_HEADER
+        if data != None and len(data) >= _HEADER_LEN:
+            for item in range(_HEADER_LEN):
+                ring[offset + item] = data[item]
+        else:
+            for item in range(_HEADER_LEN):
+                ring[offset + item] = 0
+
+    # Records oldest first as bytes
+    def raw(self):
+        if self._count <= self._records:
+            return bytes(self._ring[0:self._count * _RECORD_LEN])
+        start = self._next * _RECORD_LEN
+        return bytes(self._ring[start:]) + bytes(self._ring[0:start])
+
+    # Decoded records oldest first:
+    #    (ticks_us, stage, interface, nexthop, target, previous, source, protocol, ttl)
+    def records(self):
+        data = self.raw()
+        return [ struct.unpack_from(_RECORD_FORMAT, data, offset) + struct.unpack_from(_HEADER_FORMAT, data, offset + _RECORD_HEADER)
+                 for offset in range(0, len(data), _RECORD_LEN) ]
+
+    # Text lines oldest first with the microseconds since the record before
+    def lines(self):
+        lines = []
+        last = None
+        for ticks, stage, interface, nexthop, target, previous, source, protocol, ttl in self.records():
+            delta = ticks_diff(ticks, last) if last != None else 0
+            last = ticks
+            name = TRACE_STAGES[stage] if stage < len(TRACE_STAGES) else "%d" % stage
+            if source == 0 and target == 0:
+                lines.append("%10d %+8d I%d %-15s" % (ticks, delta, interface, name))
+            else:
+                lines.append("%10d %+8d I%d %-15s N=%d T=%d P=%d S=%d Proto=%d TTL=%d" %
+                             (ticks, delta, interface, name, nexthop, target, previous, source, protocol, ttl))
+        return lines
+
+    # Write the ring to <write> (default print) oldest first
+    def dump(self, write=print):
+        if self._count > self._records:
+            write("%d records lost to wrap" % (self._count - self._records))
+        for line in self.lines():
+            write(line)
@@ -3,9 +3,12 @@
 #
 # Designed to be inherited by worker class to perform the actual I/O
 #
-import gc
+import umemory
 from ulock import *
-from uthread import timer
+from uthread import thread, timer
+from time import sleep
+from meshtrace import TRACE_RX_IRQ, TRACE_TX_START
+from meshmetrics import Metrics, ALLOC_RX_READ, ALLOC_TIMER
 try:
     _UNUSED_=const(1)
 except:
@@ -16,6 +19,11 @@ class SX127xDeviceException(Exception):
     pass
 
 _DEFAULT_PACKET_DELAY = 0.05
+_IRQ_OUTLIER = 2000          # Handler runs or edge delays over this many us are kept as outliers
+
+# Call <func>(timer, *<args>) after <delay> seconds from a timer thread
+def thread_call_later(delay, func, *args):
+    timer(delay, func).start(*args)
 
 # Register definitions
 _SX127x_REG_FIFO                 = const(0x00)     # Read/write fifo
@@ -31,6 +39,8 @@ _SX127x_MODE_TX                     = const(0x03)
 _SX127x_MODE_FS_RX                  = const(0x04)
 _SX127x_MODE_RX_CONTINUOUS          = const(0x05)
 _SX127x_MODE_RX_SINGLE              = const(0x06)
+_SX127x_MODE_CAD                    = const(0x07)
+_SX127x_MODE_MASK                   = const(0x07)  # Mode bits of OP_MODE
 # 0x02 through 0x05 not used
 _SX127x_REG_FREQ_MSB             = const(0x06)     # Carrier MSB
 _SX127x_REG_FREQ_MID             = const(0x07)     # Carrier Middle
@@ -108,8 +118,10 @@ _SX127x_REG_PLL                  = const(0x70)     # Constrols PLL bandwidth
 # Other consts
 _SX127x_MAX_PACKET_LENGTH        = const(255)
 
-_TX_FIFO_BASE              = const(0x00)
+# The FIFO is split so a frame loaded for transmit is not overwritten by one received
 _RX_FIFO_BASE              = const(0x00)
+_TX_FIFO_BASE              = const(0x80)
+_TX_FIFO_SIZE              = const(0x80)     # Larger frames are written at 0x00 using the whole FIFO
 
 _BANDWIDTH_BINS = (
         7.8E3,
@@ -122,6 +134,305 @@ _BANDWIDTH_BINS = (
         125E3,
         250E3
 )
+_BANDWIDTH_MAX             = 500E3   # Anything above the last bin
+
+# Demodulator limits per spreading factor 6..12 (from the SX1276 datasheet)
+_DEMOD_SNR = ( -5.0, -7.5, -10.0, -12.5, -15.0, -17.5, -20.0 )            # dB
+_SENSITIVITY_125K = ( -118.0, -123.0, -126.0, -129.0, -132.0, -134.5, -137.0 )   # dBm at 125 kHz
+
+# Receive status registers read in one burst: RX_FIFO_CURRENT through RSSI_VALUE
+_RX_STATUS_BASE            = _SX127x_REG_RX_FIFO_CURRENT
+_RX_STATUS_LEN             = const(_SX127x_REG_RSSI_VALUE - _SX127x_REG_RX_FIFO_CURRENT + 1)
+_RX_METADATA_BASE          = const(_SX127x_REG_MODEM_STATUS - _SX127x_REG_RX_FIFO_CURRENT)   # Kept with the packet
+_FEI_LEN                   = const(3)
+
+# Low power listening: sleep, wake every listen interval for a CAD and receive only if a preamble is there
+_LISTEN_OFF                = const(0)    # Continuous receive, transmitting or powered down
+_LISTEN_SLEEP              = const(1)    # Asleep until the next sniff
+_LISTEN_CAD                = const(2)    # Channel activity detection running
+_LISTEN_RX                 = const(3)    # Preamble seen; receiving a single packet
+_LISTEN_SYMBOL_TIMEOUT     = const(32)   # Symbols RX_SINGLE waits for the preamble after CAD fires
+_WAKE_PREAMBLE_MARGIN      = const(8)    # Preamble symbols beyond the listen interval
+_MAX_PREAMBLE_LENGTH       = const(0xFFFF)
+
+_RSSI_SETTLE               = 0.002       # Seconds after entering receive before RSSI_VALUE is meaningful
+_RSSI_SAMPLE_INTERVAL      = 0.001       # Seconds between RSSI samples of a scan
+
+# Link data captured with a received packet.  Holds the raw MODEM_STATUS, PACKET_SNR,
+# PACKET_RSSI and RSSI_VALUE registers (and FEI if read), decoded only when asked for.
+class RxMetadata:
+    def __init__(self, status, rssi_offset, fei=None, fei_scale=0):
+        self._status = status
+        self._rssi_offset = rssi_offset
+        self._fei = fei
+        self._fei_scale = fei_scale
+
+    def __str__(self):
+        fei = self.fei()
+        return "RSSI=%d SNR=%.1f Noise=%d%s" % (self.rssi(), self.snr(), self.channel_rssi(), "" if fei == None else " FEI=%d" % fei)
+
+    # Signal to noise ratio of the packet in dB
+    def snr(self):
+        snr = self._status[1]
+        # Two's complement
+        if snr >= 128:
+            snr -= 256
+        return snr / 4.0
+
+    # Strength of the packet in dBm
+    def rssi(self):
+        return self._status[2] + self._rssi_offset
+
+    # Strength of the channel in dBm just after the packet ended; the noise floor
+    def channel_rssi(self):
+        return self._status[3] + self._rssi_offset
+
+    # Frequency error of the packet in Hz, or None if not read
+    def fei(self):
+        if self._fei == None:
+            return None
+        # 20 bit two's complement
+        fei = ((self._fei[0] & 0x0F) << 16) | (self._fei[1] << 8) | self._fei[2]
+        if fei >= 0x80000:
+            fei -= 0x100000
+        return int(fei * self._fei_scale)
+
+# Domain table compiled from a meshdomains entry.  Channel frequencies are kept as FRF register
+# triplets and datarates as pre-encoded MODEM_CONFIG and PA_CONFIG values, so retuning is a
+# table index plus a burst write.  Tables can be saved to flash and loaded at boot instead of
+# compiling the domain each time.
+_DOMAIN_TABLE_MAGIC        = b'SXDT'
+_DOMAIN_TABLE_VERSION      = const(1)
+
+# Per datarate record
+_RATE_FLAGS                = const(0)
+_RATE_SF                   = const(1)
+_RATE_BW                   = const(2)    # Bandwidth bin
+_RATE_CONFIG_3             = const(3)    # Low data rate optimize bit
+_RATE_PA_CONFIG            = const(4)
+_RATE_TX                   = const(5)    # Power in dBm
+_RATE_MAX_LENGTH           = const(6)
+_RATE_LEN                  = const(7)
+
+_RATE_FLAG_DEFINED         = const(0x01)
+_RATE_FLAG_RFO             = const(0x02)  # RFO output rather than PA_BOOST
+
+class DomainTable:
+    def __init__(self, xtal, freq_range, index, frequencies, datarates, rates):
+        self._xtal = xtal
+        self._freq_range = freq_range
+        # Channel number to slot + 1; 0 if no such channel
+        self._index = index
+        # FRF msb, mid and lsb per slot
+        self._frequencies = frequencies
+        # Lowest and highest datarate per slot
+        self._datarates = datarates
+        # _RATE_LEN bytes per datarate number
+        self._rates = rates
+
+    def xtal(self):
+        return self._xtal
+
+    def freq_range(self):
+        return self._freq_range
+
+    def _slot(self, channel):
+        if type(channel) != int or channel < 0 or channel >= len(self._index) or self._index[channel] == 0:
+            raise SX127xDeviceException("Invalid channel: %s" % channel)
+        return self._index[channel] - 1
+
+    def channels(self):
+        return [ c for c in range(len(self._index)) if self._index[c] != 0 ]
+
+    def has_channel(self, channel):
+        return type(channel) == int and 0 <= channel < len(self._index) and self._index[channel] != 0
+
+    # (lowest, highest) datarate of <channel>
+    def channel_datarates(self, channel):
+        slot = self._slot(channel)
+        return (self._datarates[slot * 2], self._datarates[slot * 2 + 1])
+
+    # Carrier of <channel> in Hz; for display
+    def frequency(self, channel):
+        slot = self._slot(channel) * 3
+        frf = (self._frequencies[slot] << 16) | (self._frequencies[slot + 1] << 8) | self._frequencies[slot + 2]
+        return int(frf * self._xtal / 2**19)
+
+    def has_datarate(self, datarate):
+        return type(datarate) == int and 0 <= datarate < len(self._rates) // _RATE_LEN and (self._rates[datarate * _RATE_LEN] & _RATE_FLAG_DEFINED) != 0
+
+    # True if <datarate> may be used on <channel>
+    def valid_datarate(self, channel, datarate):
+        if not self.has_datarate(datarate):
+            return False
+        rates = self.channel_datarates(channel)
+        return rates[0] <= datarate <= rates[1]
+
+    def _rate(self, datarate, field):
+        return self._rates[datarate * _RATE_LEN + field]
+
+    def spreading_factor(self, datarate):
+        return self._rate(datarate, _RATE_SF)
+
+    def bandwidth_bin(self, datarate):
+        return self._rate(datarate, _RATE_BW)
+
+    # Bandwidth in Hz as programmed
+    def bandwidth(self, datarate):
+        bw = self._rate(datarate, _RATE_BW)
+        return _BANDWIDTH_BINS[bw] if bw < len(_BANDWIDTH_BINS) else _BANDWIDTH_MAX
+
+    # Low data rate optimize bit for MODEM_CONFIG_3
+    def low_datarate(self, datarate):
+        return self._rate(datarate, _RATE_CONFIG_3)
+
+    def tx_power(self, datarate):
+        return (self._rate(datarate, _RATE_TX), "RFO" if self._rate(datarate, _RATE_FLAGS) & _RATE_FLAG_RFO else "PA")
+
+    # Largest frame that may be sent at <datarate>
+    def max_length(self, datarate):
+        return self._rate(datarate, _RATE_MAX_LENGTH)
+
+    # Fill <buffer> with FREQ_MSB, FREQ_MID, FREQ_LSB and PA_CONFIG for <channel> at <datarate>
+    def tune_registers(self, channel, datarate, buffer):
+        slot = self._slot(channel) * 3
+        buffer[0] = self._frequencies[slot]
+        buffer[1] = self._frequencies[slot + 1]
+        buffer[2] = self._frequencies[slot + 2]
+        buffer[3] = self._rate(datarate, _RATE_PA_CONFIG)
+        return buffer
+
+    # Fill <buffer> with the MODEM_CONFIG_1 and MODEM_CONFIG_2 bits owned by <datarate>
+    # (bandwidth and spreading factor); the caller merges in coding rate, header and crc bits.
+    def modem_registers(self, datarate, buffer):
+        buffer[0] = self._rate(datarate, _RATE_BW) << 4
+        buffer[1] = self._rate(datarate, _RATE_SF) << 4
+        return buffer
+
+    # Write the table to <filename>
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(_DOMAIN_TABLE_MAGIC)
+            f.write(bytes([ _DOMAIN_TABLE_VERSION ]))
+            f.write(int(self._xtal).to_bytes(4, 'big'))
+            f.write(int(self._freq_range[0]).to_bytes(4, 'big'))
+            f.write(int(self._freq_range[1]).to_bytes(4, 'big'))
+            f.write(len(self._index).to_bytes(2, 'big'))
+            f.write((len(self._datarates) // 2).to_bytes(2, 'big'))
+            f.write(bytes([ len(self._rates) // _RATE_LEN ]))
+            f.write(self._index)
+            f.write(self._frequencies)
+            f.write(self._datarates)
+            f.write(self._rates)
+
+    # Read a table written by save()
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            header = f.read(22)
+            if len(header) != 22 or header[0:4] != _DOMAIN_TABLE_MAGIC or header[4] != _DOMAIN_TABLE_VERSION:
+                raise SX127xDeviceException("%s is not a domain table" % filename)
+
+            xtal = int.from_bytes(header[5:9], 'big')
+            freq_range = (int.from_bytes(header[9:13], 'big'), int.from_bytes(header[13:17], 'big'))
+            channels = int.from_bytes(header[17:19], 'big')
+            slots = int.from_bytes(header[19:21], 'big')
+            rates = header[21]
+
+            index = bytearray(f.read(channels))
+            frequencies = bytearray(f.read(slots * 3))
+            datarates = bytearray(f.read(slots * 2))
+            rates = bytearray(f.read(rates * _RATE_LEN))
+
+        return DomainTable(xtal, freq_range, index, frequencies, datarates, rates)
+
+# Compile a meshdomains entry for a radio clocked by <xtal>
+def compile_domain(domain, xtal=32e6):
+    if 'channels' not in domain:
+        raise SX127xDeviceException("'channels' not found in domain")
+
+    if 'data_rates' not in domain:
+        raise SX127xDeviceException("'data_rates' not found in domain")
+
+    xtal = int(xtal)
+
+    channels = {}
+    for channel in domain['channels']:
+        freq = channel['freq'][0]
+        step = channel['freq'][1]
+        for c in range(channel['chan'][0], channel['chan'][1] + 1):
+            channels[c] = (freq, channel['dr'])
+            freq += step
+
+    if max(channels) > 255 or max(domain['data_rates']) > 255:
+        raise SX127xDeviceException("Channel or datarate number too large for domain table")
+
+    index = bytearray(max(channels) + 1)
+    frequencies = bytearray(len(channels) * 3)
+    datarates = bytearray(len(channels) * 2)
+    slot = 0
+    for c in sorted(channels):
+        freq, dr = channels[c]
+        # FRF = freq * 2^19 / xtal, rounded, in integers
+        frf = (int(freq) * 2**19 + xtal // 2) // xtal
+        frequencies[slot * 3] = (frf >> 16) & 0xFF
+        frequencies[slot * 3 + 1] = (frf >> 8) & 0xFF
+        frequencies[slot * 3 + 2] = frf & 0xFF
+        datarates[slot * 2] = dr[0]
+        datarates[slot * 2 + 1] = dr[1]
+        slot += 1
+        index[c] = slot
+
+    rates = bytearray((max(domain['data_rates']) + 1) * _RATE_LEN)
+    for datarate in domain['data_rates']:
+        rate = domain['data_rates'][datarate]
+        record = datarate * _RATE_LEN
+
+        sf = min(max(rate['sf'], 6), 12)
+        bw = len(_BANDWIDTH_BINS)
+        for i in range(len(_BANDWIDTH_BINS)):
+            if rate['bw'] <= _BANDWIDTH_BINS[i]:
+                bw = i
+                break
+        hz = _BANDWIDTH_BINS[bw] if bw < len(_BANDWIDTH_BINS) else _BANDWIDTH_MAX
+
+        tx = rate['tx'] if type(rate['tx']) == tuple else (rate['tx'], "PA")
+        flags = _RATE_FLAG_DEFINED
+        if tx[1] == "PA":
+            # PA Boost mode
+            pa_config = _SX127x_PA_BOOST | min(max(int(round(tx[0])) - 2, 0), 15)
+        else:
+            pa_config = 0x70 | min(max(int(tx[0]), 0), 15)
+            flags |= _RATE_FLAG_RFO
+
+        rates[record + _RATE_FLAGS] = flags
+        rates[record + _RATE_SF] = sf
+        rates[record + _RATE_BW] = bw
+        # Set 'low data rate' flag if long symbol time
+        rates[record + _RATE_CONFIG_3] = 0x08 if 1000 / (hz / 2**sf) > 16 else 0x00
+        rates[record + _RATE_PA_CONFIG] = pa_config
+        rates[record + _RATE_TX] = min(max(int(tx[0]), 0), 255)
+        rates[record + _RATE_MAX_LENGTH] = min(rate['m'] if 'm' in rate else _SX127x_MAX_PACKET_LENGTH, _SX127x_MAX_PACKET_LENGTH)
+
+    return DomainTable(xtal, domain['freq_range'], index, frequencies, datarates, rates)
+
+# Load the compiled <domain> from <filename>, compiling and saving it if the file is missing
+# or was built for another crystal.  Remove the file after changing the domain.
+def load_domain(domain, filename, xtal=32e6):
+    try:
+        table = DomainTable.load(filename)
+        if table.xtal() == int(xtal):
+            return table
+    except Exception:
+        pass
+
+    table = compile_domain(domain, xtal)
+    try:
+        table.save(filename)
+    except Exception as e:
+        print("Unable to save domain table to %s: %s" % (filename, e))
+
+    return table
 
 # _FREQUENCIES = {
 #         196: (42, 64, 0),
@@ -142,22 +453,30 @@ _BANDWIDTH_BINS = (
 #    attach_interrupt(<dio#>, edge, <callback>)        Enable interrupt, rising edge if <edge> true. callback supplied (None causes disable)
 #         Call attach_interrupt with None callback to disable
 #
-#    onReceive(packet, crc_ok, rssi)                   Callback to receive a packet
+#    onReceive(packet, crc_ok, rssi, snr, metadata)    Callback to receive a packet (metadata is an RxMetadata)
 #
 #    onTransmit()                                      Callback when packet has been transmitted
 #                                                      Returns next packet if more to send
+#                                                      (call set_transmit_channel first to send it on another channel or rate,
+#                                                      or without a header)
 #
 #    reset()                                           Reset device
 #
 #  Optional:
 #    write_buffer(<register>, <bytearray of values>, size)   Optional: write a packet
 #    read_buffer(<register>, <length>                  Optional: read a packet
+#    read_registers(<register>, <bytearray>)           Optional: fill bytearray from consecutive registers
+#    write_registers(<register>, <bytearray>)          Optional: write bytearray to consecutive registers
 #    set_power(state)                                  Set power mode (override and extend is suggested)
+#    edge_time(<dio#>)                                 ticks_us of the last edge on the DIO, for interrupt profiling
 #
 
 # Parameters
-#     domain                - domain frequency and data rate table
+#     domain                - domain frequency and data rate table; a meshdomains entry or a
+#                             DomainTable from compile_domain() or load_domain()
 #     channel               - specified if to lock to a specific channel
+#     read_fei              - read frequency error of each received packet into its metadata
+#     listen_interval       - seconds between CAD sniffs for low power listening; 0 receives continuously
 #     delay                 - delay before transmitting next packet in queue
 #                             First one always done immediately. Intermediate
 #                             packets delay this number of (fractional) seconds
@@ -167,48 +486,56 @@ _BANDWIDTH_BINS = (
 #                             a new packet if restarting.  This would force a
 #                             *minimum* delay between packets, regardless of
 #                             if they are sent one-at-a-time or in-bulk.
+#     metrics               - meshmetrics.Metrics registry to count into; one of our own if not given
+#     irq_profile           - time the DIO0 handlers: edge to start, run time and lock waits
+#     irq_outlier           - us beyond which a profiled handler run is kept with its frame
+#     irq_name              - metric name prefix of the profiles (default "irq")
+#     alloc_profile         - count heap allocation on each packet path (meshmetrics.AllocProfile "alloc")
+#     call_later            - function(delay, func, *args) calling func(<handle>, *args) after delay seconds;
+#                             thread_call_later unless the stack runs on another engine
 #
 class SX127x_driver:
 
-    def _calc_freq(self, freq):
-        frf = round(freq / self._pll_step)
-        return ( int(frf / 65536), int(frf / 256) % 256, frf % 256)
-        
     def __init__(self, domain, **kwargs):
-        self._domain  = domain
         self._xtal    = kwargs['xtal']    if 'xtal'    in kwargs else 32e6
         self._channel = kwargs['channel'] if 'channel' in kwargs else None
         self._delay   = kwargs['delay']   if 'delay'   in kwargs else _DEFAULT_PACKET_DELAY
+        self._read_fei = kwargs['read_fei'] if 'read_fei' in kwargs else False
+        self._listen_interval = kwargs['listen_interval'] if 'listen_interval' in kwargs else 0
+        self._call_later = kwargs['call_later'] if 'call_later' in kwargs else thread_call_later
 
-        self._packets_memory_errors = 0
+        # Statistics; radios of one mesh share a registry
+        self._metrics = kwargs['metrics'] if 'metrics' in kwargs else Metrics()
+        self._tx_interrupts = self._metrics.counter("radio.tx_interrupts")
+        self._rx_interrupts = self._metrics.counter("radio.rx_interrupts")
+        self._memory_failures = self._metrics.counter("radio.memory_failures")
 
-        self._pll_step = self._xtal / 2**19
-        # print("PLL step %f" % self._pll_step)
+        # Timing of the DIO0 handlers (meshmetrics.IrqProfile), named <irq_name>.rx and .tx
+        self._rx_profile = None
+        self._tx_profile = None
+        if 'irq_profile' in kwargs and kwargs['irq_profile']:
+            name = kwargs['irq_name'] if 'irq_name' in kwargs else "irq"
+            outlier = kwargs['irq_outlier'] if 'irq_outlier' in kwargs else _IRQ_OUTLIER
+            self._rx_profile = self._metrics.irq_profile(name + ".rx", outlier)
+            self._tx_profile = self._metrics.irq_profile(name + ".tx", outlier)
 
-        # Define channel table for this frequency
-        if 'channels' in self._domain:
-            self._channels = {}
-            for channel in self._domain['channels']:
-                freq = channel['freq'][0]
-                step = channel['freq'][1]
-                for c in range(channel['chan'][0], channel['chan'][1] + 1):
-                    # self._channels[chantype][c] = { 'dr': channel['dr'], 'freq': self._calc_freq(freq) }
-                    # Add hz to table for debugging purposes - not really used
-                    self._channels[c] = { 'dr': channel['dr'], 'freq': self._calc_freq(freq), 'hz': freq }
-                    freq += step
+        # Allocation by packet path, shared by the radios and the mesh above them
+        self._alloc = self._metrics.alloc_profile("alloc") if 'alloc_profile' in kwargs and kwargs['alloc_profile'] else None
 
-            # # Dump for inspection
-            # for c in self._channels:
-            #     print("%d: %s" % (c, self._channels[c]))
+        # FEI register to Hz is 2^24 / xtal * bandwidth / 500 kHz
+        self._fei_step = 2**24 / self._xtal / 500E3
 
-        else:
-            raise LorDeviceException("'channels' not found in domain")
+        # Channel and datarate tables, compiled here unless the caller already did (e.g. from flash)
+        if type(domain) != DomainTable:
+            domain = compile_domain(domain, self._xtal)
 
-        if 'data_rates' in self._domain:
-            self._data_rates = self._domain['data_rates']
+        elif domain.xtal() != int(self._xtal):
+            raise SX127xDeviceException("Domain table compiled for %d Hz crystal" % domain.xtal())
 
-        else:
-            raise SX127xDeviceException("'data_rates' not found in domain")
+        self._domain = domain
+
+        # Register to dBm for packet and channel RSSI
+        self._rssi_offset = -157 + (7 if self._domain.freq_range()[0] < 868E6 else 0)
 
         self._sync_word        = kwargs['sync_word']        if 'sync_word'        in kwargs else 0x34
         self._preamble_length  = kwargs['preamble_length']  if 'preamble_length'  in kwargs else 8
@@ -222,17 +549,51 @@ class SX127x_driver:
         self._spreading_factor = kwargs['spreading_factor'] if 'spreading_factor' in kwargs else 7
         self._tx_power         = kwargs['tx_power']         if 'tx_power'         in kwargs else 2
 
-        self._tx_interrupts = 0
-        self._rx_interrupts = 0
         # self._fhss_interrupts = 0
 
         self._current_implicit_header = None
 
+        # Implicit header frame length expected when receiving; 0 for explicit headers
+        self._receive_length = 0
+        self._current_receive_length = 0
+
+        # Preallocated so the receive interrupt does not allocate for status
+        self._rx_status = bytearray(_RX_STATUS_LEN)
+
+        # Shadow copy of configuration registers so retuning only writes what changed
+        self._config_cache = {}
+
+        # Preallocated register images for retuning
+        self._tune_registers = bytearray(4)
+        self._modem_registers = bytearray(2)
+
+        # Channel and datarate for next transmitted packet; None to use the listening channel
+        self._transmit_channel = None
+        self._transmit_implicit = False
+        self._transmit_preamble = None
+        self._tuned = None
+
+        self._listen_state = _LISTEN_OFF
+        self._listen_thread = None
+
+        # True while receiving on another channel for scan_channel
+        self._scanning = False
+
+        # Copy of the frame sitting in the TX region of the FIFO, or None
+        self._preloaded = None
+
         self._lock = rlock()
 
+        # Packet trace ring (meshtrace.Trace) or None, and our radio number in its records
+        self._trace = None
+        self._trace_interface = 0
+
 
     def start(self, wanted_version=0x12, activate=True):
         self.reset()
+        self._config_cache = {}
+        self._current_implicit_header = None
+        self._tuned = None
 
         # Read version
         version = None
@@ -268,13 +629,19 @@ class SX127x_driver:
         self.write_register(_SX127x_REG_LNA, self.read_register(_SX127x_REG_LNA) | 0x03)  # MANIFEST CONST?
 
         # auto AGC enable
-        self.write_register(_SX127x_REG_MODEM_CONFIG_3, 0x04)  # MANIFEST??
+        self._write_config(_SX127x_REG_MODEM_CONFIG_3, (self._read_config(_SX127x_REG_MODEM_CONFIG_3) & 0x08) | 0x04)  # MANIFEST??
+
+        self._write_config(_SX127x_REG_TX_FIFO_BASE, _TX_FIFO_BASE)
+        self.write_register(_SX127x_REG_RX_FIFO_BASE, _RX_FIFO_BASE)
 
-        self.write_register(_SX127x_REG_TX_FIFO_BASE, _TX_FIFO_BASE) 
-        self.write_register(_SX127x_REG_RX_FIFO_BASE, _RX_FIFO_BASE) 
+        # Mask all but Tx, Rx and the ones used by low power listening
+        self.write_register(_SX127x_REG_IRQ_FLAGS_MASK, 0xFF & ~(_SX127x_IRQ_TX_DONE | _SX127x_IRQ_RX_DONE | _SX127x_IRQ_RX_TIMEOUT |
+                                                                 _SX127x_IRQ_CAD_COMPLETE | _SX127x_REG_CAD_DETECTED))
 
-        # Mask all but Tx and Rx
-        self.write_register(_SX127x_REG_IRQ_FLAGS_MASK, 0xFF & ~(_SX127x_IRQ_TX_DONE | _SX127x_IRQ_RX_DONE))
+        # Sniffs are only done while there is a listen interval
+        self._symbol_timeout(_LISTEN_SYMBOL_TIMEOUT)
+        if self._listen_interval != 0:
+            self.set_listen_interval(self._listen_interval)
 
         # Clear all interrupts
         self.write_register(_SX127x_REG_IRQ_FLAGS, 0xFF)
@@ -307,6 +674,17 @@ class SX127x_driver:
         self._garbage_collect()
         return buffer
 
+    # Read consecutive registers one at a time; override with a burst read if possible
+    def read_registers(self, address, buffer):
+        for i in range(len(buffer)):
+            buffer[i] = self.read_register(address + i)
+        return buffer
+
+    # Write consecutive registers one at a time; override with a burst write if possible
+    def write_registers(self, address, buffer):
+        for i in range(len(buffer)):
+            self.write_register(address + i, buffer[i])
+
     # Must be overriden by base class
     def write_register(self, reg, value):
         raise Exception("write_register not defined.")
@@ -317,6 +695,28 @@ class SX127x_driver:
     def attach_interrupt(self, dio, edge, callback):
         raise Exception("enable_interrupt not defined.")
 
+    # Configuration registers go through a shadow copy so unchanged values are not rewritten
+    def _read_config(self, reg):
+        if reg not in self._config_cache:
+            self._config_cache[reg] = self.read_register(reg)
+        return self._config_cache[reg]
+
+    def _write_config(self, reg, value):
+        value &= 0xFF
+        if self._config_cache.get(reg) != value:
+            self.write_register(reg, value)
+            self._config_cache[reg] = value
+
+    # Write <values> to consecutive configuration registers from <reg> in one burst if any changed
+    def _write_configs(self, reg, values):
+        changed = False
+        for i in range(len(values)):
+            if self._config_cache.get(reg + i) != values[i]:
+                self._config_cache[reg + i] = values[i]
+                changed = True
+        if changed:
+            self.write_registers(reg, values)
+
     def set_power(self, power=True):
         if power:
             # Bring things up
@@ -331,29 +731,128 @@ class SX127x_driver:
 
 
     def get_packet_rssi(self):
-        rssi = self.read_register(_SX127x_REG_PACKET_RSSI) - 157
-        if self._domain['freq_range'][0] < 868E6:
-            rssi = rssi + 7
-        return rssi
+        return self.read_register(_SX127x_REG_PACKET_RSSI) + self._rssi_offset
 
     def get_packet_snr(self):
-        return self.read_register(_SX127x_REG_PACKET_SNR) / 4.0
+        snr = self.read_register(_SX127x_REG_PACKET_SNR)
+        # Two's complement
+        if snr >= 128:
+            snr -= 256
+        return snr / 4.0
 
     def set_standby_mode(self):
         # print("standby mode")
+        self._listen_state = _LISTEN_OFF
+        self._scanning = False
         self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_STANDBY)
 
     def set_sleep_mode(self):
         # print("sleep mode")
+        # FIFO contents are lost in sleep
+        self._preloaded = None
+        self._listen_state = _LISTEN_OFF
+        self._scanning = False
         self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_SLEEP)
 
     def set_receive_mode(self):
         # print("receive mode")
-        # self.set_channel(self._receive_channel)
-        self.attach_interrupt(0, True, self._rxhandle_interrupt)
-        # self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_RX_SINGLE)
-        self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_RX_CONTINUOUS)
-        self.write_register(_SX127x_REG_DIO_MAPPING_1, 0b00000000)
+        self._scanning = False
+        # Return to listening channel if last transmit used a different one
+        self._transmit_channel = None
+        self._transmit_implicit = False
+        self._transmit_preamble = None
+        channel, datarate = self._listen_channel()
+        self._tune(channel, datarate)
+        self._set_receive_length(self._listen_length(channel, datarate))
+
+        if self._listen_interval != 0:
+            # Senders stretch their preamble over our interval; expect that much
+            self._write_preamble(self.get_preamble_length(self._listen_interval, datarate))
+            self._listen_sleep()
+
+        else:
+            self._listen_state = _LISTEN_OFF
+            self._write_preamble(self._preamble_length)
+            self.attach_interrupt(0, True, self._rxhandle_interrupt)
+            self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_RX_CONTINUOUS)
+            self.write_register(_SX127x_REG_DIO_MAPPING_1, 0b00000000)
+
+    # Sniff for a preamble every <interval> seconds, sleeping in between, instead of receiving
+    # continuously.  0 returns to continuous receive.  Takes effect on the next receive.
+    def set_listen_interval(self, interval):
+        with self._lock:
+            self._listen_interval = interval
+            if interval != 0 and self._listen_thread == None:
+                self._listen_thread = thread(run=self._listen, stack=8192)
+                self._listen_thread.start()
+
+            elif interval == 0 and self._listen_state == _LISTEN_SLEEP:
+                # Nothing else would wake us
+                self.set_receive_mode()
+
+    def get_listen_interval(self):
+        return self._listen_interval
+
+    # Wake the radio for a CAD every listen interval
+    def _listen(self, t):
+        while t.running and self._listen_interval != 0:
+            sleep(self._listen_interval)
+            with self._lock:
+                if self._listen_state == _LISTEN_SLEEP:
+                    self._start_cad()
+
+        with self._lock:
+            self._listen_thread = None
+
+        return 0
+
+    def _listen_sleep(self):
+        if self._listen_interval == 0:
+            # Low power listening was turned off meanwhile
+            self.set_receive_mode()
+        else:
+            self.set_sleep_mode()
+            self._listen_state = _LISTEN_SLEEP
+
+    def _start_cad(self):
+        self.set_standby_mode()
+        self._listen_state = _LISTEN_CAD
+        self.attach_interrupt(0, True, self._cadhandle_interrupt)
+        self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_CAD)
+        self.write_register(_SX127x_REG_DIO_MAPPING_1, 0b10000000)
+
+    # CAD finished: receive a packet if a preamble was seen, otherwise back to sleep
+    def _cadhandle_interrupt(self, event):
+        flags = self.read_register(_SX127x_REG_IRQ_FLAGS)
+        self.write_register(_SX127x_REG_IRQ_FLAGS, flags)
+
+        if flags & _SX127x_IRQ_CAD_COMPLETE:
+            with self._lock:
+                if self._listen_state == _LISTEN_CAD:
+                    if flags & _SX127x_REG_CAD_DETECTED:
+                        self._listen_state = _LISTEN_RX
+                        self.attach_interrupt(0, True, self._rxhandle_interrupt)
+                        self.attach_interrupt(1, True, self._rxtimeout_interrupt)
+                        self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_RX_SINGLE)
+                        self.write_register(_SX127x_REG_DIO_MAPPING_1, 0b00000000)
+                    else:
+                        self._listen_sleep()
+        else:
+            print("_cadhandle_interrupt: not for us %02x" % flags)
+
+    # RX_SINGLE found no packet after the CAD
+    def _rxtimeout_interrupt(self, event):
+        flags = self.read_register(_SX127x_REG_IRQ_FLAGS)
+        self.write_register(_SX127x_REG_IRQ_FLAGS, flags & _SX127x_IRQ_RX_TIMEOUT)
+
+        with self._lock:
+            if self._listen_state == _LISTEN_RX and flags & _SX127x_IRQ_RX_TIMEOUT:
+                self._listen_sleep()
+
+    # Symbols RX_SINGLE waits for a preamble
+    def _symbol_timeout(self, symbols):
+        self._write_config(_SX127x_REG_MODEM_CONFIG_2, (self._read_config(_SX127x_REG_MODEM_CONFIG_2) & 0xFC) | ((symbols >> 8) & 0x03))
+        self._write_config(_SX127x_REG_SYMBOL_TIMEOUT, symbols)
 
     def set_transmit_mode(self):
         # print("transmit mode")
@@ -372,9 +871,9 @@ class SX127x_driver:
         if tx_power[1] == "PA":
             # PA Boost mode
             level = min(max(int(round(tx_power[0]) - 2), 0), 15)
-            self.write_register(_SX127x_REG_PA_CONFIG, _SX127x_PA_BOOST | tx_power[0])
+            self._write_config(_SX127x_REG_PA_CONFIG, _SX127x_PA_BOOST | level)
         else:
-            self.write_register(_SX127x_REG_PA_CONFIG, 0x70 | (min(max(tx_power[0], 0), 15)))
+            self._write_config(_SX127x_REG_PA_CONFIG, 0x70 | (min(max(tx_power[0], 0), 15)))
 
     def get_tx_power(self):
         return self._tx_power
@@ -404,21 +903,12 @@ class SX127x_driver:
             new_channel = self._channel[0] if channel == None else channel
             new_datarate = self._channel[1] if datarate == None else datarate
 
-        if new_channel in self._channels:
-            current_channel = self._channels[new_channel]
-
-            info = current_channel['freq']
-            self.write_register(_SX127x_REG_FREQ_MSB, info[0])
-            self.write_register(_SX127x_REG_FREQ_MID, info[1])
-            self.write_register(_SX127x_REG_FREQ_LSB, info[2])
-
+        if self._domain.has_channel(new_channel):
             # If forcing default or new datarate is invalid, set to default (lowest) for channel
-            if new_datarate not in current_channel['dr']:
-                new_datarate = current_channel['dr'][0]
+            if not self.valid_datarate(new_channel, new_datarate):
+                new_datarate = self._domain.channel_datarates(new_channel)[0]
 
-            self.set_bandwidth(self._data_rates[new_datarate]['bw'])
-            self.set_spreading_factor(self._data_rates[new_datarate]['sf'])
-            self.set_tx_power(self._data_rates[new_datarate]['tx'])
+            self._tune(new_channel, new_datarate)
     
             self._channel = (new_channel, new_datarate)
 
@@ -427,19 +917,168 @@ class SX127x_driver:
         else:
             raise Exception("Invalid channel: %s" % channel)
 
+    # True if <datarate> may be used on <channel>
+    def valid_datarate(self, channel, datarate):
+        return self._domain.valid_datarate(channel, datarate)
+
+    # Program frequency and modem settings from the domain table.  Carrier and PA_CONFIG are
+    # adjacent, as are MODEM_CONFIG_1 and 2, so each is one burst.  Only registers that change are written.
+    def _tune(self, channel, datarate):
+        if (channel, datarate) != self._tuned:
+            domain = self._domain
+            self._write_configs(_SX127x_REG_FREQ_MSB, domain.tune_registers(channel, datarate, self._tune_registers))
+
+            # Keep coding rate, header mode, crc and symbol timeout bits
+            modem = domain.modem_registers(datarate, self._modem_registers)
+            modem[0] |= self._read_config(_SX127x_REG_MODEM_CONFIG_1) & 0x0F
+            modem[1] |= self._read_config(_SX127x_REG_MODEM_CONFIG_2) & 0x0F
+            self._write_configs(_SX127x_REG_MODEM_CONFIG_1, modem)
+
+            sf = domain.spreading_factor(datarate)
+            self._write_config(_SX127x_REG_MODEM_CONFIG_3, (self._read_config(_SX127x_REG_MODEM_CONFIG_3) & ~0x08) | domain.low_datarate(datarate))
+            self._write_config(_SX127x_REG_DETECTION_OPTIMIZE, 0xc5 if sf == 6 else 0xc3)
+            self._write_config(_SX127x_REG_DETECTION_THRESHOLD, 0x0c if sf == 6 else 0x0a)
+
+            self._bandwidth = domain.bandwidth(datarate)
+            self._spreading_factor = sf
+            self._tx_power = domain.tx_power(datarate)
+
+            self._tuned = (channel, datarate)
+
+    # Send the next packet on <channel> at <datarate>; None for either uses the current setting.
+    # With <implicit_header> the packet is sent without a LoRa header.  <preamble> overrides the
+    # preamble length, to wake a receiver that is sniffing.
+    # Reverts to the listening channel when the radio returns to receive.
+    def set_transmit_channel(self, channel=None, datarate=None, implicit_header=False, preamble=None):
+        channel = self._channel[0] if channel == None or not self._domain.has_channel(channel) else channel
+        datarate = self._channel[1] if datarate == None else datarate
+        if not self.valid_datarate(channel, datarate):
+            datarate = self._domain.channel_datarates(channel)[0]
+        self._transmit_channel = (channel, datarate)
+        self._transmit_implicit = implicit_header
+        self._transmit_preamble = preamble
+
+    # Measure <channel> at <datarate> (default listening datarate), returning <samples> RSSI
+    # readings in dBm.  Leaves the listening channel for a few ms, so the caller makes sure
+    # nothing is being transmitted.  Packets heard meanwhile are still received.
+    # Sleeps between readings with the lock held; see scan_channel_later to not block.
+    def scan_channel(self, channel, samples=8, datarate=None):
+        values = []
+        with self._lock:
+            self._scan_start(channel, datarate)
+            sleep(_RSSI_SETTLE)
+            for sample in range(samples):
+                values.append(self._scan_sample())
+                sleep(_RSSI_SAMPLE_INTERVAL)
+            self.set_receive_mode()
+
+        return values
+
+    # As scan_channel, but each reading is a call_later step so nothing waits for the scan.
+    # <done>(values) is called with the readings, or None if the radio was needed meanwhile.
+    def scan_channel_later(self, channel, samples, datarate, done):
+        with self._lock:
+            self._scan_start(channel, datarate)
+        self._call_later(_RSSI_SETTLE, self._scan_step, [], samples, done)
+
+    def _scan_step(self, timer, values, samples, done):
+        with self._lock:
+            value = self._scan_sample()
+            if value != None and len(values) + 1 == samples:
+                self.set_receive_mode()
+
+        if value == None:
+            # A transmit or receive took the radio back
+            done(None)
+        elif len(values) + 1 == samples:
+            done(values + [ value ])
+        else:
+            values.append(value)
+            self._call_later(_RSSI_SAMPLE_INTERVAL, self._scan_step, values, samples, done)
+
+    # Receive on <channel> to read its RSSI.  Any other mode set ends the scan.
+    def _scan_start(self, channel, datarate=None):
+        datarate = self._channel[1] if datarate == None else datarate
+        if not self.valid_datarate(channel, datarate):
+            datarate = self._domain.channel_datarates(channel)[0]
+
+        self.set_standby_mode()
+        self._tune(channel, datarate)
+        self.attach_interrupt(0, True, self._rxhandle_interrupt)
+        self.write_register(_SX127x_REG_OP_MODE, _SX127x_MODE_LONG_RANGE | _SX127x_MODE_RX_CONTINUOUS)
+        self.write_register(_SX127x_REG_DIO_MAPPING_1, 0b00000000)
+        self._scanning = True
+
+    # RSSI in dBm on the channel being scanned; None once the scan has been ended
+    def _scan_sample(self):
+        if not self._scanning:
+            return None
+        return self.read_register(_SX127x_REG_RSSI_VALUE) + self._rssi_offset
+
+    # Channel and datarate to receive on.  May be overridden to listen elsewhere for a while.
+    def _listen_channel(self):
+        return self._channel
+
+    # Implicit header frame length to expect on <channel> at <datarate>; 0 for explicit headers.
+    # May be overridden to receive fixed size frames on some channels only.
+    def _listen_length(self, channel, datarate):
+        return self._receive_length
+
+    # Symbol time in ms at <datarate> (default channel datarate)
+    def _symbol_time(self, datarate=None):
+        datarate = self._channel[1] if datarate == None else datarate
+        return 1000.0 * (2 ** self._domain.spreading_factor(datarate)) / self._domain.bandwidth(datarate)
+
+    # Time on air in ms of a <length> byte packet at <datarate> (default channel datarate)
+    # using the current coding rate and crc settings.  <implicit_header> and <preamble> None
+    # use the configured header mode and preamble length.
+    def get_airtime(self, length, datarate=None, implicit_header=None, preamble=None):
+        sf = self._domain.spreading_factor(self._channel[1] if datarate == None else datarate)
+        symbol = self._symbol_time(datarate)
+        low_rate = 1 if symbol > 16 else 0
+        implicit = 1 if (self._implicit_header if implicit_header == None else implicit_header) else 0
+        crc = 1 if self._enable_crc else 0
+
+        # Semtech AN1200.13 payload symbol count
+        bits = 8 * length - 4 * sf + 28 + 16 * crc - 20 * implicit
+        step = 4 * (sf - 2 * low_rate)
+        symbols = 8 + max(-(-bits // step) * self._coding_rate, 0)
+
+        return ((self._preamble_length if preamble == None else preamble) + 4.25 + symbols) * symbol
+
+    # Preamble length in symbols at <datarate> that spans <interval> seconds, so a receiver
+    # sniffing at that interval wakes up during it
+    def get_preamble_length(self, interval, datarate=None):
+        length = int(interval * 1000.0 / self._symbol_time(datarate)) + _WAKE_PREAMBLE_MARGIN
+        return min(max(length, self._preamble_length), _MAX_PREAMBLE_LENGTH)
+
+    # Demodulation limits for <datarate>: (minimum SNR in dB, sensitivity in dBm)
+    def get_datarate_limits(self, datarate):
+        sf = self._domain.spreading_factor(datarate)
+        bw = self._domain.bandwidth(datarate)
+
+        # Sensitivity worsens 3 dB per doubling of bandwidth
+        octaves = 0
+        while bw >= 250E3 * (2 ** octaves):
+            octaves += 1
+
+        return _DEMOD_SNR[sf - 6], _SENSITIVITY_125K[sf - 6] + 3.0 * octaves
+
     def get_channel(self):
         return self._channel
 
-    # Set bandwidth (limited by table specification)
-    def set_bandwidth(self, bandwidth):
-        bw = len(_BANDWIDTH_BINS)
+    # Return register value for bandwidth (limited by table specification)
+    def _bandwidth_bin(self, bandwidth):
         for i in range(len(_BANDWIDTH_BINS)):
             if bandwidth <= _BANDWIDTH_BINS[i]:
-                bw = i
-                break
+                return i
+        return len(_BANDWIDTH_BINS)
+
+    def set_bandwidth(self, bandwidth):
+        bw = self._bandwidth_bin(bandwidth)
     
-        self.write_register(_SX127x_REG_MODEM_CONFIG_1,
-                             (self.read_register(_SX127x_REG_MODEM_CONFIG_1) & 0x0f) | (bw << 4))
+        self._write_config(_SX127x_REG_MODEM_CONFIG_1,
+                           (self._read_config(_SX127x_REG_MODEM_CONFIG_1) & 0x0f) | (bw << 4))
 
         self._bandwidth = bandwidth
 
@@ -450,18 +1089,18 @@ class SX127x_driver:
         self._spreading_factor = min(max(spreading_factor, 6), 12)
     
         # Set 'low data rate' flag if long symbol time otherwise clear it
-        config3 = self.read_register(_SX127x_REG_MODEM_CONFIG_3)
+        config3 = self._read_config(_SX127x_REG_MODEM_CONFIG_3)
         if 1000 / (self._bandwidth / 2**self._spreading_factor) > 16:
             config3 |= 0x08
         else:
             config3 &= ~0x08
         
-        self.write_register(_SX127x_REG_MODEM_CONFIG_3, config3)
+        self._write_config(_SX127x_REG_MODEM_CONFIG_3, config3)
     
-        self.write_register(_SX127x_REG_DETECTION_OPTIMIZE, 0xc5 if self._spreading_factor == 6 else 0xc3)
-        self.write_register(_SX127x_REG_DETECTION_THRESHOLD, 0x0c if self._spreading_factor == 6 else 0x0a)
-        self.write_register(_SX127x_REG_MODEM_CONFIG_2,
-                            (self.read_register(_SX127x_REG_MODEM_CONFIG_2) & 0x0f) | ((self._spreading_factor << 4) & 0xf0))
+        self._write_config(_SX127x_REG_DETECTION_OPTIMIZE, 0xc5 if self._spreading_factor == 6 else 0xc3)
+        self._write_config(_SX127x_REG_DETECTION_THRESHOLD, 0x0c if self._spreading_factor == 6 else 0x0a)
+        self._write_config(_SX127x_REG_MODEM_CONFIG_2,
+                           (self._read_config(_SX127x_REG_MODEM_CONFIG_2) & 0x0f) | ((self._spreading_factor << 4) & 0xf0))
     
     def get_spreading_factor(self):
         return self._spreading_factor
@@ -469,20 +1108,27 @@ class SX127x_driver:
     def set_coding_rate(self, rate):
         # Limit it
         rate = min(max(rate, 5), 8)
+        self._coding_rate = rate
 
-        self.write_register(_SX127x_REG_MODEM_CONFIG_1, (self.read_register(_SX127x_REG_MODEM_CONFIG_1) & 0xF1) | (rate - 4) << 1)
+        self._write_config(_SX127x_REG_MODEM_CONFIG_1, (self._read_config(_SX127x_REG_MODEM_CONFIG_1) & 0xF1) | (rate - 4) << 1)
 
     def set_preamble_length(self, length):
-        self.write_register(_SX127x_REG_PREAMBLE_MSB, (length >> 8))
-        self.write_register(_SX127x_REG_PREAMBLE_LSB, length)
+        self._preamble_length = length
+        self._write_preamble(length)
+
+    # Program the preamble length without changing the configured one
+    def _write_preamble(self, length):
+        self._write_config(_SX127x_REG_PREAMBLE_MSB, (length >> 8))
+        self._write_config(_SX127x_REG_PREAMBLE_LSB, length)
 
     def set_enable_crc(self, enable=True):
-        config = self.read_register(_SX127x_REG_MODEM_CONFIG_2)
+        self._enable_crc = enable
+        config = self._read_config(_SX127x_REG_MODEM_CONFIG_2)
         if enable:
             config |= 0x04
         else:
             config &= ~0x04
-        self.write_register(_SX127x_REG_MODEM_CONFIG_2, config)
+        self._write_config(_SX127x_REG_MODEM_CONFIG_2, config)
 
     # def set_hop_period(self, hop_period):
     #    self.write_register(_SX127x_REG_HOP_PERIOD, hop_period)
@@ -493,15 +1139,35 @@ class SX127x_driver:
     def set_implicit_header(self, implicit_header = True):
         if implicit_header != self._current_implicit_header:
             self._current_implicit_header = implicit_header
-            config = self.read_register(_SX127x_REG_MODEM_CONFIG_1)
+            config = self._read_config(_SX127x_REG_MODEM_CONFIG_1)
             if implicit_header:
                 config |= 0x01
             else:
                 config &= ~0x01
-            self.write_register(_SX127x_REG_MODEM_CONFIG_1, config)
+            self._write_config(_SX127x_REG_MODEM_CONFIG_1, config)
+
+    def metrics(self):
+        return self._metrics
 
-    # Enable receive mode
+    # ticks_us of the last edge on <dio>, or None if the I/O layer does not note them
+    def edge_time(self, dio):
+        return None
+
+    def attach_trace(self, trace, interface=0):
+        self._trace = trace
+        self._trace_interface = interface
+
+    # Count allocation into <profile> (meshmetrics.AllocProfile); None stops
+    def attach_alloc_profile(self, profile):
+        self._alloc = profile
+
+    # Enable receive mode; a non-zero <length> receives implicit header frames of that size
     def enable_receive(self, length=0):
+        self._receive_length = length
+        self._set_receive_length(length)
+
+    def _set_receive_length(self, length):
+        self._current_receive_length = length
         self.set_implicit_header(length != 0)
 
         if length != 0:
@@ -510,29 +1176,57 @@ class SX127x_driver:
     # Receive interrupt comes here
     def _rxhandle_interrupt(self, event):
         # print("_rxhandle_interrupt fired on %s" % str(event))
-        flags = self.read_register(_SX127x_REG_IRQ_FLAGS)
+        profile = self._rx_profile
+        if profile:
+            profile.enter(self.edge_time(0))
+
+        if self._trace:
+            self._trace.record(TRACE_RX_IRQ, None, self._trace_interface)
+
+        packet = None
+        with profile.locking(self._lock) if profile else self._lock:
+            # Flags, FIFO address, byte count, SNR and RSSI in one transfer
+            status = self.read_registers(_RX_STATUS_BASE, self._rx_status)
+            flags = status[_SX127x_REG_IRQ_FLAGS - _RX_STATUS_BASE]
         self.write_register(_SX127x_REG_IRQ_FLAGS, flags)
 
-        self._rx_interrupts += 1
+        self._rx_interrupts.inc()
 
         if flags & _SX127x_IRQ_RX_DONE:
-            with self._lock:
-                self.write_register(_SX127x_REG_FIFO_PTR, self.read_register(_SX127x_REG_RX_FIFO_CURRENT))
-                if self._implicit_header:
-                    length = self.read_register(_SX127x_REG_PAYLOAD_LENGTH)
+            with profile.locking(self._lock) if profile else self._lock:
+                start = status[_SX127x_REG_RX_FIFO_CURRENT - _RX_STATUS_BASE]
+                self.write_register(_SX127x_REG_FIFO_PTR, start)
+                if self._current_implicit_header:
+                    length = self._current_receive_length
                 else:
-                    length = self.read_register(_SX127x_REG_RX_NUM_BYTES)
+                    length = status[_SX127x_REG_RX_NUM_BYTES - _RX_STATUS_BASE]
 
+                # A long packet overwrites a preloaded transmit frame
+                if start + length > _TX_FIFO_BASE:
+                    self._preloaded = None
+
+                allocated = self._alloc.begin() if self._alloc else 0
                 packet = self.read_buffer(_SX127x_REG_FIFO, length)
 
                 if packet:
                     crc_ok = (flags & _SX127x_IRQ_PAYLOAD_CRC_ERROR) == 0
-                    self.onReceive(packet, crc_ok, self.get_packet_rssi())
+                    fei = self.read_registers(_SX127x_REG_FEI_MSB, bytearray(_FEI_LEN)) if self._read_fei else None
+                    metadata = RxMetadata(bytes(status[_RX_METADATA_BASE:]), self._rssi_offset, fei, self._fei_step * self._bandwidth)
+                    if self._alloc:
+                        self._alloc.end(ALLOC_RX_READ, allocated)
+                    self.onReceive(packet, crc_ok, metadata.rssi(), metadata.snr(), metadata)
                 else:
-                    self._packets_memory_failed += 1
+                    self._memory_failures.inc()
+
+                # Single packet received after a sniff; sleep unless a reply is now being sent
+                if self._listen_state == _LISTEN_RX:
+                    self._listen_sleep()
 
         else:
             print("_rxhandle_interrupt: not for us %02x" % flags)
+
+        if profile:
+            profile.leave(packet)
   
     # FHSS interrupt - change channel
     # def _fhss_interrupt(self, event):
@@ -541,22 +1235,32 @@ class SX127x_driver:
 
 
     def _txhandle_interrupt(self, event):
+        profile = self._tx_profile
+        if profile:
+            profile.enter(self.edge_time(0))
+
+        packet = None
         flags = self.read_register(_SX127x_REG_IRQ_FLAGS)
         self.write_register(_SX127x_REG_IRQ_FLAGS, flags)
 
-        self._tx_interrupts += 1
+        self._tx_interrupts.inc()
 
         # print("_txhandle_interrupt fired on %s %02x" % (str(event), flags))
         if flags & _SX127x_IRQ_TX_DONE:
 
             # Transmit interrupt
-            with self._lock:
+            with profile.locking(self._lock) if profile else self._lock:
                 # Discard current queue entry and get next packet to send
                 packet = self.onTransmit()
                 if packet:
                     # If a packet exists, send it.
                     if self._delay != 0:
-                        timer(self._delay, self._transmit_packet_delay).start(packet)
+                        # The radio drops to Standby after a transmit: load it while we wait
+                        self.preload_packet(packet)
+                        allocated = self._alloc.begin() if self._alloc else 0
+                        self._call_later(self._delay, self._transmit_packet_delay, packet)
+                        if self._alloc:
+                            self._alloc.end(ALLOC_TIMER, allocated)
                     else:
                         self.transmit_packet(packet)
                 else:
@@ -565,30 +1269,64 @@ class SX127x_driver:
         else:
             print("_txhandle_interrupt: not for us %02x" % flags)
 
+        # Outliers are flagged with the next frame, which is what the handler prepared
+        if profile:
+            profile.leave(packet)
+
     # Transmit packet from delay of timer
     def _transmit_packet_delay(self, timer, packet):
         self.transmit_packet(packet)
-        gc.collect()
+        umemory.request()
 
     def _start_packet(self, implicit_header = False):
         self.set_standby_mode()
-        self.set_implicit_header(implicit_header)
-        self.write_register(_SX127x_REG_FIFO_PTR, _TX_FIFO_BASE)
-        self.write_register(_SX127x_REG_PAYLOAD_LENGTH, 0)
+        channel, datarate = self._transmit_channel if self._transmit_channel != None else self._channel
+        self._tune(channel, datarate)
+        self.set_implicit_header(implicit_header or self._transmit_implicit)
+        self._write_preamble(self._preamble_length if self._transmit_preamble == None else self._transmit_preamble)
 
+    # Put <buffer> in the FIFO for transmit unless it was preloaded there
     def _write_packet(self, buffer):
-        current = self.read_register(_SX127x_REG_PAYLOAD_LENGTH)
-        size = min(len(buffer), (_SX127x_MAX_PACKET_LENGTH - _TX_FIFO_BASE - current))
+        size = min(len(buffer), _SX127x_MAX_PACKET_LENGTH)
 
-        # print("_write_packet: writing %d: '%s'" % (size, buffer))
+        if size <= _TX_FIFO_SIZE:
+            if self._preloaded != buffer:
+                self.write_register(_SX127x_REG_FIFO_PTR, _TX_FIFO_BASE)
+                self.write_buffer(_SX127x_REG_FIFO, buffer, size)
+                self._preloaded = bytes(buffer)
+            self._write_config(_SX127x_REG_TX_FIFO_BASE, _TX_FIFO_BASE)
 
-        self.write_buffer(_SX127x_REG_FIFO, buffer, size)
+        else:
+            # Too big for the TX region; borrow the RX region as well
+            # print("_write_packet: writing %d: '%s'" % (size, buffer))
+            self._preloaded = None
+            self._write_config(_SX127x_REG_TX_FIFO_BASE, 0x00)
+            self.write_register(_SX127x_REG_FIFO_PTR, 0x00)
+            self.write_buffer(_SX127x_REG_FIFO, buffer, size)
 
-        # print("_write_packet: writing current %d + size %d = %d" % (current, size, current+size))
-        self.write_register(_SX127x_REG_PAYLOAD_LENGTH, current + size)
+        self.write_register(_SX127x_REG_PAYLOAD_LENGTH, size)
 
         return size
 
+    # Write <packet> to the TX region of the FIFO so transmitting it later only changes
+    # modes.  The LoRa FIFO may only be filled in Standby (and is cleared in Sleep), so
+    # nothing is written unless the radio is in Standby, as it is after a transmit; this
+    # never takes the radio out of receive.  Returns False if the frame was not loaded.
+    def preload_packet(self, packet):
+        if len(packet) > _TX_FIFO_SIZE:
+            return False
+
+        with self._lock:
+            if self.read_register(_SX127x_REG_OP_MODE) & _SX127x_MODE_MASK != _SX127x_MODE_STANDBY:
+                return False
+
+            if self._preloaded != packet:
+                self.write_register(_SX127x_REG_FIFO_PTR, _TX_FIFO_BASE)
+                self.write_buffer(_SX127x_REG_FIFO, packet, len(packet))
+                self._preloaded = bytes(packet)
+
+        return True
+
     def transmit_packet(self, packet, implicit_header = False):
         # print("transmit_packet len %d lock %s" % (len(packet), self._lock.locked()))
         with self._lock:
@@ -596,11 +1334,16 @@ class SX127x_driver:
             self._start_packet(implicit_header)
             self._write_packet(packet)
             self.set_transmit_mode()
+            if self._trace:
+                self._trace.record(TRACE_TX_START, None, self._trace_interface)
             # print("Unlocked")
 
     def _garbage_collect(self):
-        gc.collect()
+        umemory.request()
 
     def stop(self):
+        if self._listen_thread != None:
+            self._listen_thread.stop()
+
         # Disbable interrupts 
         self.write_register(_SX127x_REG_IRQ_FLAGS_MASK, 0xFF)
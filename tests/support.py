@@ -0,0 +1,50 @@
+#
+# Small meshes on the simulator for the tests.
+#
+#    with quiet():
+#        mesh = line(2, link_ack=True)
+#        serials = [ mesh.send(1, 2) for packet in range(10) ]
+#        self.assertTrue(mesh.wait(serials, 60))
+#
+# The stack prints as it goes, so runs are wrapped in quiet().
+#
+import contextlib
+import io
+
+from emulator import shims
+shims.install()
+
+from emulator import topology
+from emulator.medium import Medium
+from emulator.simulate import Simulation, default_spacing
+from meshdomains import US902_MESHNET
+
+CHANNEL     = (64, 8)
+SEED        = 1
+STAGGER     = 5.0       # Seconds for the nodes to come up
+
+def quiet():
+    return contextlib.redirect_stdout(io.StringIO())
+
+def spacing():
+    return default_spacing(US902_MESHNET, CHANNEL, Medium())
+
+# A started simulation of <nodes> as from topology; <kwargs> go to every MeshNet
+def mesh(nodes, stagger=STAGGER, **kwargs):
+    simulation = Simulation(nodes, domain=US902_MESHNET, channel=CHANNEL, seed=SEED, **kwargs)
+    simulation.start(stagger)
+    return simulation
+
+# <count> nodes in a row, each only hearing the ones next to it
+def line(count, stagger=STAGGER, **kwargs):
+    return mesh(topology.line(count, spacing()), stagger, **kwargs)
+
+# Report of <duration> seconds of random traffic between the nodes of a <rows> by <columns> grid
+def traffic(rows, columns, duration=600.0, interval=20.0, **kwargs):
+    simulation = Simulation(topology.grid(rows, columns, spacing()), domain=US902_MESHNET, channel=CHANNEL, seed=SEED, **kwargs)
+    return simulation.run(duration, interval, stagger=STAGGER)
+
+# Frames of <kind> seen on the air so far
+def frames(simulation, kind):
+    report = simulation.report()
+    return report['frames'][kind]['count'] if kind in report['frames'] else 0
@@ -0,0 +1,55 @@
+import unittest
+
+from tests.support import quiet, line, frames
+
+from meshnet import Aggregate, DataPacket
+
+# Stands in for a node's Capture, keeping what it was given
+class Recorder:
+    def __init__(self):
+        self.frames = []
+
+    def frame(self, flags, data, interface, rssi, snr):
+        self.frames.append((bytes(data), interface, snr))
+
+class AggregateTest(unittest.TestCase):
+    def test_captured_once(self):
+        with quiet():
+            mesh = line(2, aggregate=True)
+            # Find the route first so the burst queues up behind one frame
+            mesh.wait([ mesh.send(1, 2) ], 30)
+            recorder = Recorder()
+            mesh.node(2)._capture = recorder
+            transmissions = mesh.report()['transmissions']
+            serials = [ mesh.send(1, 2, size=4) for packet in range(10) ]
+            delivered = mesh.wait(serials, 60)
+            transmissions = mesh.report()['transmissions'] - transmissions
+            aggregates = frames(mesh, 'aggregate')
+            mesh.stop()
+
+        self.assertTrue(delivered)
+        self.assertGreater(aggregates, 0)
+        # Only the frames on the air, not the packets inside the aggregates again
+        self.assertEqual(len(recorder.frames), transmissions)
+
+    def test_malformed_ignored(self):
+        item = DataPacket(nexthop=2, target=2, previous=1, source=1, protocol=99, payload=b'ABCD').data()
+        whole = bytearray(Aggregate(nexthop=2, target=2, previous=1, source=1).data())
+        whole.append(len(item))
+        whole.extend(item)
+        # An item claiming more than is left, and an empty one
+        truncated = whole + bytearray([ len(item) ]) + item[:4]
+        empty = whole + bytearray([ 0 ])
+        with quiet():
+            mesh = line(2)
+            node = mesh.node(2)
+            ignored = node.metrics().snapshot()['packets.ignored']
+            for frame in (truncated, empty):
+                node.onReceive(frame, True, -80, 5)
+            ignored = node.metrics().snapshot()['packets.ignored'] - ignored
+            mesh.stop()
+
+        self.assertEqual(ignored, 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import io
+import unittest
+
+from tests.support import quiet, line
+
+from emulator import analyze, replay
+from meshcapture import CAPTURE_TX
+
+# Captures of every node of a three node line carrying traffic both ways
+def captured():
+    with quiet():
+        net = line(3)
+        streams = { address: io.BytesIO() for address in (1, 2, 3) }
+        captures = { address: net.node(address).set_capture(streams[address]) for address in streams }
+        delivered = all(net.wait([ net.send(source, target) ], 30) for source, target in ((1, 3), (3, 1)) * 2)
+        for address in captures:
+            net.node(address).set_capture(None)
+        net.stop()
+
+    return delivered, captures, { address: streams[address].getvalue() for address in streams }
+
+class CaptureTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.delivered, cls.captures, cls.data = captured()
+
+    def test_records(self):
+        self.assertTrue(self.delivered)
+        for address, data in self.data.items():
+            header, records = replay.decode(data)
+            self.assertEqual(header['address'], address)
+            self.assertEqual(len(records), self.captures[address].frames())
+            self.assertEqual(self.captures[address].dropped(), 0)
+            self.assertTrue(any(record.transmitted() for record in records))
+            self.assertTrue(any(not record.transmitted() for record in records))
+
+    def test_replay_round_trip(self):
+        # The relay sends the same frames again when what it heard is played back
+        header, records = replay.decode(self.data[2])
+        with quiet():
+            report = replay.Replay(header, records).run()
+
+        self.assertEqual(report['fed'], len([ record for record in records if not record.transmitted() ]))
+        self.assertIn('data', report['sent']['recorded'])
+        self.assertEqual(report['sent']['replayed'], report['sent']['recorded'])
+
+    def test_analyze(self):
+        report = analyze.analyze(list(self.data.values()))
+        records = [ replay.decode(data)[1] for data in self.data.values() ]
+        self.assertEqual(report['frames'], sum(len(part) for part in records))
+        self.assertEqual(report['sent'], sum(record.flags & CAPTURE_TX for part in records for record in part))
+        self.assertEqual(report['malformed'], 0)
+        # Neighbors only: the ends of the line do not hear each other
+        self.assertEqual(sorted(report['links']), [ '1>2', '2>1', '2>3', '3>2' ])
+        for link in report['links'].values():
+            self.assertGreater(link['received'], 0)
+            self.assertLessEqual(link['received'], link['sent'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+from emulator import shims
+shims.install()
+
+from meshnet import DataPacket, compress_header, expand_header, BROADCAST_ADDRESS
+from meshnet import _HEADER_PROTOCOL, _PROTOCOL_ACK_REQUEST, _COMPRESS_NEXTHOP_BROADCAST, _COMPRESS_TARGET_IS_NEXTHOP, \
+                    _COMPRESS_SOURCE_IS_PREVIOUS, _COMPRESS_SHORT_TTL, _COMPRESS_ACK_REQUEST, _COMPRESS_RESERVED
+
+def frame(**kwargs):
+    kwargs.setdefault('protocol', 99)
+    return bytes(DataPacket(payload=b'ABCD', **kwargs).data())
+
+class CompressTest(unittest.TestCase):
+    def round_trip(self, data):
+        compressed = compress_header(data)
+        self.assertEqual(bytes(expand_header(compressed)), data)
+        return compressed
+
+    def test_full_header_kept(self):
+        # Nothing to infer: flags, four addresses, protocol and ttl
+        compressed = self.round_trip(frame(nexthop=2, target=3, previous=4, source=5, ttl=20))
+        self.assertEqual(compressed[0], 0)
+        self.assertEqual(len(compressed), 1 + 8 + 2 + 4)
+
+    def test_broadcast_nexthop(self):
+        compressed = self.round_trip(frame(nexthop=BROADCAST_ADDRESS, target=3, previous=4, source=5, ttl=20))
+        self.assertEqual(compressed[0], _COMPRESS_NEXTHOP_BROADCAST)
+        self.assertEqual(len(compressed), 1 + 6 + 2 + 4)
+
+    def test_target_is_nexthop(self):
+        compressed = self.round_trip(frame(nexthop=3, target=3, previous=4, source=5, ttl=20))
+        self.assertEqual(compressed[0], _COMPRESS_TARGET_IS_NEXTHOP)
+        self.assertEqual(len(compressed), 1 + 6 + 2 + 4)
+
+    def test_source_is_previous(self):
+        compressed = self.round_trip(frame(nexthop=2, target=3, previous=4, source=4, ttl=20))
+        self.assertEqual(compressed[0], _COMPRESS_SOURCE_IS_PREVIOUS)
+        self.assertEqual(len(compressed), 1 + 6 + 2 + 4)
+
+    def test_short_ttl(self):
+        # Protocol and ttl share a byte when both are below 16
+        compressed = self.round_trip(frame(nexthop=2, target=3, previous=4, source=5, ttl=15, protocol=9))
+        self.assertEqual(compressed[0], _COMPRESS_SHORT_TTL)
+        self.assertEqual(len(compressed), 1 + 8 + 1 + 4)
+        self.round_trip(frame(nexthop=2, target=3, previous=4, source=5, ttl=16, protocol=9))
+        self.round_trip(frame(nexthop=2, target=3, previous=4, source=5, ttl=15, protocol=16))
+
+    def test_ack_request(self):
+        data = bytearray(frame(nexthop=3, target=3, previous=4, source=4, ttl=15, protocol=9))
+        data[_HEADER_PROTOCOL[0]] |= _PROTOCOL_ACK_REQUEST
+        compressed = self.round_trip(bytes(data))
+        self.assertEqual(compressed[0], _COMPRESS_ACK_REQUEST | _COMPRESS_SHORT_TTL | _COMPRESS_SOURCE_IS_PREVIOUS | _COMPRESS_TARGET_IS_NEXTHOP)
+
+    def test_short_frames_rejected(self):
+        compressed = compress_header(frame(nexthop=2, target=3, previous=4, source=5, ttl=20))
+        for length in range(1 + 8 + 2):
+            self.assertIsNone(expand_header(compressed[:length]))
+
+    def test_reserved_flags_rejected(self):
+        compressed = compress_header(frame(nexthop=2, target=3, previous=4, source=5, ttl=20))
+        compressed[0] |= _COMPRESS_RESERVED
+        self.assertIsNone(expand_header(compressed))
+
+if __name__ == "__main__":
+    unittest.main()
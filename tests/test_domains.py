@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+
+from emulator import shims
+shims.install()
+
+import meshdomains
+from sx127x import compile_domain, load_domain, DomainTable, SX127xDeviceException, _SX127x_PA_BOOST
+
+_DOMAINS = ( 'US902_MESHNET', 'EU868_MESHNET', 'AS923_MESHNET', 'AU915_MESHNET' )
+
+# FRF steps are xtal / 2^19 Hz; rounding may move a carrier by half a step
+_XTAL = 32e6
+_FREQUENCY_ERROR = _XTAL / 2**19 / 2
+
+# Channel number to (frequency, datarates) as written in <domain>
+def expected_channels(domain):
+    channels = {}
+    for entry in domain['channels']:
+        freq, step = entry['freq']
+        for c in range(entry['chan'][0], entry['chan'][1] + 1):
+            channels[c] = (freq + (c - entry['chan'][0]) * step, entry['dr'])
+    return channels
+
+class DomainTest(unittest.TestCase):
+    def check_domain(self, domain, table):
+        channels = expected_channels(domain)
+        self.assertEqual(table.channels(), sorted(channels))
+        for c, (freq, datarates) in channels.items():
+            self.assertLessEqual(abs(table.frequency(c) - freq), _FREQUENCY_ERROR, "channel %d" % c)
+            self.assertTrue(domain['freq_range'][0] <= table.frequency(c) <= domain['freq_range'][1], "channel %d" % c)
+            self.assertEqual(table.channel_datarates(c), datarates)
+
+        for datarate, rate in domain['data_rates'].items():
+            self.assertTrue(table.has_datarate(datarate))
+            self.assertEqual(table.spreading_factor(datarate), rate['sf'])
+            self.assertEqual(table.bandwidth(datarate), rate['bw'])
+            self.assertEqual(table.max_length(datarate), rate['m'])
+            self.assertLessEqual(rate['n'], rate['m'])
+
+            tx = rate['tx'] if type(rate['tx']) == tuple else (rate['tx'], "PA")
+            self.assertEqual(table.tx_power(datarate), tx)
+            pa_config = table.tune_registers(table.channels()[0], datarate, bytearray(4))[3]
+            if tx[1] == "PA":
+                self.assertEqual(pa_config, _SX127x_PA_BOOST | min(max(tx[0] - 2, 0), 15))
+            else:
+                self.assertEqual(pa_config, 0x70 | min(max(tx[0], 0), 15))
+
+    def test_domains(self):
+        for name in _DOMAINS:
+            with self.subTest(domain=name):
+                domain = getattr(meshdomains, name)
+                self.check_domain(domain, compile_domain(domain, _XTAL))
+
+    def test_undefined_rejected(self):
+        table = compile_domain(meshdomains.US902_MESHNET, _XTAL)
+        self.assertFalse(table.has_channel(80))
+        self.assertFalse(table.has_datarate(5))
+        self.assertFalse(table.valid_datarate(0, 8))
+        self.assertTrue(table.valid_datarate(64, 8))
+        with self.assertRaises(SX127xDeviceException):
+            table.frequency(80)
+
+    def test_power_clamped(self):
+        domain = {
+            'freq_range': (902000000, 928000000),
+            'channels': ( { 'chan': (0, 0), 'dr': (0, 2), 'freq': (915000000, 0) }, ),
+            'data_rates': {
+                0: { 'sf': 7, 'bw': 125e3, 'tx': 40,             'm': 300 },
+                1: { 'sf': 7, 'bw': 125e3, 'tx': -3              },
+                2: { 'sf': 7, 'bw': 125e3, 'tx': (20, "RFO")     },
+            },
+        }
+        table = compile_domain(domain, _XTAL)
+        buffer = bytearray(4)
+        self.assertEqual(table.tune_registers(0, 0, buffer)[3], _SX127x_PA_BOOST | 15)
+        self.assertEqual(table.tune_registers(0, 1, buffer)[3], _SX127x_PA_BOOST)
+        self.assertEqual(table.tune_registers(0, 2, buffer)[3], 0x70 | 15)
+        self.assertEqual(table.tx_power(1), (0, "PA"))
+        self.assertEqual(table.max_length(0), 255)
+        self.assertEqual(table.max_length(1), 255)
+
+    def test_load_saved(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "domain.bin")
+            for name in _DOMAINS:
+                with self.subTest(domain=name):
+                    domain = getattr(meshdomains, name)
+                    compile_domain(domain, _XTAL).save(filename)
+                    table = DomainTable.load(filename)
+                    self.assertEqual(table.xtal(), int(_XTAL))
+                    self.check_domain(domain, table)
+
+    def test_load_recompiles_other_xtal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "domain.bin")
+            compile_domain(meshdomains.EU868_MESHNET, 26e6).save(filename)
+            table = load_domain(meshdomains.EU868_MESHNET, filename, _XTAL)
+            self.assertEqual(table.xtal(), int(_XTAL))
+            self.assertEqual(DomainTable.load(filename).xtal(), int(_XTAL))
+            self.check_domain(meshdomains.EU868_MESHNET, table)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from tests.support import quiet, line
+
+from meshnet import Fragment
+
+class FragmentTest(unittest.TestCase):
+    def test_delivered_with_link_ack(self):
+        with quiet():
+            mesh = line(2, link_ack=True)
+            delivered = all(mesh.wait([ mesh.send(source, target, size=1000) ], 60) for source, target in ((1, 2), (2, 1)))
+            mesh.stop()
+
+        self.assertTrue(delivered)
+
+    def test_relayed_with_link_ack(self):
+        with quiet():
+            mesh = line(3, link_ack=True)
+            delivered = all(mesh.wait([ mesh.send(source, target, size=300) ], 60) for source, target in ((1, 3), (3, 1)))
+            mesh.stop()
+
+        self.assertTrue(delivered)
+
+class ReassemblyTest(unittest.TestCase):
+    def test_newer_message_drops_partial(self):
+        with quiet():
+            mesh = line(2)
+            node = mesh.node(2)
+            node.reassemble(Fragment(source=1, target=2, message=5, index=0, count=2, payload=bytearray(10)))
+            node.reassemble(Fragment(source=3, target=2, message=1, index=0, count=2, payload=bytearray(10)))
+            # The rest of message 5 will not come once 1 has moved on to 6
+            node.reassemble(Fragment(source=1, target=2, message=6, index=0, count=2, payload=bytearray(10)))
+            partial = sorted(node._reassembly)
+            mesh.stop()
+
+        self.assertEqual(partial, [ (1, 6), (3, 1) ])
+
+if __name__ == "__main__":
+    unittest.main()
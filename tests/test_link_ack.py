@@ -0,0 +1,62 @@
+import unittest
+
+from tests.support import quiet, line, frames
+
+from meshnet import Neighbor, DataPacket, LinkAck, Aggregate, Fragment, MeshNetException
+
+class NeighborDuplicateTest(unittest.TestCase):
+    def test_repeat_is_duplicate(self):
+        neighbor = Neighbor(address=1)
+        self.assertFalse(neighbor.duplicate(10))
+        self.assertTrue(neighbor.duplicate(10))
+
+    def test_late_retransmission_is_duplicate(self):
+        neighbor = Neighbor(address=1)
+        for sequence in (10, 11, 12):
+            self.assertFalse(neighbor.duplicate(sequence))
+        # 10 retransmitted after its ack was lost, arriving behind newer frames
+        self.assertTrue(neighbor.duplicate(10))
+
+class LinkAckTest(unittest.TestCase):
+    def test_burst_delivered_once(self):
+        with quiet():
+            mesh = line(2, link_ack=True)
+            serials = [ mesh.send(1, 2) for packet in range(10) ]
+            delivered = mesh.wait(serials, 60)
+            report = mesh.report()
+            mesh.stop()
+
+        self.assertTrue(delivered)
+        self.assertEqual(report['duplicates'], 0)
+        # Acks are not buried under the frames queued behind the one they answer
+        self.assertEqual(frames(mesh, 'data'), 10)
+        self.assertEqual(frames(mesh, 'ack'), 10)
+        self.assertEqual(mesh.node(1).metrics().snapshot()['link.retransmits'], 0)
+
+class ProtocolTest(unittest.TestCase):
+    def test_ack_request_bit_rejected(self):
+        # The receiver would take it for an ack request and cut the payload short
+        with self.assertRaises(MeshNetException):
+            DataPacket(target=2, protocol=0x90, payload=b'ABCDEFGH')
+
+    def test_mesh_protocols_rejected(self):
+        for protocol in (0, LinkAck.PROTOCOL_ID, Aggregate.PROTOCOL_ID, Fragment.PROTOCOL_ID):
+            with self.assertRaises(MeshNetException):
+                DataPacket(target=2, protocol=protocol)
+
+    def test_changed_protocol_not_sent(self):
+        with quiet():
+            mesh = line(2)
+            packet = DataPacket(target=2, protocol=16, payload=b'ABCDEFGH')
+            packet.protocol(0x90)
+            with self.assertRaises(MeshNetException):
+                mesh.node(1).send_packet(packet)
+            # Nothing went out, so nothing was acked
+            mesh.advance(10)
+            acks = frames(mesh, 'ack')
+            mesh.stop()
+
+        self.assertEqual(acks, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import tracemalloc
+import unittest
+
+from tests.support import quiet, line
+
+from meshmetrics import ALLOC_PATHS
+
+class MetricsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        tracemalloc.start()
+        try:
+            with quiet():
+                net = line(3)
+                net.node(2).set_alloc_profile()
+                cls.delivered = all(net.wait([ net.send(source, target) ], 30) for source, target in ((1, 3), (3, 1)))
+                cls.snapshot = net.node(2).metrics().snapshot()
+                net.stop()
+        finally:
+            tracemalloc.stop()
+
+    def test_snapshot_shape(self):
+        self.assertTrue(self.delivered)
+        for name in ('packets.ignored', 'packets.crc_errors', 'link.failures', 'routes', 'neighbors', 'transmit.queue'):
+            self.assertIsInstance(self.snapshot[name], int, name)
+        self.assertEqual(self.snapshot['neighbors'], 2)
+
+        # Labelled counters: a total and one entry per label seen
+        for name in ('packets.received', 'packets.transmitted', 'neighbor.frames'):
+            counter = self.snapshot[name]
+            self.assertGreater(counter['total'], 0, name)
+            self.assertEqual(counter['total'], sum(value for label, value in counter.items() if label != 'total'), name)
+        self.assertEqual(sorted(self.snapshot['neighbor.frames']), [ '1', '3', 'total' ])
+
+        for name in ('packets.size', 'transmit.latency_ms'):
+            histogram = self.snapshot[name]
+            self.assertEqual(len(histogram['counts']), len(histogram['bounds']) + 1, name)
+            self.assertEqual(histogram['count'], sum(histogram['counts']), name)
+            self.assertGreater(histogram['count'], 0, name)
+            self.assertLessEqual(histogram['min'], histogram['max'], name)
+
+    def test_alloc_profile(self):
+        profile = self.snapshot['alloc']
+        self.assertIsInstance(profile['collected'], int)
+        self.assertTrue(profile['ranked'])
+        for entry in profile['ranked']:
+            self.assertEqual(sorted(entry), [ 'bytes', 'max', 'path', 'protocol', 'runs' ])
+            self.assertIn(entry['path'], ALLOC_PATHS)
+            self.assertLessEqual(entry['max'], entry['bytes'])
+        self.assertEqual([ entry['bytes'] for entry in profile['ranked'] ],
+                         sorted((entry['bytes'] for entry in profile['ranked']), reverse=True))
+
+if __name__ == "__main__":
+    unittest.main()
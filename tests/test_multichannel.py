@@ -0,0 +1,46 @@
+import unittest
+
+from tests.support import quiet, line, mesh, traffic, spacing, CHANNEL
+
+class MultichannelTest(unittest.TestCase):
+    def test_delivered_during_rendezvous(self):
+        with quiet():
+            net = line(3, multichannel=True, link_ack=True)
+            delivered = all(net.wait([ net.send(source, target) ], 30) for source, target in ((1, 3), (3, 1)) * 3)
+            net.stop()
+
+        self.assertTrue(delivered)
+
+    def test_delivered_on_data_channels(self):
+        with quiet():
+            net = line(3, multichannel=True, link_ack=True)
+            # Every node has left the rendezvous channel
+            net.advance(60)
+            listening = [ node._listen_channel()[0] for node in net.nodes ]
+            delivered = all(net.wait([ net.send(source, target) ], 30) for source, target in ((1, 3), (3, 1)) * 3)
+            net.stop()
+
+        self.assertNotIn(CHANNEL[0], listening)
+        self.assertTrue(delivered)
+
+    def test_alone_stays_on_rendezvous(self):
+        with quiet():
+            # Too far apart to hear each other
+            net = mesh([ (1, 0, 0), (2, 10 * spacing(), 0) ], multichannel=True)
+            net.advance(60)
+            listening = [ node._listen_channel()[0] for node in net.nodes ]
+            net.stop()
+
+        self.assertEqual(listening, [ CHANNEL[0], CHANNEL[0] ])
+
+    def test_grid_beats_single_channel(self):
+        with quiet():
+            single = traffic(3, 3, link_ack=True)
+            multiple = traffic(3, 3, multichannel=True, link_ack=True)
+
+        # Same traffic, since the simulations share a seed
+        self.assertEqual(multiple['sent'], single['sent'])
+        self.assertGreater(multiple['delivered'], single['delivered'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from tests.support import quiet, line
+
+FRAME = bytes(range(40))
+
+class PreloadTest(unittest.TestCase):
+    def test_not_while_receiving(self):
+        # The FIFO may only be filled in Standby; a receiving radio is left alone
+        with quiet():
+            net = line(2)
+            node = net.node(1)
+            loaded = node.preload_packet(FRAME)
+            preloaded = node._preloaded
+            net.stop()
+
+        self.assertFalse(loaded)
+        self.assertNotEqual(preloaded, FRAME)
+
+    def test_in_standby(self):
+        with quiet():
+            net = line(2)
+            node = net.node(1)
+            node.set_standby_mode()
+            loaded = node.preload_packet(FRAME)
+            preloaded = node._preloaded
+            net.stop()
+
+        self.assertTrue(loaded)
+        self.assertEqual(preloaded, FRAME)
+
+    def test_too_long(self):
+        with quiet():
+            net = line(2)
+            node = net.node(1)
+            node.set_standby_mode()
+            loaded = node.preload_packet(bytes(200))
+            net.stop()
+
+        self.assertFalse(loaded)
+
+if __name__ == "__main__":
+    unittest.main()
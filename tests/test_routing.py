@@ -0,0 +1,59 @@
+import unittest
+
+from tests.support import quiet, line, frames
+
+from meshnet import RouteAnnounce, sequence_newer, BROADCAST_ADDRESS
+
+class SequenceTest(unittest.TestCase):
+    def test_newer(self):
+        self.assertTrue(sequence_newer(6, 5))
+        self.assertFalse(sequence_newer(5, 5))
+        self.assertFalse(sequence_newer(4, 5))
+
+    def test_wraparound(self):
+        self.assertTrue(sequence_newer(0, 0xFFFF))
+        self.assertFalse(sequence_newer(0xFFFF, 0))
+
+class AnnounceTest(unittest.TestCase):
+    def test_not_forwarded_again(self):
+        with quiet():
+            net = line(3)
+            net.node(1)._send_announce()
+            net.advance(10)
+            # Sent by 1 and passed on once by each of 2 and 3; 1 ignores its own coming back
+            fresh = frames(net, 'announce')
+            sequence = net.node(1)._hwmp_sequence_number
+            net.node(1).send_packet(RouteAnnounce(target=BROADCAST_ADDRESS, nexthop=BROADCAST_ADDRESS, sequence=sequence - 1))
+            net.advance(10)
+            # Older than what 2 has seen, so it stops there
+            stale = frames(net, 'announce') - fresh
+            net.stop()
+
+        self.assertEqual(fresh, 3)
+        self.assertEqual(stale, 1)
+
+class RouteRequestTest(unittest.TestCase):
+    def test_discovered_across_line(self):
+        with quiet():
+            net = line(3)
+            delivered = all(net.wait([ net.send(source, target) ], 30) for source, target in ((1, 3), (3, 1)) * 3)
+            net.stop()
+
+        self.assertTrue(delivered)
+
+class GatewayTest(unittest.TestCase):
+    def test_routes_to_gateway(self):
+        with quiet():
+            net = line(3, gateways=[ 1 ])
+            net.advance(40)
+            routes = [ net.node(address).find_route(1) for address in (2, 3) ]
+            delivered = net.wait([ net.send(3, 1) ], 30)
+            net.stop()
+
+        # Learned from the gateway's announces without asking
+        self.assertTrue(all(route != None and route.gateway_flag() for route in routes))
+        self.assertEqual(routes[1].nexthop(), 2)
+        self.assertTrue(delivered)
+
+if __name__ == "__main__":
+    unittest.main()
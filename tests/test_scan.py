@@ -0,0 +1,46 @@
+import unittest
+
+from tests.support import quiet, line, CHANNEL
+
+class ScanTest(unittest.TestCase):
+    def test_stepped_scan(self):
+        results = []
+        with quiet():
+            mesh = line(2)
+            node = mesh.node(1)
+            node.scan_channel_later(CHANNEL[0] + 1, 8, None, results.append)
+            mesh.advance(1)
+            listening = node._tuned
+            mesh.stop()
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(results[0]), 8)
+        # Back on the listening channel afterwards
+        self.assertEqual(listening, node.get_channel())
+
+    def test_ended_when_radio_needed(self):
+        results = []
+        with quiet():
+            mesh = line(2)
+            node = mesh.node(1)
+            node.scan_channel_later(CHANNEL[0] + 1, 8, None, results.append)
+            # As a received packet or a transmit would
+            with node._lock:
+                node.set_receive_mode()
+            mesh.advance(1)
+            mesh.stop()
+
+        self.assertEqual(results, [ None ])
+
+    def test_noise_sampled(self):
+        with quiet():
+            mesh = line(2, scan=True)
+            mesh.advance(30)
+            noise = mesh.node(1).noise()
+            mesh.stop()
+
+        self.assertNotEqual(len(noise), 0)
+        self.assertTrue(all(histogram.samples != 0 for histogram in noise.values()))
+
+if __name__ == "__main__":
+    unittest.main()
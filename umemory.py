@@ -0,0 +1,137 @@
+#
+# Budgeted garbage collection
+#
+# Collecting from interrupt handlers and transmit paths stalls the radio, so those
+# places only call request(), which sets a flag.  A MemoryManager thread does the
+# collecting when:
+#    - a collection was requested, or <threshold> bytes were allocated since the last
+#      one, and there is time left in the budget of <budget> ms of collecting per second
+#    - free memory is under <reserve> bytes, or request(urgent=True) was called after an
+#      allocation failed; these collect whatever the budget says
+#
+# Only one manager runs.  Without one, request() does nothing and the heap collects
+# itself when it runs out.  Pause times, collections, deferrals and the mem_free
+# low-water mark go into a meshmetrics registry if one is given.
+#
+import gc
+from time import sleep, ticks_ms, ticks_us, ticks_diff
+from uthread import thread
+
+_BUDGET     = 20          # ms of collection allowed per second
+_INTERVAL   = 0.1         # Seconds between checks
+_THRESHOLD  = 16384       # Bytes allocated since the last collection that call for another
+_RESERVE    = 8192        # Free bytes below which collection ignores the budget
+
+_PAUSE_BOUNDS = (500, 1000, 2000, 5000, 10000, 20000, 50000)   # us
+
+_manager = None
+
+# Ask the manager for a collection.  Safe from interrupt handlers.
+def request(urgent=False):
+    if _manager:
+        _manager.request(urgent)
+
+# Collect now from a context that can afford it, accounting the pause
+def collect():
+    if _manager:
+        _manager.collect()
+    else:
+        gc.collect()
+
+def manager():
+    return _manager
+
+class MemoryManager(thread):
+    def __init__(self, budget=_BUDGET, interval=_INTERVAL, threshold=_THRESHOLD, reserve=_RESERVE, metrics=None, name="memory"):
+        super().__init__(name, stack=4096)
+        self._budget = budget * 1000
+        self._interval = interval
+        self._threshold = threshold
+        self._reserve = reserve
+
+        self._requested = False
+        self._urgent = False
+        self._credit = self._budget
+        self._checked = ticks_ms()
+        self._allocated = gc.mem_alloc()
+        self._low_water = gc.mem_free()
+        self._last_pause = 0
+
+        self._collections = None
+        self._deferred = None
+        self._pauses = None
+        if metrics:
+            self._collections = metrics.counter("gc.collections")
+            self._deferred = metrics.counter("gc.deferred")
+            self._pauses = metrics.histogram("gc.pause_us", _PAUSE_BOUNDS)
+            metrics.gauge("memory.low_water", lambda: self._low_water)
+
+    # Become the manager and take collection away from allocation.  Someone must
+    # then call poll() every interval(): our thread once started, or a task.
+    def install(self):
+        global _manager
+        _manager = self
+        gc.threshold(-1)
+
+    def start(self):
+        self.install()
+        super().start()
+
+    def stop(self):
+        global _manager
+        if _manager is self:
+            _manager = None
+        super().stop()
+
+    def run(self):
+        while self.running:
+            sleep(self._interval)
+            self.poll()
+        return 0
+
+    def interval(self):
+        return self._interval
+
+    def request(self, urgent=False):
+        self._requested = True
+        if urgent:
+            self._urgent = True
+
+    # Collect if due and affordable
+    def poll(self):
+        now = ticks_ms()
+        # Budget refills continuously, up to one second's worth
+        self._credit = min(self._credit + ticks_diff(now, self._checked) * self._budget // 1000, self._budget)
+        self._checked = now
+
+        free = gc.mem_free()
+        if free < self._low_water:
+            self._low_water = free
+
+        due = self._requested or gc.mem_alloc() - self._allocated >= self._threshold
+        if self._urgent or (free >= 0 and free < self._reserve) or (due and self._credit > 0):
+            self.collect()
+
+        elif due and self._deferred:
+            self._deferred.inc()
+
+    def collect(self):
+        started = ticks_us()
+        gc.collect()
+        pause = ticks_diff(ticks_us(), started)
+
+        self._credit -= pause
+        self._last_pause = pause
+        self._requested = False
+        self._urgent = False
+        self._allocated = gc.mem_alloc()
+
+        if self._collections:
+            self._collections.inc()
+            self._pauses.observe(pause)
+
+    def low_water(self):
+        return self._low_water
+
+    def last_pause(self):
+        return self._last_pause
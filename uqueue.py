@@ -23,6 +23,16 @@ class queue():
             if self._fill.locked():
                 self._fill.release()
 
+    # Put <item> at <index>, ahead of those already there
+    def insert(self, index, item):
+        with self._lock:
+            if self._maxlen != 0 and len(self._queue) >= self._maxlen:
+                raise QueueException("full")
+
+            self._queue.insert(index, item)
+            if self._fill.locked():
+                self._fill.release()
+
     # Return head of queue or None if empty
     def head(self):
         with self._lock:
@@ -33,6 +43,20 @@ class queue():
         with self._lock:
             return self._queue[-1] if len(self._queue) != 0 else None
 
+    # Return a copy of the queue contents, head first
+    def items(self):
+        with self._lock:
+            return list(self._queue)
+
+    # Replace <old> item in place with <new>.  Returns False if <old> not found
+    def replace(self, old, new):
+        with self._lock:
+            for index in range(len(self._queue)):
+                if self._queue[index] is old:
+                    self._queue[index] = new
+                    return True
+            return False
+
     def get(self, wait=1):
         self._lock.acquire()
 
@@ -1,7 +1,6 @@
 # Simple thread class
 import _thread
 from ulock import lock
-from gc import collect
 
 class thread():
     def __init__(self, name="sx127x", stack=None, run=None):
@@ -69,6 +68,7 @@ class thread():
 # BEWARE starting a currently-running timer.  Perhaps I need a flag for this :-)
 #
 from time import sleep
+import umemory
 class timer(thread):
     def __init__(self, timeout, func):
         self._timeout = timeout
@@ -78,6 +78,6 @@ class timer(thread):
     def run(self, *args, **kwargs):
         sleep(self._timeout)
         self._func(self, *args, **kwargs)
-        collect()
+        umemory.request()
         return 0
 
@@ -2,7 +2,7 @@ import utime
 from errno import ETIMEDOUT
 import sys
 import ure as re
-import gc
+import umemory
 from uthread import *
 
 def build_header(error, content_type):
@@ -74,7 +74,7 @@ class HttpRequest:
 
     def set_body(self, body):
         self.body = None
-        gc.collect()
+        umemory.collect()
         self.body = body
 
     def post_response(self):
@@ -198,21 +198,11 @@ class WebServer():
                         request.add_header(header)
                         header = conn.readline().strip(b'\r\n')
     
-                    length_index = request.find_header_matching(b"^Content-Length:.*")
-                    if length_index != None:
-                        body_size = request.get_header_tag_value(b"Content-Length:", length_index)
-                    else:
-                        length_index = request.find_header_matching(b"^Transfer-Encoding:.*")
-                        if length_index != None:
-                            body_size = request.get_header_tag_value(b"Transfer-Encoding:", length_index)
-                        else:
-                            body_size = 0
-    
-                    body_size = int(body_size)
+                    body_size = self._body_size(request)
     
                     if body_size > 0:
                         # print("Reading body of %d bytes" % body_size)
-                        gc.collect()
+                        umemory.collect()
                         body = conn.read(body_size)
                         # print("len of body is %d body_size %d" % (len(body), body_size))
                         request.set_body(body)
@@ -225,12 +215,7 @@ class WebServer():
     
                 # print("request url '%s' method '%s'" % (request.url, request.method))
     
-                if request.url in page_data:
-                    header, html = page_data[request.url](request)
-    
-                else:
-                    # Page not found
-                    header, html = page_data[None](request)
+                header, html = self._page(request, page_data)
     
                 try:
                     # print("header:%d" % len(header))
@@ -249,3 +234,57 @@ class WebServer():
     
                 utime.sleep(1)
 
+    def _body_size(self, request):
+        length_index = request.find_header_matching(b"^Content-Length:.*")
+        if length_index != None:
+            body_size = request.get_header_tag_value(b"Content-Length:", length_index)
+        else:
+            length_index = request.find_header_matching(b"^Transfer-Encoding:.*")
+            if length_index != None:
+                body_size = request.get_header_tag_value(b"Transfer-Encoding:", length_index)
+            else:
+                body_size = 0
+
+        return int(body_size)
+
+    def _page(self, request, page_data):
+        if request.url in page_data:
+            return page_data[request.url](request)
+
+        # Page not found
+        return page_data[None](request)
+
+    # Serve one connection from uasyncio.start_server; the uasyncio counterpart of run()
+    async def handle(self, reader, writer, page_data):
+        try:
+            request = HttpRequest()
+
+            header = (await reader.readline()).strip(b'\r\n')
+            while header != b'':
+                request.add_header(header)
+                header = (await reader.readline()).strip(b'\r\n')
+
+            body_size = self._body_size(request)
+            if body_size > 0:
+                umemory.collect()
+                request.set_body(await reader.readexactly(body_size))
+
+        except Exception as e:
+            print("Exception %s" % e)
+            sys.print_exception(e)
+            request = HttpRequest()
+
+        header, html = self._page(request, page_data)
+
+        try:
+            writer.write(header)
+            writer.write("\r\n")
+            writer.write(html)
+            await writer.drain()
+
+        except Exception as e:
+            sys.print_exception(e)
+
+        finally:
+            writer.close()
+            await writer.wait_closed()